@@ -0,0 +1,384 @@
+"""Benchmarks for gitpy
+Builds a synthetic repository (however many files, directories however deep, files however big, and however
+many commits of history) in a temp directory, then times each command and the functions doing the work under
+them, including pushes to a fake receive-pack server running on localhost. Results come out as JSON so two
+revisions can be compared:
+
+    git show HEAD~5:gitpy.py > /tmp/old_gitpy.py
+    python benchmark.py --gitpy /tmp/old_gitpy.py --output old.json
+    python benchmark.py --output new.json --compare old.json
+
+Benchmarks whose functions don't exist in the gitpy being measured (or that fail) are reported as skipped, so
+older revisions can still be run against the same suite. Revisions from before nested trees need --depth 0."""
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import contextlib
+import subprocess
+import http.server
+import importlib.util
+
+
+#Import gitpy.py from path as the module gitpy (so add's worker processes can find its functions)
+def load_gitpy(path):
+    spec = importlib.util.spec_from_file_location('gitpy', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['gitpy'] = module
+    spec.loader.exec_module(module)
+    return module
+
+#Return the git revision path is at (with a + if it has uncommitted changes), or None if it isn't in a git repo
+def get_revision(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory,
+                                  capture_output=True, check=True).stdout.decode().strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', os.path.abspath(path)], cwd=directory)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('+' if dirty.returncode else '')
+
+"""Synthetic repositories
+Files are spread evenly over a tree of directories, depth levels deep, with the fanout picked so each directory
+ends up with about as many files as subdirectories. Contents are lines of pseudo random text from a seeded
+generator, so every run with the same options builds exactly the same repository, and edits change a line
+or two like a real commit would (which keeps delta compression and diffs realistic)."""
+
+#Return list of count relative paths, depth directories deep
+def make_paths(count, depth):
+    fanout = max(2, round(count ** (1 / (depth + 1)))) if depth else 1
+    directories = fanout ** depth
+    paths = []
+    for n in range(count):
+        directory = n % directories
+        parts = ['d{}'.format((directory // fanout ** level) % fanout) for level in range(depth)]
+        paths.append('/'.join(parts + ['file{}.txt'.format(n)]))
+    return paths
+
+#Return about size bytes of text lines
+def make_content(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        line = 'line {} {:08x} {:08x}\n'.format(len(lines), rng.getrandbits(32), rng.getrandbits(32))
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()
+
+#Replace one line of the file at path with a new one
+def edit_file(rng, path):
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    n = rng.randrange(len(lines))
+    lines[n] = 'edited {:08x}'.format(rng.getrandbits(32)).encode()
+    with open(path, 'wb') as f:
+        f.write(b'\n'.join(lines))
+
+#Build a repository in directory repo (relative to the current directory) with one commit, followed by
+#commits - 1 more commits that each edit about 1% of the files, return list of its paths
+def generate_repo(gitpy, repo, files, depth, file_size, commits, seed=0):
+    rng = random.Random(seed)
+    gitpy.init(repo)
+    os.chdir(repo)
+    paths = make_paths(files, depth)
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(make_content(rng, file_size))
+    gitpy.add(paths)
+    gitpy.commit('commit 0', author='Bench Mark <bench@example.com>')
+    for n in range(1, commits):
+        changed = rng.sample(paths, max(1, len(paths) // 100))
+        for path in changed:
+            edit_file(rng, path)
+        gitpy.add(changed)
+        gitpy.commit('commit {}'.format(n), author='Bench Mark <bench@example.com>')
+    return paths
+
+"""The fake server
+Just enough of git-receive-pack over smart http for push: it advertises its refs (report-status, atomic and
+ofs-delta), reads the commands and the pack, checks the pack's trailing SHA-1 and object count, moves its
+refs and reports every command ok. Nothing gets unpacked, so the time measured is all the client's."""
+
+class FakeReceivePackHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def reply(self, content_type, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.path.endswith('/info/refs?service=git-receive-pack'):
+            self.reply('text/plain', b'not found', 404)
+            return
+        caps = b'report-status delete-refs atomic ofs-delta agent=gitpy-benchmark'
+        refs = sorted(self.server.refs.items()) or [('capabilities^{}', '0' * 40)]
+        lines = ['{} {}'.format(sha1, name).encode() for name, sha1 in refs]
+        lines[0] += b'\x00' + caps
+        gitpy = self.server.gitpy
+        body = gitpy.build_lines_data([b'# service=git-receive-pack']) + gitpy.build_lines_data(lines)
+        self.reply('application/x-git-receive-pack-advertisement', body)
+
+    def do_POST(self):
+        body = self.read_body()
+        commands = []
+        i = 0
+        while True:
+            size = int(body[i:i + 4], 16)
+            if size == 0:
+                i += 4
+                break
+            old, new, ref = body[i + 4:i + size].split(b'\x00')[0].decode().split()
+            commands.append((old, new, ref))
+            i += size
+        pack = body[i:]
+        if pack:
+            assert pack[:4] == b'PACK', 'bad pack signature'
+            assert hashlib.sha1(pack[:-20]).digest() == pack[-20:], 'bad pack checksum'
+            self.server.objects_received += int.from_bytes(pack[8:12], 'big')
+        self.server.bytes_received += len(body)
+        lines = [b'unpack ok']
+        for old, new, ref in commands:
+            self.server.refs[ref] = new
+            lines.append('ok {}'.format(ref).encode())
+        self.reply('application/x-git-receive-pack-result', self.server.gitpy.build_lines_data(lines))
+
+#Start a fake receive-pack server in a background thread, return it (its url is server.url)
+def start_server(gitpy):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeReceivePackHandler)
+    server.daemon_threads = True
+    server.gitpy = gitpy
+    server.refs = {}
+    server.bytes_received = 0
+    server.objects_received = 0
+    server.url = 'http://127.0.0.1:{}/bench.git'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+"""Running the benchmarks
+Each benchmark is a name, the gitpy functions it needs, an untimed setup (which returns the arguments for
+the timed part) and the timed part itself. Output from gitpy is swallowed while timing so it doesn't skew
+the results (or bury them)."""
+
+#Return list of (name, required gitpy functions, setup function, timed function or name of a gitpy function)
+#for the repository in the current directory
+def get_benchmarks(gitpy, paths, options, server):
+    rng = random.Random(1)
+    author = 'Bench Mark <bench@example.com>'
+    big_path = 'big-file.bin'
+
+    def no_setup():
+        return ()
+
+    def setup_big_file():
+        if not os.path.exists(big_path):
+            with open(big_path, 'wb') as f:
+                for _ in range(options.large_file_size // (1 << 20)):
+                    f.write(os.urandom(1 << 20))
+        return (big_path,)
+
+    def setup_fresh_add():
+        os.remove(os.path.join('.git', 'index'))
+        return (paths,)
+
+    def setup_edits():
+        changed = rng.sample(paths, max(1, len(paths) // 100))
+        for path in changed:
+            edit_file(rng, path)
+        return ()
+
+    def setup_edited_add():
+        setup_edits()
+        return (paths,)
+
+    def setup_cold_tree():
+        entries, extensions = gitpy.read_index_file()
+        extensions.pop(b'TREE', None)
+        gitpy.write_index(entries, extensions)
+        return ()
+
+    def setup_commit():
+        path = rng.choice(paths)
+        edit_file(rng, path)
+        gitpy.add([path])
+        return ('benchmark commit', author)
+
+    def setup_all_objects():
+        return (gitpy.find_commit_objects(gitpy.get_local_master_hash()),)
+
+    def setup_full_push():
+        server.refs.clear()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join('.git', 'reachable-cache'))
+        return (server.url, 'user', 'password')
+
+    def setup_one_commit_push():
+        server.refs['refs/heads/master'] = gitpy.get_local_master_hash()
+        setup_commit()
+        with contextlib.redirect_stdout(io.StringIO()):
+            gitpy.commit('benchmark commit', author)
+        return (server.url, 'user', 'password')
+
+    return [
+        ('hash_file', ['hash_file'], setup_big_file, 'hash_file'),
+        ('add (new index)', ['add'], setup_fresh_add, 'add'),
+        ('add (unchanged)', ['add'], lambda: (paths,), 'add'),
+        ('read_index', ['read_index'], no_setup, 'read_index'),
+        ('write_index', ['write_index'], lambda: (gitpy.read_index(),), 'write_index'),
+        ('status (clean)', ['get_status'], no_setup, 'get_status'),
+        ('status (1% edited)', ['get_status'], setup_edits, 'get_status'),
+        ('diff (working copy)', ['diff'], no_setup, 'diff'),
+        #this also adds the edits made for status and diff, so the benchmarks after it start from a clean working copy
+        ('add (1% edited)', ['add'], setup_edited_add, 'add'),
+        ('write_tree (cold)', ['write_tree', 'read_index_file'], setup_cold_tree, 'write_tree'),
+        ('write_tree (cached)', ['write_tree'], no_setup, 'write_tree'),
+        ('commit', ['commit'], setup_commit, 'commit'),
+        ('diff (two commits)', ['diff_commits'], lambda: ('master~1', 'master'), 'diff_commits'),
+        ('find_commit_objects', ['find_commit_objects'],
+            lambda: (gitpy.get_local_master_hash(),), 'find_commit_objects'),
+        ('create_pack', ['create_pack'], setup_all_objects, 'create_pack'),
+        ('create_pack (no deltas)', ['create_pack'], setup_all_objects,
+            lambda objects: gitpy.create_pack(objects, window=0)),
+        ('write_commit_graph', ['write_commit_graph'], no_setup, 'write_commit_graph'),
+        ('push (full)', ['push'], setup_full_push, 'push'),
+        ('push (one commit)', ['push'], setup_one_commit_push, 'push'),
+        ('repack -a', ['repack'], no_setup, lambda: gitpy.repack(all_packs=True)),
+        ('status (packed)', ['get_status'], no_setup, 'get_status'),
+    ]
+
+#Time run(*setup()) repeat times, return dict of results (times are in seconds)
+def run_benchmark(setup, run, repeat):
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            args = setup()
+            start = time.perf_counter()
+            run(*args)
+            times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'repeat': repeat}
+
+#Run every benchmark (or only the ones whose names contain one of only), return the results as a dict
+def run_benchmarks(options):
+    gitpy = load_gitpy(options.gitpy)
+    results = {
+        'gitpy': os.path.abspath(options.gitpy),
+        'revision': get_revision(options.gitpy),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': {'files': options.files, 'depth': options.depth, 'file_size': options.file_size,
+                    'commits': options.commits, 'large_file_size': options.large_file_size,
+                    'repeat': options.repeat, 'seed': options.seed},
+        'benchmarks': {},
+    }
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='gitpy-benchmark-', dir=options.directory)
+    server = start_server(gitpy)
+    try:
+        os.chdir(directory)
+        print('generating {} files, {} deep, {} bytes each, {} commits'.format(
+                options.files, options.depth, options.file_size, options.commits), file=sys.stderr)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            paths = generate_repo(gitpy, 'repo', options.files, options.depth, options.file_size,
+                                  options.commits, options.seed)
+        results['generate_seconds'] = time.perf_counter() - start
+        for name, needs, setup, run in get_benchmarks(gitpy, paths, options, server):
+            if options.only and not any(pattern in name for pattern in options.only):
+                continue
+            missing = [function for function in needs if not hasattr(gitpy, function)]
+            if missing:
+                result = {'skipped': 'gitpy has no {}'.format(', '.join(missing))}
+            else:
+                #an older gitpy may not handle everything the suite throws at it, note that and carry on
+                try:
+                    result = run_benchmark(setup, getattr(gitpy, run) if isinstance(run, str) else run, options.repeat)
+                except Exception as error:
+                    result = {'skipped': 'failed with {!r}'.format(error)}
+            results['benchmarks'][name] = result
+            print(format_result(name, result), file=sys.stderr)
+        results['push_bytes_received'] = server.bytes_received
+        results['push_objects_received'] = server.objects_received
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.chdir(cwd)
+        if options.keep:
+            print('left repository in {}'.format(directory), file=sys.stderr)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+#Return a line for one result, with how it compares to base (another result for the same benchmark) if given
+def format_result(name, result, base=None):
+    if 'skipped' in result:
+        return '{:<26} skipped ({})'.format(name, result['skipped'])
+    line = '{:<26} {:>10.4f}s  (median {:.4f}s of {})'.format(name, result['min'], result['median'], result['repeat'])
+    if base is not None and 'min' in base and base['min'] > 0:
+        if result['min'] > base['min']:
+            line += '  {:>6.2f}x slower'.format(result['min'] / base['min'])
+        else:
+            line += '  {:>6.2f}x faster'.format(base['min'] / result['min'])
+    return line
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time gitpy commands on a synthetic repository')
+    parser.add_argument('--gitpy', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gitpy.py'),
+                        help='gitpy.py to benchmark (default: the one next to this script)')
+    parser.add_argument('--files', type=int, default=2000, help='number of files in the repository (default 2000)')
+    parser.add_argument('--depth', type=int, default=3, help='how many directories deep files are (default 3)')
+    parser.add_argument('--file-size', type=int, default=2048, help='bytes in each file (default 2048)')
+    parser.add_argument('--commits', type=int, default=10, help='length of the history (default 10)')
+    parser.add_argument('--large-file-size', type=int, default=64 << 20,
+                        help='bytes in the file hash_file is timed on (default 64MB)')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each benchmark (default 3)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating the repository')
+    parser.add_argument('--only', nargs='+', metavar='name', help='only run benchmarks whose names contain one of these')
+    parser.add_argument('--directory', help='where to build the repository (default: the system temp directory)')
+    parser.add_argument('--keep', action='store_true', help="don't delete the repository afterwards")
+    parser.add_argument('--output', help='write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--compare', metavar='results.json', help='compare against results saved with --output')
+    options = parser.parse_args()
+
+    results = run_benchmarks(options)
+    if options.compare:
+        with open(options.compare) as f:
+            base = json.load(f)
+        print('compared with {} ({})'.format(base.get('revision') or base.get('gitpy'), options.compare), file=sys.stderr)
+        for name, result in results['benchmarks'].items():
+            print(format_result(name, result, base['benchmarks'].get(name)), file=sys.stderr)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -13,15 +13,53 @@ import struct
 import operator
 #for our cat-file utility function
 import sys
-#Used to check differences between file copies
-import difflib
 #Used for commits
 import time
 #Used for talking with git servers
 import urllib.request
+import urllib.parse
+import urllib.error
+import http.client
+import ssl
+import base64
+import io
 import stat
+#used for reading pack files without loading them into memory
+import mmap
 #needed to handle commands
 import argparse
+#used for chaining the push request together with the streamed pack
+import itertools
+#used to make the object cache safe to share between threads
+import threading
+#used for walking commits newest first and merging sorted hash lists
+import heapq
+#used for hashing files in parallel when adding
+import concurrent.futures
+#used for expanding patterns given to add
+import glob
+#used for storing the index as compact columns
+import array
+#used for finding the longest run of unique lines two files have in common when diffing
+import bisect
+#used for matching .gitignore patterns
+import re
+#used for the temp file a streamed object is written to before we know its name
+import tempfile
+#used for the filesystem monitor (inotify through libc, a unix socket to talk to it, and running monitor hooks)
+import ctypes
+import ctypes.util
+import socket
+import select
+import subprocess
+#used for tracing (wrapping functions so they keep their names, and writing the trace out when we exit)
+import functools
+import atexit
+import json
+#used for making a repository current for the length of a with block
+import contextlib
+#used for pushing to many remotes at the same time
+import asyncio
 
 """
 Goal is to be able to create, add, commit, and push to a server (github) by the end of the week.
@@ -40,6 +78,50 @@ def read_file(path):
     with open(path, "rb") as f:
         return f.read()
 
+"""Which repository?
+At first everything here worked on the repository in the current directory, which is fine for a command line
+tool, but a program serving lots of repositories has to chdir for each request and can't work on two of them
+at once from different threads. So nothing below uses the current directory directly: paths inside .git come
+from git_path, paths in the working copy come from work_path, and what used to be global caches (open packs,
+the commit-graph, the object cache) live on a Repository object (see the end of the file).
+
+The module functions work on the calling thread's current repository. That's the one a Repository method (or
+"with repository.activate():") made current, or otherwise the one in the current directory, so the functions
+and the command line still work just like they always have."""
+
+_thread_state = threading.local()
+#(current directory, Repository) for threads that haven't made a repository current
+_default_repository = None
+
+#Return the Repository the calling thread is working on
+def get_repository():
+    repository = getattr(_thread_state, 'repository', None)
+    if repository is not None:
+        return repository
+    global _default_repository
+    cwd = os.getcwd()
+    default = _default_repository
+    if default is None or default[0] != cwd:
+        default = _default_repository = (cwd, Repository(''))
+    return default[1]
+
+#Make repository the calling thread's current one (None goes back to the current directory's)
+#(also used to start worker threads off on the right repository)
+def set_thread_repository(repository):
+    _thread_state.repository = repository
+
+#Return the path of parts (ex: 'objects', 'pack') inside the current repository's .git directory
+def git_path(*parts):
+    return os.path.join(get_repository().git_dir, *parts)
+
+#Return where path (relative to the top of the working copy) is on disk for the current repository
+def work_path(path):
+    return os.path.join(get_repository().path, path)
+
+#Return a name for a temp file that no other process or thread will pick at the same time
+def unique_suffix():
+    return '{}-{}'.format(os.getpid(), threading.get_ident())
+
 #I LOVE WINDOWS!!!!!
 def u32(x):
     return int(x) & 0xFFFFFFFF
@@ -95,51 +177,236 @@ class ObjectType(enum.Enum):
     commit = 1
     tree = 2
     blob = 3
+    tag = 4
 
 #Hash an object of a given type then write to store (if write True), return the hash
 def hash_object(data, object_type, write=True):
     #Create the header with object type and size of the data
     header = '{} {}'.format(object_type, len(data)).encode()
-    #add the null bit and then the data
-    full_data = header + b'\x00' + data
-    sha1 = hashlib.sha1(full_data).hexdigest()
+    #add the null bit and then the data (fed in separately, so we never build a second copy of data)
+    sha1 = hashlib.sha1(header + b'\x00')
+    sha1.update(data)
+    sha1 = sha1.hexdigest()
     #If True, write data to store
     if write:
-        path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
+        path = loose_object_path(sha1)
         if not os.path.exists(path):
             os.makedirs(os.path.dirname(path), exist_ok=True)
-            write_file(path, zlib.compress(full_data))
+            #write to a temp file and rename it into place, so anyone hashing the same content
+            #at the same time (add's worker processes, say) never sees a half written object
+            tmp_path = '{}.tmp{}'.format(path, unique_suffix())
+            compressor = zlib.compressobj()
+            with open(tmp_path, 'wb') as f:
+                f.write(compressor.compress(header + b'\x00'))
+                f.write(compressor.compress(data))
+                f.write(compressor.flush())
+            os.replace(tmp_path, path)
+    return sha1
+
+"""hash_object needs the whole file in memory, and zlib.compress makes another copy, so adding a 4GB file
+would need several GB of memory. hash_file streams the file instead: it reads it a chunk at a time into one
+reusable buffer, feeding each chunk to both the hash and the compressor, and writes the compressed output to a
+temp file in .git/objects. We only know the object's name at the end, so that's when the temp file gets renamed
+into place. Memory use is the same whatever the size of the file."""
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+#Hash the file at path as an object of the given type then write to store (if write True), return the hash
+def hash_file(path, object_type='blob', write=True):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        header = '{} {}\x00'.format(object_type, size).encode()
+        sha1 = hashlib.sha1(header)
+        tmp = None
+        if write:
+            fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=git_path('objects'))
+            tmp = os.fdopen(fd, 'wb')
+            compressor = zlib.compressobj()
+            tmp.write(compressor.compress(header))
+        try:
+            buffer = bytearray(min(HASH_CHUNK_SIZE, max(size, 1)))
+            view = memoryview(buffer)
+            total = 0
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                total += n
+                sha1.update(view[:n])
+                if tmp is not None:
+                    tmp.write(compressor.compress(view[:n]))
+            if total != size:
+                raise ValueError('{} changed size while it was being hashed'.format(path))
+            sha1 = sha1.hexdigest()
+            if tmp is not None:
+                tmp.write(compressor.flush())
+                tmp.close()
+                object_path = loose_object_path(sha1)
+                if os.path.exists(object_path):
+                    os.remove(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    os.replace(tmp_path, object_path)
+        except BaseException:
+            if tmp is not None:
+                tmp.close()
+                os.remove(tmp_path)
+            raise
     return sha1
 
 """Note that from the above function we can write find and read object functions:
 finding obviously just requires searching for the hash prefix and the rest of the hash, and we know how the header
-is organized so we just find the object and read out it's type and size."""
+is organized so we just find the object and read out it's type and size.
+
+Objects don't have to be loose files though, they can also live in a pack file under .git/objects/pack
+(see the pack file section further down), so both of these check the packs too."""
 
-#Find object with sha-1 prefix and return path to object or raise value error (if no or multiple objects have same prefix)
+#Return path of the loose object file for a full sha1 (whether or not it exists)
+def loose_object_path(sha1):
+    return git_path('objects', sha1[:2], sha1[2:])
+
+#Find object with sha-1 prefix and return its full sha-1 or raise value error (if no or multiple objects have same prefix)
 def find_object(sha1_prefix):
     if len(sha1_prefix) < 2:
         raise ValueError('Hash prefix must be 2 or more characters')
+    #anything that isn't hex (like a ref name that didn't match) can't be an object
+    if not re.fullmatch('[0-9a-fA-F]+', sha1_prefix):
+        raise ValueError('object {!r} not found'.format(sha1_prefix))
+    sha1_prefix = sha1_prefix.lower()
+    if len(sha1_prefix) == 40:
+        #a full hash doesn't need a directory listing, it's either there or it isn't
+        if os.path.exists(loose_object_path(sha1_prefix)) or find_packed_object(sha1_prefix):
+            return sha1_prefix
+        raise ValueError('object {!r} not found'.format(sha1_prefix))
     #remember the layout is .git/objects/first 2 characters of sha1/rest of sha1
-    obj_dir = os.path.join('.git', 'objects', sha1_prefix[:2])
+    obj_dir = git_path('objects', sha1_prefix[:2])
     rest = sha1_prefix[2:]
-    objects = [name for name in os.listdir(obj_dir) if name.startswith(rest)]
+    try:
+        objects = {sha1_prefix[:2] + name for name in os.listdir(obj_dir) if name.startswith(rest)}
+    except FileNotFoundError:
+        objects = set()
+    for pack in get_packs():
+        objects.update(pack.index.find_prefix(sha1_prefix))
     if not objects:
         raise ValueError('object {!r} not found'.format(sha1_prefix))
     if len(objects) >= 2:
         raise ValueError('Multiple objects ({}) with prefix {!r}'.format(len(objects), sha1_prefix))
-    return os.path.join(obj_dir, objects[0])
+    return objects.pop()
+
+"""Walking history reads the same commits and trees over and over, and every read means finding the object
+and inflating it again. So read_object can keep recently used objects in an LRU cache. It's bounded by the
+total size of the cached data (one big blob would make a count limit meaningless), it's off unless you turn it
+on with enable_object_cache (or by setting GITPY_OBJECT_CACHE to a size in bytes), and a lock makes it safe
+to share between threads."""
+
+#LRU cache of sha1 -> (object_type, data_bytes), bounded by the total bytes of data held
+class ObjectCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    #Return cached (object_type, data_bytes) for sha1, or None
+    def get(self, sha1):
+        with self.lock:
+            value = self.entries.get(sha1)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(sha1)
+            self.hits += 1
+            return value
+
+    #Cache (object_type, data_bytes) for sha1, evicting least recently used objects to make room
+    def put(self, sha1, value):
+        size = len(value[1])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if sha1 in self.entries:
+                self.entries.move_to_end(sha1)
+                return
+            self.entries[sha1] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    #Return dict of hits, misses, evictions, number of objects and bytes currently cached
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'objects': len(self.entries), 'bytes': self.size}
+
+#Turn on the current repository's object cache with room for max_bytes of object data (0 or None turns it off),
+#return the cache
+def enable_object_cache(max_bytes=64 * 1024 * 1024):
+    repository = get_repository()
+    repository.object_cache = ObjectCache(max_bytes) if max_bytes else None
+    return repository.object_cache
 
 #Read object with given sha1 prefix and return a tuple of object_type, data_bytes
 def read_object(sha1_prefix):
-    path = find_object(sha1_prefix)
-    full_data = zlib.decompress(read_file(path))
-    nul_index = full_data.index(b'\x00')
-    header = full_data[:nul_index]
-    obj_type, size_str = header.decode().split()
-    size = int(size_str)
-    data = full_data[nul_index + 1:]
-    assert size == len(data), 'expected size {}, got {} bytes'.format(size, len(data))
-    return (obj_type, data)
+    if len(sha1_prefix) == 40:
+        sha1 = sha1_prefix.lower()
+    else:
+        sha1 = find_object(sha1_prefix)
+    cache = get_repository().object_cache
+    if cache is not None:
+        cached = cache.get(sha1)
+        if cached is not None:
+            return cached
+    try:
+        full_data = zlib.decompress(read_file(loose_object_path(sha1)))
+    except FileNotFoundError:
+        found = find_packed_object(sha1)
+        if found is None:
+            raise ValueError('object {!r} not found'.format(sha1_prefix))
+        pack, offset = found
+        result = pack.read_object(offset)
+    else:
+        nul_index = full_data.index(b'\x00')
+        header = full_data[:nul_index]
+        obj_type, size_str = header.decode().split()
+        size = int(size_str)
+        data = full_data[nul_index + 1:]
+        assert size == len(data), 'expected size {}, got {} bytes'.format(size, len(data))
+        result = (obj_type, data)
+    if cache is not None:
+        cache.put(sha1, result)
+    return result
+
+#Read just the header of object with given full sha1, return a tuple of object_type, size
+#(much cheaper than read_object when all we need is the size, only the first few bytes get inflated)
+def read_object_header(sha1):
+    try:
+        f = open(loose_object_path(sha1), 'rb')
+    except FileNotFoundError:
+        found = find_packed_object(sha1)
+        if found is None:
+            raise ValueError('object {!r} not found'.format(sha1))
+        pack, offset = found
+        return pack.read_header(offset)
+    with f:
+        d = zlib.decompressobj()
+        header = b''
+        while b'\x00' not in header:
+            chunk = f.read(256)
+            if not chunk:
+                raise ValueError('object {!r} has a truncated header'.format(sha1))
+            header += d.decompress(chunk)
+    obj_type, size_str = header[:header.index(b'\x00')].decode().split()
+    return (obj_type, int(size_str))
 
 """
 Write contents of object with sha1 prefix to stdout.
@@ -165,9 +432,9 @@ def cat_file(mode, sha1_prefix):
         if obj_type in ['commit', 'blob']:
             sys.stdout.buffer.write(data)
         elif obj_type == 'tree':
-            for mode, path, sha1 in read_tree(data=data):
+            for mode, path, digest in read_tree(data=data):
                 type_str = 'tree' if stat.S_ISDIR(mode) else 'blob'
-                print('{:06o} {} {}\t{}'.format(mode, type_str, sha1, path))
+                print('{:06o} {} {}\t{}'.format(mode, type_str, digest.hex(), path))
         else:
             assert False, 'Unahdled object type {!r}'.format(obj_type)
     else:
@@ -205,12 +472,182 @@ IndexEntry = collections.namedtuple('IndexEntry', [
     'uid', 'gid', 'size', 'sha1', 'flags', 'path',
 ])
 
-#Read index file and return list of IndexEntry objects
-def read_index():
-    try:
-        data = read_file(os.path.join('.git', 'index'))
-    except FileNotFoundError:
-        return []
+"""A list of IndexEntry tuples costs several hundred bytes per file (a tuple, a dozen int objects, a bytes and
+a str), so with a few hundred thousand files just loading the index takes seconds. IndexEntries keeps the same
+data as columns instead: the ten stat fields in one array of unsigned ints, the sha1s back to back in one
+bytearray, the flags in an array of shorts and the paths as one utf-8 blob with an array of offsets into it.
+That's under 100 bytes per file plus the path, and loading is mostly copying slices of the index file.
+
+Indexing it (entries[i], or iterating) builds IndexEntry tuples on demand, so code that just wants to look
+at entries doesn't care. Since the index is sorted by path, finding a path is a binary search over the blob."""
+
+#number of stat fields (ctime_s through size) stored per entry
+INDEX_STAT_FIELDS = 10
+
+class IndexEntries:
+    def __init__(self):
+        self.stats = array.array('I')
+        self.sha1s = bytearray()
+        self.flags = array.array('H')
+        self.paths = bytearray()
+        #entry i's path is paths[path_offsets[i]:path_offsets[i + 1]]
+        self.path_offsets = array.array('I', [0])
+
+    #Build from an iterable of IndexEntry objects (which should already be sorted by path)
+    @classmethod
+    def from_entries(cls, entries):
+        if isinstance(entries, cls):
+            return entries
+        result = cls()
+        for entry in entries:
+            result.append(entry)
+        return result
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('index entry out of range')
+        stats = self.stats[i * INDEX_STAT_FIELDS:(i + 1) * INDEX_STAT_FIELDS]
+        return IndexEntry(*stats, self.sha1(i), self.flags[i], self.path(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    #Return path of entry i as utf-8 bytes
+    def path_bytes(self, i):
+        return bytes(self.paths[self.path_offsets[i]:self.path_offsets[i + 1]])
+
+    #Return path of entry i, decoded only when asked for
+    def path(self, i):
+        return self.path_bytes(i).decode()
+
+    #Return iterator over all the paths, in order
+    def iter_paths(self):
+        paths = self.paths.decode()
+        offsets = self.path_offsets
+        #paths are mostly ascii, where byte offsets and str offsets agree and we can slice the decoded str
+        if len(paths) == len(self.paths):
+            return (paths[offsets[i]:offsets[i + 1]] for i in range(len(self)))
+        return (self.path(i) for i in range(len(self)))
+
+    #Return (binary) sha1 of entry i
+    def sha1(self, i):
+        return bytes(self.sha1s[i * 20:(i + 1) * 20])
+
+    #Return mode of entry i
+    def mode(self, i):
+        return self.stats[i * INDEX_STAT_FIELDS + 6]
+
+    #Return index of the first entry whose path is >= path, searching entries lo to hi
+    def bisect_left(self, path, lo=0, hi=None):
+        if isinstance(path, str):
+            path = path.encode()
+        if hi is None:
+            hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path_bytes(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    #Return index of the entry with the given path, or -1 if there isn't one
+    def find(self, path):
+        if isinstance(path, str):
+            path = path.encode()
+        i = self.bisect_left(path)
+        if i < len(self) and self.path_bytes(i) == path:
+            return i
+        return -1
+
+    #Return IndexEntry for path, or default if it's not in the index
+    def get(self, path, default=None):
+        i = self.find(path)
+        return self[i] if i >= 0 else default
+
+    #Add an IndexEntry to the end
+    def append(self, entry):
+        self.stats.extend(u32(value) for value in entry[:INDEX_STAT_FIELDS])
+        self.sha1s += entry.sha1
+        self.flags.append(entry.flags)
+        self.paths += entry.path.encode()
+        self.path_offsets.append(len(self.paths))
+
+    #Copy entries start to end of another IndexEntries onto the end of this one, without building tuples
+    def extend_from(self, other, start=0, end=None):
+        if end is None:
+            end = len(other)
+        if start >= end:
+            return
+        self.stats += other.stats[start * INDEX_STAT_FIELDS:end * INDEX_STAT_FIELDS]
+        self.sha1s += other.sha1s[start * 20:end * 20]
+        self.flags += other.flags[start:end]
+        shift = len(self.paths) - other.path_offsets[start]
+        self.paths += other.paths[other.path_offsets[start]:other.path_offsets[end]]
+        self.path_offsets.extend(offset + shift for offset in other.path_offsets[start + 1:end + 1])
+
+    #Replace entry i with an IndexEntry that has the same path
+    def set(self, i, entry):
+        assert entry.path == self.path(i), 'can only replace an entry with one for the same path'
+        self.stats[i * INDEX_STAT_FIELDS:(i + 1) * INDEX_STAT_FIELDS] = \
+            array.array('I', (u32(value) for value in entry[:INDEX_STAT_FIELDS]))
+        self.sha1s[i * 20:(i + 1) * 20] = entry.sha1
+        self.flags[i] = entry.flags
+
+    #Return True if entry i here and entry j of other are identical
+    def same(self, i, other, j):
+        return (self.flags[i] == other.flags[j] and
+                self.sha1s[i * 20:(i + 1) * 20] == other.sha1s[j * 20:(j + 1) * 20] and
+                self.stats[i * INDEX_STAT_FIELDS:(i + 1) * INDEX_STAT_FIELDS] ==
+                other.stats[j * INDEX_STAT_FIELDS:(j + 1) * INDEX_STAT_FIELDS] and
+                self.path_bytes(i) == other.path_bytes(j))
+
+    #Return a new IndexEntries with a sorted list of IndexEntry objects merged in (replacing entries with the same path)
+    def merge(self, entries):
+        result = IndexEntries()
+        start = 0
+        for entry in entries:
+            i = self.bisect_left(entry.path, start)
+            result.extend_from(self, start, i)
+            result.append(entry)
+            start = i + 1 if i < len(self) and self.path(i) == entry.path else i
+        result.extend_from(self, start)
+        return result
+
+    #Return the columns as big-endian bytes (the byte order in the index file): (stats, flags)
+    def big_endian_columns(self):
+        stats = array.array('I', self.stats)
+        flags = array.array('H', self.flags)
+        if sys.byteorder == 'little':
+            stats.byteswap()
+            flags.byteswap()
+        return stats.tobytes(), flags.tobytes()
+
+"""Big repos make for big indexes, and every add (or status refresh) rewrites the whole thing. Like real git
+we have two ways to cut that down:
+
+Index version 4 drops the NUL padding and stores each path as the number of bytes to chop off the end of the
+previous entry's path (a varint, the same encoding as an OFS_DELTA offset) followed by the new suffix and a NUL.
+The index is sorted, so neighbouring paths share long prefixes and deep trees shrink a lot.
+
+A split index keeps most of the entries in a shared index (.git/sharedindex.<sha1 of that file>) that is written
+once, while .git/index only holds what changed since: a "link" extension with the shared index's sha1 and two
+EWAH compressed bitmaps (which shared entries are deleted, which are replaced), then the replacement entries
+in bitmap order (with empty paths, they keep the shared entry's path) and then any new entries. Once the
+changes grow past SPLIT_INDEX_MAX_PERCENT of the shared index we write a fresh shared index and start over."""
+
+SPLIT_INDEX_MAX_PERCENT = 20
+
+#Parse a whole index file, return a tuple of (version, IndexEntries, dict of extension signature -> data)
+def parse_index(data):
     #remember the last 20 bytes are a checksum of the rest of the index's contents
     #so check the hash of the everything but the last 20 bytes of the file,
     #if that matches the last 20 bytes of the file, the index is valid.
@@ -221,38 +658,189 @@ def read_index():
     #4s indicates a 4 byte string (should always be b'DIRC')
     #L represents a 4 byte unsigned integer
     #So !4sLL means the struct we're unpacking uses big-endian order, first you'll unpack a 4
-    #byte string into signature, then a 4-byte int into version (should always be 2 currently), then one more into num_entries
+    #byte string into signature, then a 4-byte int into version (2, 3 or 4), then one more into num_entries
     #out of the first 12 bytes of data.
     signature, version, num_entries = struct.unpack('!4sLL', data[:12])
     assert signature == b'DIRC', \
     'invalid index signature {}'.format(signature)
-    assert version == 2, 'unknown index version {}'.format(version)
-    #our index entries is everything between the header and last 20 bytes
-    entry_data = data[12:-20]
-    entries = []
-    #i = current length of all entries before the current one
-    #so the second entries fields' end can be found at i = len(entry_1) + 62
-    i = 0
-    #ensure we don't run past the entry_data len when unpacking
-    while i + 62 < len(entry_data):
+    assert version in (2, 3, 4), 'unknown index version {}'.format(version)
+    #our index entries is everything between the header and last 20 bytes (and any extensions)
+    end = len(data) - 20
+    view = memoryview(data)
+    entries = IndexEntries()
+    stats = bytearray()
+    flags = bytearray()
+    #i = offset of the current entry, the first one starts right after the header
+    i = 12
+    previous_path = b''
+    #read exactly num_entries entries, whatever's left after them is extensions
+    for _ in range(num_entries):
         #our fields are 62 bytes total
         #10 4 byte ints, a 20 length string, and a 2 byte char
+        #rather than unpacking each one we copy them into their columns still big-endian, and swap them all at the end
         fields_end = i + 62
-        #remember our tuple is current 10 ints, the 20 length sha1 hash
-        #H is 2-byte unsigned short, which in this case represents the flags field
-        fields = struct.unpack('!LLLLLLLLLL20sH', entry_data[i:fields_end])
-        #since our path can be of an arbitrary length
-        #we'll search for the NUL byte which signifies the end of the path
-        #then we can just store the path as entry_data[fields_end:path_end]
-        path_end = entry_data.index(b'\x00', fields_end)
-        path = entry_data[fields_end:path_end]
-        entry = IndexEntry(*(fields + (path.decode(),)))
-        entries.append(entry)
-        entry_len = ((62 + len(path) + 8) // 8) * 8
-        i += entry_len
-    assert len(entries) == num_entries
+        stats += view[i:i + 40]
+        entries.sha1s += view[i + 40:i + 60]
+        if version >= 3 and data[i + 60] & 0x40:
+            #version 3 adds 16 bits of extended flags (skip-worktree, intent-to-add) which we don't use
+            fields_end += 2
+            flags += bytes([data[i + 60] & ~0x40 & 0xFF, data[i + 61]])
+        else:
+            flags += view[i + 60:i + 62]
+        if version == 4:
+            strip, path_start = decode_ofs_delta_offset(data, fields_end)
+            path_end = data.index(b'\x00', path_start)
+            path = previous_path[:len(previous_path) - strip] + data[path_start:path_end]
+            previous_path = path
+            entries.paths += path
+            i = path_end + 1
+        else:
+            #since our path can be of an arbitrary length
+            #we'll search for the NUL byte which signifies the end of the path
+            #then we can just store the path as data[fields_end:path_end]
+            path_end = data.index(b'\x00', fields_end)
+            entries.paths += view[fields_end:path_end]
+            #entries are padded with 1-8 NULs to a multiple of 8 bytes
+            i += ((path_end - i + 8) // 8) * 8
+        entries.path_offsets.append(len(entries.paths))
+    entries.stats.frombytes(stats)
+    entries.flags.frombytes(flags)
+    if sys.byteorder == 'little':
+        entries.stats.byteswap()
+        entries.flags.byteswap()
+    #each extension is a 4 byte signature, a 4 byte size, then that many bytes of data
+    extensions = {}
+    while i + 8 <= end:
+        ext_signature, ext_size = struct.unpack('!4sL', data[i:i + 8])
+        extensions[ext_signature] = data[i + 8:i + 8 + ext_size]
+        i += 8 + ext_size
+    return version, entries, extensions
+
+#Read index file and return a tuple of (IndexEntries, dict of extension signature -> data)
+#for a split index the entries are the merged result, and the link extension is kept so write_index splits again
+def read_index_file():
+    try:
+        data = read_file(git_path('index'))
+    except FileNotFoundError:
+        return IndexEntries(), {}
+    version, entries, extensions = parse_index(data)
+    if b'link' in extensions:
+        entries = merge_split_index(entries, extensions[b'link'])
+    return entries, extensions
+
+#Read the shared index with the given hex sha1, return its IndexEntries (None if it's missing)
+def read_shared_index(sha1):
+    repository = get_repository()
+    path = git_path('sharedindex.' + sha1)
+    cached = repository.shared_index_cache
+    if cached is not None and cached[0] == path:
+        return cached[1]
+    try:
+        data = read_file(path)
+    except FileNotFoundError:
+        return None
+    assert data[-20:].hex() == sha1, 'shared index {} has the wrong checksum'.format(sha1)
+    entries = parse_index(data)[1]
+    repository.shared_index_cache = (path, entries)
     return entries
-    
+
+#Read an EWAH compressed bitmap from data at offset, return tuple of (set of bit positions that are set, new offset)
+def read_ewah(data, offset):
+    bit_size, word_count = struct.unpack('!LL', data[offset:offset + 8])
+    words = struct.unpack('!{}Q'.format(word_count), data[offset + 8:offset + 8 + word_count * 8])
+    #skip the position of the last run length word, that's only needed to append to the bitmap
+    offset += 8 + word_count * 8 + 4
+    bits = set()
+    position = 0
+    i = 0
+    while i < len(words):
+        #a run length word: bit 0 is the repeated bit, the next 32 bits are how many 64 bit words of it,
+        #and the top 31 bits are how many literal words follow
+        word = words[i]
+        run_length = (word >> 1) & 0xFFFFFFFF
+        literal_count = word >> 33
+        if word & 1:
+            bits.update(range(position, position + run_length * 64))
+        position += run_length * 64
+        for literal in words[i + 1:i + 1 + literal_count]:
+            bits.update(position + bit for bit in range(64) if (literal >> bit) & 1)
+            position += 64
+        i += 1 + literal_count
+    return {bit for bit in bits if bit < bit_size}, offset
+
+#Encode a set of bit positions (all less than bit_size) as an EWAH compressed bitmap, return the bytes
+def write_ewah(bits, bit_size):
+    literals = [0] * ((bit_size + 63) // 64)
+    for bit in bits:
+        literals[bit // 64] |= 1 << (bit % 64)
+    words = []
+    last_run_word = 0
+    i = 0
+    #runs of empty words get squashed into a run length word, everything else is written as a literal
+    while i < len(literals) or not words:
+        run_length = 0
+        while i < len(literals) and literals[i] == 0 and run_length < 0xFFFFFFFF:
+            run_length += 1
+            i += 1
+        start = i
+        while i < len(literals) and literals[i] != 0 and i - start < 0x7FFFFFFF:
+            i += 1
+        last_run_word = len(words)
+        words.append((run_length << 1) | ((i - start) << 33))
+        words.extend(literals[start:i])
+    return struct.pack('!LL{}QL'.format(len(words)), bit_size, len(words), *(words + [last_run_word]))
+
+#Apply a split index's entries and link extension to its shared index, return the merged IndexEntries
+def merge_split_index(entries, link):
+    shared_sha1 = link[:20].hex()
+    if shared_sha1 == '0' * 40:
+        return entries
+    shared_entries = read_shared_index(shared_sha1)
+    assert shared_entries is not None, 'shared index {} is missing'.format(shared_sha1)
+    #the bitmaps can be left off when nothing in the shared index was deleted or replaced
+    deleted = replaced = set()
+    if len(link) > 20:
+        deleted, offset = read_ewah(link, 20)
+        replaced, offset = read_ewah(link, offset)
+    #replacements come first in bitmap order, whatever's after them is new
+    replacements = {}
+    for n, i in enumerate(sorted(replaced)):
+        #replacements are stored without a path, they take the path (and its length in flags) of what they replace
+        entry = entries[n]
+        shared_flags = shared_entries.flags[i]
+        replacements[i] = entry._replace(path=shared_entries.path(i),
+                                         flags=(entry.flags & ~0xFFF) | (shared_flags & 0xFFF))
+    added = sorted(entries[len(replaced):], key=operator.attrgetter('path'))
+    if not deleted and not replaced:
+        return shared_entries.merge(added)
+    merged = IndexEntries()
+    start = 0
+    for i in sorted(deleted | replaced):
+        merged.extend_from(shared_entries, start, i)
+        if i in replacements and i not in deleted:
+            merged.append(replacements[i])
+        start = i + 1
+    merged.extend_from(shared_entries, start)
+    return merged.merge(added)
+
+#Return the index version write_index should use: GIT_INDEX_VERSION if it's set, otherwise the current index's
+#version (2 for a new index, and version 3 is written back as 2 since we don't keep extended flags)
+def get_index_version():
+    if os.environ.get('GIT_INDEX_VERSION'):
+        version = int(os.environ['GIT_INDEX_VERSION'])
+    else:
+        try:
+            with open(git_path('index'), 'rb') as f:
+                header = f.read(12)
+            version = struct.unpack('!4sLL', header)[1] if len(header) == 12 else 2
+        except FileNotFoundError:
+            version = 2
+    return 4 if version == 4 else 2
+
+#Read index file and return its IndexEntries (which act like a list of IndexEntry objects)
+def read_index():
+    return read_index_file()[0]
+
 #Prints list of files in the index (mode, sha1, and stage number if "details" true)
 def ls_files(details=False):
     for entry in read_index():
@@ -262,24 +850,520 @@ def ls_files(details=False):
         else:
             print(entry.path)
 
-#Get status of a working copy, return (changed_paths, new_paths, deleted_paths)
-def get_status():
+"""Checking every file's content on every status is slow, so like real git we lean on the stat
+data add() stored in each IndexEntry. If a file's mtime, ctime, size, inode, dev and mode all
+still match its entry, the contents haven't changed and we don't need to re-hash it.
+
+The catch is "racy git": a file modified in the same timestamp tick the index was written in
+can look clean even though it isn't. So any entry whose mtime isn't strictly older than the
+index file's own mtime gets re-hashed regardless."""
+
+#Return True if the stat result for a file still matches what's recorded in the IndexEntry
+def stat_matches(entry, st):
+    return (entry.mtime_s == u32(st.st_mtime_ns // 1000000000) and
+            entry.mtime_n == u32(st.st_mtime_ns % 1000000000) and
+            entry.ctime_s == u32(st.st_ctime_ns // 1000000000) and
+            entry.ctime_n == u32(st.st_ctime_ns % 1000000000) and
+            entry.size == u32(st.st_size) and
+            entry.ino == u32(st.st_ino) and
+            entry.dev == u32(st.st_dev) and
+            entry.mode == u32(st.st_mode))
+
+#Return True if entry was modified too close to when the index was written to trust its stat data
+def is_racy(entry, index_mtime_ns):
+    if index_mtime_ns is None:
+        return True
+    entry_mtime_ns = entry.mtime_s * 1000000000 + entry.mtime_n
+    return entry_mtime_ns >= index_mtime_ns
+
+#Return mtime of the index file in nanoseconds, or None if there is no index yet
+def get_index_mtime_ns():
+    try:
+        return os.stat(git_path('index')).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+"""Finding untracked files means listing every directory in the working copy, and big checkouts are mostly
+directories nobody cares about (node_modules, build output, virtualenvs). So like git we read .gitignore files
+(and .git/info/exclude) and never go into a directory they ignore.
+
+Each .gitignore is compiled once: its patterns are turned into regexes over the path relative to the
+.gitignore's directory, and runs of patterns with the same effect (ignore or re-include, any path or
+directories only) are joined into a single regex. The last matching pattern wins, so we check the runs from the
+bottom up, and deeper .gitignores before shallower ones (with info/exclude last).
+
+Listing a directory is mostly waiting on the filesystem, which releases the GIL, so directories get listed by
+a pool of threads, and os.scandir tells us which entries are directories without a stat call for each."""
+
+#Translate a gitignore pattern (without its leading ! or trailing /) into a regex for the path relative to
+#the directory of the .gitignore it came from
+def translate_ignore_pattern(pattern):
+    #a slash anywhere but the end means it's relative to the .gitignore's directory, otherwise it matches at any depth
+    anchored = '/' in pattern
+    if pattern.startswith('/'):
+        pattern = pattern[1:]
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            parts.append('/.*')
+            i += 3
+        elif c == '*':
+            if pattern.startswith('**', i):
+                parts.append('.*')
+                i += 2
+            else:
+                parts.append('[^/]*')
+                i += 1
+        elif c == '?':
+            parts.append('[^/]')
+            i += 1
+        elif c == '[' and pattern.find(']', i + 2) >= 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            parts.append('[' + chars.replace('[', '\\[') + ']')
+            i = end + 1
+        elif c == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(c))
+            i += 1
+    regex = ''.join(parts)
+    return regex if anchored else '(?:.*/)?' + regex
+
+#Parse the contents of a .gitignore, return list of (compiled regex, negate, directories only) groups in file order
+def parse_ignore_file(data):
+    patterns = []
+    for line in data.decode(errors='surrogateescape').splitlines():
+        if not line or line.startswith('#'):
+            continue
+        #trailing spaces don't count unless they're escaped
+        while line.endswith(' ') and not line.endswith('\\ '):
+            line = line[:-1]
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line:
+            patterns.append((translate_ignore_pattern(line), negate, dir_only))
+    groups = []
+    for (negate, dir_only), run in itertools.groupby(patterns, key=lambda p: (p[1], p[2])):
+        regex = re.compile('(?:{})\\Z'.format('|'.join(pattern for pattern, _, _ in run)), re.DOTALL)
+        groups.append((regex, negate, dir_only))
+    return groups
+
+class IgnoreRules:
+    def __init__(self):
+        #rules are lists of (directory, groups) from lowest to highest precedence
+        self.root_rules = []
+        try:
+            groups = parse_ignore_file(read_file(git_path('info', 'exclude')))
+            if groups:
+                self.root_rules.append(('', groups))
+        except FileNotFoundError:
+            pass
+        self.cache = {}
+
+    #Return rules with the .gitignore in directory (relative to the working copy, '' for the top) added
+    def load(self, directory, rules):
+        try:
+            groups = parse_ignore_file(read_file(work_path(os.path.join(directory, '.gitignore'))))
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return rules
+        return rules + [(directory, groups)] if groups else rules
+
+    #Return the rules that apply to the contents of directory
+    def rules_for(self, directory):
+        rules = self.cache.get(directory)
+        if rules is None:
+            parent = self.rules_for(directory.rpartition('/')[0]) if directory else self.root_rules
+            rules = self.cache[directory] = self.load(directory, parent)
+        return rules
+
+    #Return True if path is ignored by rules (which should be the rules for its directory)
+    def match(self, rules, path, is_dir):
+        for directory, groups in reversed(rules):
+            relative = path[len(directory) + 1:] if directory else path
+            for regex, negate, dir_only in reversed(groups):
+                if (is_dir or not dir_only) and regex.match(relative):
+                    return not negate
+        return False
+
+    #Return True if path is ignored, either itself or because a directory it's in is
+    def is_ignored(self, path, is_dir=False):
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            directory = '/'.join(parts[:i])
+            if self.match(self.rules_for('/'.join(parts[:i - 1])), directory, True):
+                return True
+        return self.match(self.rules_for('/'.join(parts[:-1])), path, is_dir)
+
+#List directory, return tuple of (file paths in it, (subdirectory, rules) for each subdirectory to scan),
+#leaving out anything ignored (runs in scan_working_copy's threads)
+def scan_directory(directory, rules, ignore):
+    rules = ignore.load(directory, rules)
+    prefix = directory + '/' if directory else ''
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(work_path(directory) or '.') as it:
+            for dir_entry in it:
+                path = prefix + dir_entry.name
+                if dir_entry.is_dir(follow_symlinks=False):
+                    if dir_entry.name != '.git' and not ignore.match(rules, path, True):
+                        subdirs.append((path, rules))
+                elif not ignore.match(rules, path, False):
+                    files.append(path)
+    except (FileNotFoundError, NotADirectoryError):
+        #removed while we were scanning, so there's nothing in it any more
+        pass
+    return files, subdirs
+
+#Return set of paths of all files in the working copy (or in directory top of it) that aren't ignored
+#jobs is the number of threads listing directories (default: ThreadPoolExecutor's default)
+def scan_working_copy(top='', ignore=None, jobs=None):
+    if ignore is None:
+        ignore = IgnoreRules()
+    top = os.path.normpath(top).replace('\\', '/') if top else ''
+    if top == '.':
+        top = ''
+    if top and ignore.is_ignored(top, is_dir=True):
+        return set()
     paths = set()
-    for root, dirs, files in os.walk('.'):
-        dirs[:] = [d for d in dirs if d != '.git']
-        for file in files:
-            path = os.path.join(root, file)
-            path = path.replace('\\', '/')
-            if path.startswith('./'):
-                path = path[2:]
-            paths.add(path)
-    entries_by_path = {e.path: e for e in read_index()}
-    entry_paths = set(entries_by_path)
-    changed = {p for p in (paths & entry_paths)
-               if hash_object(read_file(p), 'blob', write=False) !=
-                  entries_by_path[p].sha1.hex()}
-    new = paths - entry_paths
-    deleted = entry_paths - paths
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs, initializer=set_thread_repository,
+                                               initargs=(get_repository(),)) as executor:
+        parent_rules = ignore.rules_for(top.rpartition('/')[0]) if top else ignore.root_rules
+        pending = {executor.submit(scan_directory, top, parent_rules, ignore)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                paths.update(files)
+                pending.update(executor.submit(scan_directory, path, rules, ignore) for path, rules in subdirs)
+    return paths
+
+"""Even with the stat cache, status still walks the whole working copy and stats every tracked file. On a big
+checkout that's most of the time, and almost all of it is spent confirming that nothing changed.
+
+A filesystem monitor can tell us what changed instead. We ask it "what changed since <token>?" and get back a
+new token and a list of paths (a path ending in / means anything under that directory, and a lone / means it
+can't say, so scan everything). The monitor is either a hook (GITPY_FSMONITOR, run like git's fsmonitor hooks
+as "<hook> 2 <token>", printing the new token and the paths, all NUL terminated) or our own inotify daemon
+(gitpy.py fsmonitor-daemon) which answers the same question over .git/fsmonitor.sock.
+
+After each status we save the token and every path that wasn't clean to .git/fsmonitor-state, so next time
+only those paths plus whatever the monitor reports need looking at. The state also records the checksum of the
+index it goes with: write_index keeps that up to date, so if anything else rewrites the index (or the monitor
+isn't running, has restarted or lost events) we fall back to a full scan and start over from the new token."""
+
+#Seconds to wait for the fsmonitor hook or daemon to answer before giving up and scanning everything
+FSMONITOR_TIMEOUT = 5
+
+#Ask the filesystem monitor what changed since token, return a tuple of (new token, list of paths, or None if
+#everything has to be rescanned), or None if there's no monitor to ask (or it didn't answer)
+def query_fsmonitor(token):
+    hook = os.environ.get('GITPY_FSMONITOR')
+    if hook:
+        try:
+            result = subprocess.run([hook, '2', token], stdout=subprocess.PIPE, cwd=get_repository().path or None,
+                                    timeout=FSMONITOR_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as error:
+            print('warning: could not run fsmonitor hook {}: {}'.format(hook, error), file=sys.stderr)
+            return None
+        if result.returncode != 0:
+            return None
+        output = result.stdout
+    else:
+        #the daemon needs unix sockets (so not on Windows), and there's no point asking if it was never started
+        sock_path = git_path('fsmonitor.sock')
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(sock_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(FSMONITOR_TIMEOUT)
+        try:
+            sock.connect(sock_path)
+            sock.sendall(token.encode() + b'\n')
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        except OSError as error:
+            print('warning: could not query fsmonitor daemon: {}'.format(error), file=sys.stderr)
+            return None
+        finally:
+            sock.close()
+        output = b''.join(chunks)
+    fields = output.split(b'\x00')
+    new_token = fields[0].decode()
+    paths = [field.decode(errors='surrogateescape') for field in fields[1:] if field]
+    if not new_token or '/' in paths:
+        return new_token or None, None
+    return new_token, paths
+
+#Return the checksum at the end of the index file as hex, or None if there is no index yet
+def get_index_checksum():
+    try:
+        with open(git_path('index'), 'rb') as f:
+            f.seek(-20, os.SEEK_END)
+            return f.read(20).hex()
+    except (FileNotFoundError, OSError):
+        return None
+
+#Read .git/fsmonitor-state, return tuple of (token, index checksum, set of paths that weren't clean last time),
+#or None if there isn't one
+def read_fsmonitor_state():
+    try:
+        fields = read_file(git_path('fsmonitor-state')).split(b'\x00')
+    except FileNotFoundError:
+        return None
+    return fields[0].decode(), fields[1].decode(), {field.decode() for field in fields[2:] if field}
+
+#Write .git/fsmonitor-state: the monitor's token, the checksum of the index and the paths that weren't clean
+def write_fsmonitor_state(token, index_checksum, paths):
+    fields = [token, index_checksum] + sorted(paths)
+    path = git_path('fsmonitor-state')
+    tmp_path = path + '.tmp' + unique_suffix()
+    write_file(tmp_path, b''.join(field.encode() + b'\x00' for field in fields))
+    os.replace(tmp_path, path)
+
+#Return a tuple of (monitor token or None, set of paths that might have changed since the last status, or None
+#if everything has to be checked)
+def get_fsmonitor_changes(entries):
+    token = None
+    state = read_fsmonitor_state()
+    if state is not None and state[1] == get_index_checksum():
+        token, _, dirty = state
+    result = query_fsmonitor(token or '')
+    if result is None:
+        return None, None
+    new_token, reported = result
+    if token is None or reported is None:
+        return new_token, None
+    candidates = set(dirty)
+    for path in reported:
+        if not path.endswith('/'):
+            candidates.add(path)
+            continue
+        #a whole directory appeared, vanished or moved: everything we track under it, and everything in it now
+        start = entries.bisect_left(path)
+        end = entries.bisect_left(path[:-1] + '0', start)
+        candidates.update(entries.path(i) for i in range(start, end))
+        if os.path.isdir(work_path(path)):
+            candidates.update(scan_working_copy(path[:-1]))
+    return new_token, candidates
+
+"""The daemon itself: inotify watches every directory in the working copy (except .git) and we number every
+change as it comes in. A token is "gitpy:<epoch>:<number of the last change>", so answering a query is just
+listing the paths changed after that number. The epoch changes whenever the daemon starts or inotify tells us
+it dropped events, so any token from before that gets told to rescan everything."""
+
+#inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+FSMONITOR_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                        IN_CREATE | IN_DELETE)
+
+class FsMonitorDaemon:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this system')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.new_epoch()
+        self.watch_tree('')
+
+    #Forget every change we've seen, tokens from before now will get a full rescan
+    def new_epoch(self):
+        self.epoch = '{:x}'.format(time.time_ns())
+        self.last_change = 0
+        self.changes = {}
+
+    #Start watching directory (relative to the working copy, '' for the top) and every directory under it
+    def watch_tree(self, directory):
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, (directory or '.').encode(), FSMONITOR_WATCH_MASK)
+            if wd < 0:
+                #it was deleted before we got to it, which we'll hear about from its parent
+                continue
+            self.watches[wd] = directory
+            try:
+                with os.scandir(directory or '.') as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir(follow_symlinks=False) and (directory or dir_entry.name != '.git'):
+                            stack.append(directory + '/' + dir_entry.name if directory else dir_entry.name)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    def record(self, path):
+        self.last_change += 1
+        self.changes[path] = self.last_change
+
+    #Handle every inotify event that's waiting
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            i = 0
+            while i < len(data):
+                #struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, then len bytes of name
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+                name = data[i + 16:i + 16 + length].rstrip(b'\x00').decode(errors='surrogateescape')
+                i += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    self.new_epoch()
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None or not name or (not directory and name == '.git'):
+                    continue
+                path = directory + '/' + name if directory else name
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        #files can land in it before the watch does, so the client walks it
+                        self.watch_tree(path)
+                    self.record(path + '/')
+                else:
+                    self.record(path)
+
+    #Return the answer to a query for token: new token, NUL, then each path changed since token, NUL terminated
+    def answer(self, token):
+        fields = token.split(':')
+        if len(fields) == 3 and fields[0] == 'gitpy' and fields[1] == self.epoch:
+            since = int(fields[2])
+            paths = [path for path, change in self.changes.items() if change > since]
+        else:
+            paths = ['/']
+        new_token = 'gitpy:{}:{}'.format(self.epoch, self.last_change)
+        return b''.join(field.encode(errors='surrogateescape') + b'\x00' for field in [new_token] + paths)
+
+    #Answer queries on socket_path until interrupted
+    def serve(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(16)
+        print('watching {} directories, listening on {}'.format(len(self.watches), socket_path))
+        try:
+            while True:
+                readable, _, _ = select.select([self.fd, server], [], [])
+                if self.fd in readable:
+                    self.read_events()
+                if server in readable:
+                    conn, _ = server.accept()
+                    with conn:
+                        conn.settimeout(5)
+                        token = b''
+                        while not token.endswith(b'\n'):
+                            chunk = conn.recv(4096)
+                            if not chunk:
+                                break
+                            token += chunk
+                        #anything that happened before the query is already queued, so count it before answering
+                        self.read_events()
+                        conn.sendall(self.answer(token.decode().strip()))
+        finally:
+            server.close()
+            os.remove(socket_path)
+            os.close(self.fd)
+
+#Run the filesystem monitor daemon for the repo in the current directory (until interrupted)
+def fsmonitor_daemon():
+    daemon = FsMonitorDaemon()
+    try:
+        daemon.serve(git_path('fsmonitor.sock'))
+    except KeyboardInterrupt:
+        pass
+
+#Get status of a working copy, return (changed_paths, new_paths, deleted_paths)
+#if refresh is True, entries that were re-hashed but turned out clean get their stat data updated in the index
+def get_status(refresh=True):
+    index_mtime_ns = get_index_mtime_ns()
+    entries, extensions = read_index_file()
+    token, candidates = get_fsmonitor_changes(entries)
+    ignore = IgnoreRules()
+    if candidates is None:
+        paths = scan_working_copy(ignore=ignore)
+        entry_paths = set(entries.iter_paths())
+        check = paths & entry_paths
+        new = paths - entry_paths
+        #ignoring only applies to untracked files, but we don't look in ignored directories, so any tracked
+        #files the scan didn't see have to be checked for directly
+        deleted = set()
+        for path in entry_paths - paths:
+            full_path = work_path(path)
+            if os.path.lexists(full_path) and not os.path.isdir(full_path):
+                check.add(path)
+            else:
+                deleted.add(path)
+    else:
+        #only the paths the monitor told us about (or that weren't clean last time) can have changed
+        check = set()
+        new = set()
+        deleted = set()
+        for path in candidates:
+            full_path = work_path(path)
+            exists = os.path.lexists(full_path) and not os.path.isdir(full_path)
+            if entries.find(path) >= 0:
+                (check if exists else deleted).add(path)
+            elif exists and not ignore.is_ignored(path):
+                new.add(path)
+    changed = set()
+    refreshed = False
+    #anything modified at or after this point isn't safe to refresh, it could still be changing
+    check_start_ns = time.time_ns()
+    for p in check:
+        i = entries.find(p)
+        entry = entries[i]
+        st = os.stat(work_path(p))
+        if stat_matches(entry, st) and not is_racy(entry, index_mtime_ns):
+            continue
+        if hash_file(work_path(p), write=False) != entry.sha1.hex():
+            changed.add(p)
+        elif st.st_mtime_ns < check_start_ns:
+            #clean, so record the new stat data (and rewrite the index so it's no longer racy)
+            entries.set(i, index_entry_from_stat(p, entry.sha1, st))
+            refreshed = True
+    if refresh and refreshed:
+        #only stat data changed, so the cache tree (if any) is still valid
+        write_index(entries, extensions)
+    if token is not None:
+        #racy entries have to be looked at again next time, even if nothing touches them
+        dirty = changed | new | deleted
+        dirty.update(p for p in check if is_racy(entries.get(p), index_mtime_ns))
+        write_fsmonitor_state(token, get_index_checksum(), dirty)
     return (sorted(changed), sorted(new), sorted(deleted))
 #shows status of working copy
 def status():
@@ -297,85 +1381,661 @@ def status():
         for path in deleted:
             print(' ', path)
 
-#Shows difference of files changed between index and working copy
-def diff():
+"""Diffing
+difflib compares every line against every other one it might match, which gets quadratic on big files or
+files with lots of edits. Instead we split the problem up around lines we can be sure about, like git's
+patience and histogram diffs:
+1. strip the lines both sides start and end with, they're obviously unchanged
+2. lines that appear exactly once on each side almost certainly match each other, so take the longest run of
+   those that are in the same order on both sides (patience sorting) and split the rest into the gaps between
+   them, which are usually tiny
+3. if there are no unique lines, find a line that appears in both sides as few times as possible in the old
+   side, grow it into the longest run of matching lines around it and split around that instead (histogram)
+4. if every common line is too common to be a good anchor, fall back to Myers' algorithm (the shortest edit
+   script, at a cost proportional to the number of differences)
+Lines are swapped for small ints first so comparing them is cheap, and matches come out in order so hunks can
+be printed as they're found."""
+
+#a line that appears more often than this in the old side isn't used as an anchor
+DIFF_MAX_CHAIN = 64
+#give up on finding the shortest edit script past this many differences and call the rest a replacement
+MYERS_MAX_COST = 1024
+#number of unchanged lines shown around each change
+DIFF_CONTEXT = 3
+
+#Return True if data looks binary (git's test: a NUL byte in the first 8000 bytes)
+def is_binary(data):
+    return b'\x00' in data[:8000]
+
+#Split data into lines, each keeping its newline (the last one may not have one)
+def split_lines(data):
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+#Find lines that appear exactly once in a[alo:ahi] and once in b[blo:bhi], return the longest list of
+#(a index, b index) pairs of them that's in the same order on both sides
+def find_unique_anchors(a, alo, ahi, b, blo, bhi):
+    a_counts = collections.Counter(a[alo:ahi])
+    b_counts = collections.Counter(b[blo:bhi])
+    a_positions = {a[i]: i for i in range(alo, ahi)}
+    pairs = [(a_positions[line], j) for j, line in enumerate(b[blo:bhi], blo)
+             if b_counts[line] == 1 and a_counts.get(line) == 1]
+    #usually nothing moved and they're already in order
+    if all(pairs[n][0] < pairs[n + 1][0] for n in range(len(pairs) - 1)):
+        return pairs
+    #longest increasing subsequence of the a indexes: tails[k] is the smallest a index that ends a run of k + 1
+    tails = []
+    tail_pairs = []
+    previous = []
+    for n, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tails, i)
+        if k == len(tails):
+            tails.append(i)
+            tail_pairs.append(n)
+        else:
+            tails[k] = i
+            tail_pairs[k] = n
+        previous.append(tail_pairs[k - 1] if k else None)
+    anchors = []
+    n = tail_pairs[-1] if tail_pairs else None
+    while n is not None:
+        anchors.append(pairs[n])
+        n = previous[n]
+    anchors.reverse()
+    return anchors
+
+#Find the best anchor for a histogram diff of a[alo:ahi] and b[blo:bhi]
+#return (a index, b index, length) of the matching run around it, or None if there's no good anchor
+def find_histogram_anchor(a, alo, ahi, b, blo, bhi):
+    positions = {}
+    for i in range(alo, ahi):
+        positions.setdefault(a[i], []).append(i)
+    best = None
+    best_count = DIFF_MAX_CHAIN + 1
+    best_length = 0
+    j = blo
+    while j < bhi:
+        occurrences = positions.get(b[j])
+        next_j = j + 1
+        if occurrences is not None and len(occurrences) <= best_count:
+            for i in occurrences:
+                #grow the match in both directions
+                start_i, start_j = i, j
+                while start_i > alo and start_j > blo and a[start_i - 1] == b[start_j - 1]:
+                    start_i -= 1
+                    start_j -= 1
+                end_i, end_j = i + 1, j + 1
+                while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                    end_i += 1
+                    end_j += 1
+                length = end_i - start_i
+                if len(occurrences) < best_count or length > best_length:
+                    best = (start_i, start_j, length)
+                    best_count = len(occurrences)
+                    best_length = length
+                next_j = max(next_j, end_j)
+        j = next_j
+    return best
+
+#Find the shortest edit script from a[alo:ahi] to b[blo:bhi] with Myers' algorithm
+#return list of matching (a index, b index, length) runs in order, or None if it would cost more than max_cost
+def myers_matching_blocks(a, alo, ahi, b, blo, bhi, max_cost=MYERS_MAX_COST):
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min(n + m, max_cost)
+    offset = max_d + 1
+    #v[offset + k] is the furthest x reached on diagonal k (x - y = k)
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        #keep the diagonals this round reads from, so we can retrace our steps afterwards
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+    #walk back from the end, collecting the diagonal (matching) moves
+    matches = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        previous = trace[d]
+        k = x - y
+        if k == -d or (k != d and previous[k + d] < previous[k + d + 2]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = previous[previous_k + d + 1]
+        previous_y = previous_x - previous_k
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        x, y = previous_x, previous_y
+    blocks = []
+    for i, j in reversed(matches):
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    return [tuple(block) for block in blocks]
+
+#Diff two lists of lines, yield matching (a index, b index, length) runs in order
+def iter_matching_blocks(a, b):
+    #most edits leave the start and end alone, so skip those before doing any real work
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-suffix - 1] == b[-suffix - 1]:
+        suffix += 1
+    if prefix:
+        yield 0, 0, prefix
+    #compare small ints instead of whole lines, the skipped lines are never looked at again
+    ids = {}
+    a_end = len(a) - suffix
+    b_end = len(b) - suffix
+    a = [None] * prefix + [ids.setdefault(line, len(ids)) for line in a[prefix:a_end]] + [None] * suffix
+    b = [None] * prefix + [ids.setdefault(line, len(ids)) for line in b[prefix:b_end]] + [None] * suffix
+    #a stack of regions still to diff and matches found to the right of them, so results come out in order
+    stack = [(False, prefix, a_end, prefix, b_end)]
+    if suffix:
+        stack.insert(0, (True, a_end, suffix, b_end, None))
+    while stack:
+        is_match, alo, ahi, blo, bhi = stack.pop()
+        if is_match:
+            yield alo, blo, ahi
+            continue
+        n = 0
+        while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+            n += 1
+        if n:
+            yield alo, blo, n
+            alo += n
+            blo += n
+        n = 0
+        while ahi - n > alo and bhi - n > blo and a[ahi - n - 1] == b[bhi - n - 1]:
+            n += 1
+        if n:
+            ahi -= n
+            bhi -= n
+            stack.append((True, ahi, n, bhi, None))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = find_unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            #join anchors next to each other into runs, then push the runs and the gaps between them
+            runs = []
+            for i, j in anchors:
+                if runs and runs[-1][0] + runs[-1][2] == i and runs[-1][1] + runs[-1][2] == j:
+                    runs[-1][2] += 1
+                else:
+                    runs.append([i, j, 1])
+            end_i, end_j = ahi, bhi
+            for i, j, n in reversed(runs):
+                if i + n < end_i or j + n < end_j:
+                    stack.append((False, i + n, end_i, j + n, end_j))
+                stack.append((True, i, n, j, None))
+                end_i, end_j = i, j
+            if alo < end_i or blo < end_j:
+                stack.append((False, alo, end_i, blo, end_j))
+            continue
+        anchor = find_histogram_anchor(a, alo, ahi, b, blo, bhi)
+        if anchor is not None:
+            i, j, n = anchor
+            stack.append((False, i + n, ahi, j + n, bhi))
+            stack.append((True, i, n, j, None))
+            stack.append((False, alo, i, blo, j))
+        else:
+            for i, j, n in reversed(myers_matching_blocks(a, alo, ahi, b, blo, bhi) or []):
+                stack.append((True, i, n, j, None))
+
+#Turn matching blocks into opcodes ('equal' or 'change', a start, a end, b start, b end), yielded in order
+def iter_opcodes(blocks, a_length, b_length):
+    i = j = 0
+    equal = None
+    for block_i, block_j, n in itertools.chain(blocks, [(a_length, b_length, 0)]):
+        if i < block_i or j < block_j:
+            if equal is not None:
+                yield equal
+                equal = None
+            yield ('change', i, block_i, j, block_j)
+        if n:
+            if equal is not None:
+                #adjacent runs (from different parts of the search) are one run
+                equal = ('equal', equal[1], block_i + n, equal[3], block_j + n)
+            else:
+                equal = ('equal', block_i, block_i + n, block_j, block_j + n)
+        i, j = block_i + n, block_j + n
+    if equal is not None:
+        yield equal
+
+#Group opcodes into hunks (lists of opcodes) with up to context unchanged lines around each change
+def iter_hunks(opcodes, context=DIFF_CONTEXT):
+    group = []
+    previous_equal = None
+    for opcode in opcodes:
+        tag, i1, i2, j1, j2 = opcode
+        if tag == 'equal':
+            if not group:
+                previous_equal = opcode
+            elif i2 - i1 > 2 * context:
+                group.append(('equal', i1, i1 + context, j1, j1 + context))
+                yield group
+                group = []
+                previous_equal = opcode
+            else:
+                group.append(opcode)
+            continue
+        if not group and previous_equal is not None:
+            _, e1, e2, f1, f2 = previous_equal
+            group.append(('equal', max(e1, e2 - context), e2, max(f1, f2 - context), f2))
+        group.append(opcode)
+    if group:
+        tag, i1, i2, j1, j2 = group[-1]
+        if tag == 'equal':
+            group[-1] = ('equal', i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+        yield group
+
+#Format a hunk's line range like unified diff does
+def format_hunk_range(start, end):
+    length = end - start
+    if length == 1:
+        return '{}'.format(start + 1)
+    if not length:
+        return '{},0'.format(start)
+    return '{},{}'.format(start + 1, length)
+
+#Diff two blobs, yield the lines of a unified diff (nothing if they're the same)
+def diff_blobs(a_data, b_data, a_name, b_name, context=DIFF_CONTEXT):
+    if len(a_data) == len(b_data) and a_data == b_data:
+        return
+    if is_binary(a_data) or is_binary(b_data):
+        yield 'Binary files {} and {} differ'.format(a_name, b_name)
+        return
+    a = split_lines(a_data)
+    b = split_lines(b_data)
+    header = False
+    opcodes = iter_opcodes(iter_matching_blocks(a, b), len(a), len(b))
+    for hunk in iter_hunks(opcodes, context):
+        if not header:
+            yield '--- {}'.format(a_name)
+            yield '+++ {}'.format(b_name)
+            header = True
+        yield '@@ -{} +{} @@'.format(format_hunk_range(hunk[0][1], hunk[-1][2]),
+                                     format_hunk_range(hunk[0][3], hunk[-1][4]))
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == 'equal':
+                lines = [(' ', line) for line in a[i1:i2]]
+            else:
+                lines = [('-', line) for line in a[i1:i2]] + [('+', line) for line in b[j1:j2]]
+            for prefix, line in lines:
+                yield prefix + line.rstrip(b'\n').decode(errors='replace')
+                if not line.endswith(b'\n'):
+                    yield '\\ No newline at end of file'
+
+#Yield the lines of the difference of files changed between index and working copy
+def iter_diff():
     changed, _, _ = get_status()
-    entries_by_path = {e.path: e for e in read_index()}
+    entries = read_index()
     for i, path, in enumerate(changed):
-        sha1 = entries_by_path[path].sha1.hex()
+        sha1 = entries.get(path).sha1.hex()
         obj_type, data = read_object(sha1)
         assert obj_type == 'blob'
-        index_lines = data.decode().splitlines()
-        working_lines = read_file(path).decode().splitlines()
-        diff_lines = difflib.unified_diff(index_lines, working_lines,
-                                          '{} (index)'.format(path),
-                                          '{} (working copy)'.format(path),
-                                          lineterm='')
-        for line in diff_lines:
-            print(line)
-        if i < len(changed - 1):
-            print('-' * 70)
+        yield from diff_blobs(data, read_file(work_path(path)),
+                              '{} (index)'.format(path),
+                              '{} (working copy)'.format(path))
+        if i < len(changed) - 1:
+            yield '-' * 70
+
+#Shows difference of files changed between index and working copy
+def diff():
+    for line in iter_diff():
+        print(line)
+
+"""Diffing two commits
+Each tree entry carries the SHA-1 of what's under it, so two trees with the same hash hold exactly the same
+files. We walk both trees side by side and only read a pair of subtrees when their hashes differ, and only
+inflate the blobs whose hashes differ, so comparing two releases costs time in proportion to what changed
+between them rather than the size of the tree."""
+
+GITLINK_MODE = 0o160000
+
+#Resolve a commit name (a sha1 or prefix, HEAD, a branch or tag, optionally followed by ~n or ^ to step back
+#through first parents) to the sha1 of its tree. A tree sha1 is accepted as is
+def resolve_tree(name):
+    match = re.match(r'(.*?)((?:[~^]\d*)*)\Z', name)
+    name, steps = match.groups()
+    local_refs = read_local_refs()
+    if name == 'HEAD':
+        head = read_file(git_path('HEAD')).decode().strip()
+        name = head[5:].strip() if head.startswith('ref:') else head
+    for ref in [name, 'refs/heads/' + name, 'refs/tags/' + name]:
+        if ref in local_refs:
+            sha1 = local_refs[ref]
+            break
+    else:
+        if name.startswith('refs/'):
+            raise ValueError('ref {!r} not found'.format(name))
+        sha1 = find_object(name)
+    sha1, _ = peel_tag(sha1)
+    for step in re.findall(r'[~^]\d*', steps):
+        count = int(step[1:]) if step[1:] else 1
+        if step[0] == '^':
+            #name^2 is the second parent (not the grandparent) and name^0 is the commit itself
+            if count:
+                parents = read_commit(sha1)[1]
+                if len(parents) < count:
+                    raise ValueError('{!r} has no parent {}'.format(sha1, count))
+                sha1 = parents[count - 1]
+            continue
+        for _ in range(count):
+            parents = read_commit(sha1)[1]
+            if not parents:
+                raise ValueError('{!r} has no parent'.format(sha1))
+            sha1 = parents[0]
+    obj_type, _ = read_object_header(sha1)
+    if obj_type == 'commit':
+        return read_commit(sha1)[0]
+    if obj_type != 'tree':
+        raise ValueError('{!r} is a {}, not a commit or tree'.format(name, obj_type))
+    return sha1
+
+#Compare two trees (either can be None for an empty tree) without reading subtrees that are the same on both sides
+#return list of (path, a mode, a sha1, b mode, b sha1) sorted by path, mode and sha1 are None where a side is missing
+def diff_trees(a_tree, b_tree):
+    changes = []
+    stack = [(a_tree, b_tree, '')]
+    while stack:
+        a_sha1, b_sha1, prefix = stack.pop()
+        #compare raw digests and only turn the ones that differ into hex
+        a_entries = {path: (mode, digest) for mode, path, digest in read_tree(sha1=a_sha1)} if a_sha1 else {}
+        b_entries = {path: (mode, digest) for mode, path, digest in read_tree(sha1=b_sha1)} if b_sha1 else {}
+        for path in a_entries.keys() | b_entries.keys():
+            a_mode, a_entry = a_entries.get(path, (None, None))
+            b_mode, b_entry = b_entries.get(path, (None, None))
+            if a_mode == b_mode and a_entry == b_entry:
+                continue
+            a_entry = a_entry and a_entry.hex()
+            b_entry = b_entry and b_entry.hex()
+            a_is_tree = a_mode is not None and stat.S_ISDIR(a_mode)
+            b_is_tree = b_mode is not None and stat.S_ISDIR(b_mode)
+            if a_is_tree or b_is_tree:
+                stack.append((a_entry if a_is_tree else None, b_entry if b_is_tree else None, prefix + path + '/'))
+            #a file replaced by a directory (or the other way round) is a deletion as well as the new tree
+            if (a_mode is not None and not a_is_tree) or (b_mode is not None and not b_is_tree):
+                if a_is_tree:
+                    a_mode = a_entry = None
+                if b_is_tree:
+                    b_mode = b_entry = None
+                changes.append((prefix + path, a_mode, a_entry, b_mode, b_entry))
+    changes.sort()
+    return changes
+
+#Return the bytes a tree entry is diffed as: a blob's data, or the commit a submodule points at
+def read_entry_data(mode, sha1):
+    if mode is None:
+        return b''
+    if mode == GITLINK_MODE:
+        return 'Subproject commit {}\n'.format(sha1).encode()
+    obj_type, data = read_object(sha1)
+    assert obj_type == 'blob'
+    return data
+
+#Yield the lines of a git style diff between two commits (or trees)
+def iter_commit_diff(a_name, b_name, context=DIFF_CONTEXT):
+    for path, a_mode, a_sha1, b_mode, b_sha1 in diff_trees(resolve_tree(a_name), resolve_tree(b_name)):
+        yield 'diff --git a/{0} b/{0}'.format(path)
+        if a_mode is None:
+            yield 'new file mode {:o}'.format(b_mode)
+        elif b_mode is None:
+            yield 'deleted file mode {:o}'.format(a_mode)
+        elif a_mode != b_mode:
+            yield 'old mode {:o}'.format(a_mode)
+            yield 'new mode {:o}'.format(b_mode)
+        if a_sha1 == b_sha1:
+            continue
+        index_line = 'index {}..{}'.format((a_sha1 or '0' * 40)[:7], (b_sha1 or '0' * 40)[:7])
+        if a_mode == b_mode:
+            index_line += ' {:o}'.format(a_mode)
+        yield index_line
+        yield from diff_blobs(read_entry_data(a_mode, a_sha1), read_entry_data(b_mode, b_sha1),
+                              'a/' + path if a_mode is not None else '/dev/null',
+                              'b/' + path if b_mode is not None else '/dev/null', context)
 
-#Write list of IndexEntry objects to git index file
-def write_index(entries):
+#Shows difference between two commits
+def diff_commits(a_name, b_name):
+    for line in iter_commit_diff(a_name, b_name):
+        print(line)
+
+#Encode IndexEntries (or a sorted list of IndexEntry objects) and dict of extensions as an index file of the
+#given version, return the bytes
+def encode_index(entries, extensions, version):
+    entries = IndexEntries.from_entries(entries)
+    #just like how we unpacked it for read index, we will now pack it, straight from the columns
+    stats, flags = entries.big_endian_columns()
+    sha1s = entries.sha1s
     packed_entries = []
-    for entry in entries:
-        #just like how we unpacked it for read index, we will now pack it
-        entry_head = struct.pack('!LLLLLLLLLL20sH',
-            u32(entry.ctime_s),
-            u32(entry.ctime_n),
-            u32(entry.mtime_s),
-            u32(entry.mtime_n),
-            u32(entry.dev),
-            u32(entry.ino),
-            u32(entry.mode),
-            u32(entry.uid),
-            u32(entry.gid),
-            u32(entry.size),
-            entry.sha1,
-            entry.flags)
-        path = entry.path.encode()
-        length = ((62 + len(path) + 8) // 8) * 8
-        packed_entry = entry_head + path + b'\x00' * (length - 62 - len(path))
-        packed_entries.append(packed_entry)
+    previous_path = b''
+    for i in range(len(entries)):
+        path = entries.path_bytes(i)
+        packed_entries += [stats[i * 40:(i + 1) * 40], sha1s[i * 20:(i + 1) * 20], flags[i * 2:(i + 1) * 2]]
+        if version == 4:
+            common = len(os.path.commonprefix([previous_path, path]))
+            packed_entries += [encode_ofs_delta_offset(len(previous_path) - common), path[common:], b'\x00']
+            previous_path = path
+        else:
+            length = ((62 + len(path) + 8) // 8) * 8
+            packed_entries += [path, b'\x00' * (length - 62 - len(path))]
     #We quite literally are doing the opposite of read_index
-    header = struct.pack('!4sLL', b'DIRC', 2, len(entries))
+    header = struct.pack('!4sLL', b'DIRC', version, len(entries))
+    for ext_signature, ext_data in extensions.items():
+        packed_entries.append(struct.pack('!4sL', ext_signature, len(ext_data)) + ext_data)
     all_data = header + b''.join(packed_entries)
     digest = hashlib.sha1(all_data).digest()
-    write_file(os.path.join('.git', 'index'), all_data + digest)
-
-#Adds all file paths to index
-def add(paths):
-    paths = [p.replace('\\', '/') for p in paths]
-    all_entries = read_index()
-    #Check to see if there are any new files to add to the index
-    entries = [e for e in all_entries if e.path not in paths]
+    return all_data + digest
+
+#Split entries against the shared index named in link (if there is one and it's still close enough),
+#otherwise write a new shared index holding all of them
+#return tuple of (entries to write to .git/index, link extension data)
+def split_index_entries(entries, link, version):
+    entries = IndexEntries.from_entries(entries)
+    shared_sha1 = link[:20].hex() if link else None
+    shared_entries = read_shared_index(shared_sha1) if shared_sha1 else None
+    if shared_entries is not None:
+        deleted = set()
+        replaced = set()
+        replacements = IndexEntries()
+        added = []
+        #both are sorted by path, so walk them side by side
+        i = j = 0
+        while i < len(shared_entries) or j < len(entries):
+            shared_path = shared_entries.path_bytes(i) if i < len(shared_entries) else None
+            path = entries.path_bytes(j) if j < len(entries) else None
+            if path is None or (shared_path is not None and shared_path < path):
+                deleted.add(i)
+                i += 1
+            elif shared_path is None or path < shared_path:
+                added.append(j)
+                j += 1
+            else:
+                if not shared_entries.same(i, entries, j):
+                    replaced.add(i)
+                    entry = entries[j]
+                    replacements.append(entry._replace(path='', flags=entry.flags & ~0xFFF))
+                i += 1
+                j += 1
+        changes = len(deleted) + len(replaced) + len(added)
+        if changes * 100 <= len(shared_entries) * SPLIT_INDEX_MAX_PERCENT:
+            for j in added:
+                replacements.extend_from(entries, j, j + 1)
+            link = (bytes.fromhex(shared_sha1) + write_ewah(deleted, len(shared_entries)) +
+                    write_ewah(replaced, len(shared_entries)))
+            return replacements, link
+    data = encode_index(entries, {}, version)
+    shared_sha1 = data[-20:].hex()
+    path = git_path('sharedindex.' + shared_sha1)
+    tmp_path = path + '.tmp' + unique_suffix()
+    write_file(tmp_path, data)
+    os.replace(tmp_path, path)
+    get_repository().shared_index_cache = (path, entries)
+    return IndexEntries(), bytes.fromhex(shared_sha1) + write_ewah(set(), 0) + write_ewah(set(), 0)
+
+#Write IndexEntries or a sorted list of IndexEntry objects (and optionally a dict of extensions) to git index file
+#version is 2 or 4 (default: see get_index_version), split writes a split index (default: split if the index
+#we read was split, which shows up as a link extension)
+def write_index(entries, extensions=None, version=None, split=None):
+    extensions = dict(extensions or {})
+    link = extensions.pop(b'link', None)
+    if version is None:
+        version = get_index_version()
+    if split is None:
+        split = link is not None
+    if split:
+        entries, link = split_index_entries(entries, link, version)
+        #the link extension has to come first, git needs it before it can make sense of the others
+        extensions = dict([(b'link', link)] + list(extensions.items()))
+    data = encode_index(entries, extensions, version)
+    #write a temp file and rename it into place, so nobody reading the index sees half of it
+    path = git_path('index')
+    tmp_path = path + '.tmp' + unique_suffix()
+    write_file(tmp_path, data)
+    os.replace(tmp_path, path)
+    #our own changes to the index don't invalidate what the filesystem monitor told us
+    state = read_fsmonitor_state()
+    if state is not None:
+        write_fsmonitor_state(state[0], data[-20:].hex(), state[2])
+    #shared indexes that .git/index no longer links to are garbage
+    current = 'sharedindex.' + link[:20].hex() if split else None
+    for name in os.listdir(get_repository().git_dir):
+        if name.startswith('sharedindex.') and name != current and '.tmp' not in name:
+            os.remove(git_path(name))
+
+#Rewrite the index with the given version and/or split setting (None leaves that setting as it is)
+def update_index(version=None, split=None):
+    entries, extensions = read_index_file()
+    write_index(entries, extensions, version, split)
+
+#Build an IndexEntry for path from its os.stat result and the (binary) sha1 of its blob
+def index_entry_from_stat(path, sha1, st):
+    #git stores seconds and nanoseconds seperately, st_*_ns gives us both without float rounding
+    ctime_s = u32(st.st_ctime_ns // 1000000000)
+    ctime_n = u32(st.st_ctime_ns % 1000000000)
+    mtime_s = u32(st.st_mtime_ns // 1000000000)
+    mtime_n = u32(st.st_mtime_ns % 1000000000)
+
+    dev  = u32(getattr(st, "st_dev", 0))
+    ino  = u32(getattr(st, "st_ino", 0))
+    mode = u32(getattr(st, "st_mode", 0))
+    uid  = u32(getattr(st, "st_uid", 0))
+    gid  = u32(getattr(st, "st_gid", 0))
+    size = u32(getattr(st, "st_size", 0))
+
+    flags = min(len(path.encode()), 0x0FFF)  # 12-bit length; upper bits are stage
+
+    return IndexEntry(
+        ctime_s, ctime_n, mtime_s, mtime_n,
+        dev, ino, mode, uid, gid, size,
+        sha1, flags, path
+    )
+
+"""Adding lots of files is mostly reading, hashing and compressing, each file independent of the others,
+so we farm that out to a pool of worker processes (threads would just fight over the GIL for the hashing).
+All the results come back to us and the index is written once at the end."""
+
+#Expand files, directories and glob patterns given to add into a sorted list of file paths
+#(ignored files are left out unless they're named explicitly)
+def expand_paths(paths):
+    expanded = set()
+    ignore = IgnoreRules()
+    for path in paths:
+        if glob.has_magic(path):
+            matches = glob.glob(path, root_dir=get_repository().path or None, recursive=True)
+            if not matches:
+                raise ValueError('pathspec {!r} did not match any files'.format(path))
+            matches = [match for match in matches
+                       if not ignore.is_ignored(os.path.normpath(match).replace('\\', '/'), os.path.isdir(work_path(match)))]
+        else:
+            matches = [path]
+        for match in matches:
+            if os.path.isdir(work_path(match)):
+                expanded.update(scan_working_copy(match, ignore))
+            else:
+                expanded.add(match)
+    result = set()
+    for path in expanded:
+        path = os.path.normpath(path).replace('\\', '/')
+        if path.split('/')[0] != '.git':
+            result.add(path)
+    return sorted(result)
+
+#Hash and store the blob at path, return its IndexEntry (runs in add's worker processes)
+def add_worker(path):
+    #stat before reading so a write that lands mid-read leaves the entry looking stale, not clean
+    st = os.stat(work_path(path))
+    sha1 = hash_file(work_path(path))
+    return index_entry_from_stat(path, bytes.fromhex(sha1), st)
+
+#Make the repository at path current in one of add's worker processes
+def start_add_worker(path):
+    set_thread_repository(Repository(path))
+
+#Adds all file paths (or directories, or glob patterns) to index
+#jobs is the number of worker processes to hash with (default: one per cpu)
+def add(paths, jobs=None):
+    paths = expand_paths(paths)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    all_entries, extensions = read_index_file()
+    #don't bother re-hashing tracked files that haven't changed
+    token, candidates = get_fsmonitor_changes(all_entries)
+    index_mtime_ns = get_index_mtime_ns()
+    unchanged = set()
     for path in paths:
-        sha1 = hash_object(read_file(path), 'blob')
-        st = os.stat(path)
-
-        ctime_s = int(getattr(st, "st_ctime", 0))
-        mtime_s = int(getattr(st, "st_mtime", 0))
-        ctime_n = 0
-        mtime_n = 0
-
-        dev  = u32(getattr(st, "st_dev", 0))
-        ino  = u32(getattr(st, "st_ino", 0))
-        mode = u32(getattr(st, "st_mode", 0))
-        uid  = u32(getattr(st, "st_uid", 0))
-        gid  = u32(getattr(st, "st_gid", 0))
-        size = u32(getattr(st, "st_size", 0))
-
-        flags = min(len(path.encode()), 0x0FFF)  # 12-bit length; upper bits are stage
-
-        entry = IndexEntry(
-            ctime_s, ctime_n, mtime_s, mtime_n,
-            dev, ino, mode, uid, gid, size,
-            bytes.fromhex(sha1), flags, path
-        )
-        entries.append(entry)
-    entries.sort(key=operator.attrgetter('path'))
-    write_index(entries)
+        i = all_entries.find(path)
+        if i < 0:
+            continue
+        if candidates is not None:
+            if path not in candidates:
+                unchanged.add(path)
+            continue
+        entry = all_entries[i]
+        if stat_matches(entry, os.stat(work_path(path))) and not is_racy(entry, index_mtime_ns):
+            unchanged.add(path)
+    paths = [path for path in paths if path not in unchanged]
+    #starting processes isn't free, so only bother for a decent number of files
+    if jobs > 1 and len(paths) >= 16:
+        chunk_size = max(1, len(paths) // (jobs * 8))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=start_add_worker,
+                                                    initargs=(get_repository().path,)) as executor:
+            new_entries = list(executor.map(add_worker, paths, chunksize=chunk_size))
+    else:
+        new_entries = [add_worker(path) for path in paths]
+    cache_tree = parse_cache_tree(extensions.get(b'TREE'))
+    for entry in new_entries:
+        i = all_entries.find(entry.path)
+        if i < 0 or all_entries.sha1(i) != entry.sha1:
+            invalidate_cache_tree(cache_tree, entry.path)
+    if cache_tree:
+        extensions[b'TREE'] = serialize_cache_tree(cache_tree)
+    #paths came out of expand_paths sorted, so this is one pass over the existing entries
+    write_index(all_entries.merge(new_entries), extensions)
 
 """Committing
 performing a commit consists of writing two objects
@@ -385,40 +2045,149 @@ A tree lists the hashes of the files (blobs) and sub-trees in a recursive manner
 when a file changes the hash of the entire tree changes, but if subtree has been left
 the same it'll be the same hash, so we can store changes in directory trees efficiently.
 
-First we will implement write_tree which will write theese tree objects for commits"""
+First we will implement write_tree which will write theese tree objects for commits
 
-#Write tree object from current index
-def write_tree():
+The index is a flat, sorted list of paths, so to get nested trees we group entries by their first directory
+component and recurse, writing each subdirectory's tree first so the parent can point at its hash.
+
+Re-hashing every tree on every commit would make commit time grow with the size of the repo, so like git
+we keep a "cache tree" in the index's TREE extension: for each directory, how many index entries it covers and
+the hash of its tree. add() invalidates the directories above any path it changes, and write_tree() reuses
+the hash of every directory that's still valid. For each directory the extension stores (in pre-order):
+    path component, NUL, entry count in ascii (-1 if invalid), space, number of subtrees in ascii, newline,
+    then the 20 byte sha1 of the tree (only if it's valid)
+We keep it in memory as a dict of directory path ('' for the root) -> (entry count, binary sha1 or None)."""
+
+#Parse TREE extension data into dict of directory path -> (entry_count, sha1), empty dict if data is None
+def parse_cache_tree(data):
+    cache_tree = {}
+    if not data:
+        return cache_tree
+    #(parent path, subtrees left to read) for each directory we're inside of
+    stack = []
+    i = 0
+    while i < len(data):
+        nul = data.index(b'\x00', i)
+        name = data[i:nul].decode()
+        newline = data.index(b'\n', nul)
+        entry_count, subtree_count = (int(n) for n in data[nul + 1:newline].split())
+        i = newline + 1
+        sha1 = None
+        if entry_count >= 0:
+            sha1 = data[i:i + 20]
+            i += 20
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+        if stack:
+            parent, remaining = stack[-1]
+            stack[-1] = (parent, remaining - 1)
+            path = parent + '/' + name if parent else name
+        else:
+            path = name
+        cache_tree[path] = (entry_count, sha1)
+        stack.append((path, subtree_count))
+    return cache_tree
+
+#Serialize dict of directory path -> (entry_count, sha1) back into TREE extension data
+def serialize_cache_tree(cache_tree):
+    children = collections.defaultdict(list)
+    for path in cache_tree:
+        if path:
+            parent, _, name = path.rpartition('/')
+            children[parent].append(name)
+    parts = []
+    def serialize(path, name):
+        entry_count, sha1 = cache_tree[path]
+        names = sorted(children[path])
+        parts.append('{}\x00{} {}\n'.format(name, entry_count, len(names)).encode())
+        if entry_count >= 0:
+            parts.append(sha1)
+        for child in names:
+            serialize(path + '/' + child if path else child, child)
+    if '' in cache_tree:
+        serialize('', '')
+    return b''.join(parts)
+
+#Mark every directory containing path as invalid in the cache tree
+def invalidate_cache_tree(cache_tree, path):
+    directory = path
+    while directory:
+        directory = directory.rpartition('/')[0]
+        if directory in cache_tree:
+            cache_tree[directory] = (-1, None)
+
+#Return the mode git expects in a tree for an index entry's mode (trees only allow a few)
+def tree_mode(mode):
+    if stat.S_ISLNK(mode):
+        return 0o120000
+    if mode & 0o111:
+        return 0o100755
+    return 0o100644
+
+#Write trees for entries[start:end] (which all live under directory prefix), return binary sha1 of the tree.
+#Valid directories in cache_tree are reused, and new_cache_tree is filled in with every directory's tree
+def build_tree(entries, start, end, prefix, cache_tree, new_cache_tree):
+    directory = prefix.rstrip('/')
+    cached = cache_tree.get(directory)
+    if cached is not None and cached[0] == end - start:
+        #nothing under here changed, so carry over this directory and everything below it
+        for path, value in cache_tree.items():
+            if path == directory or not directory or path.startswith(prefix):
+                new_cache_tree[path] = value
+        return cached[1]
     tree_entries = []
-    for entry in read_index():
-        assert '/' not in entry.path, \
-        'currently only supports a single, top-level directory'
-        mode_path = '{:o} {}'.format(entry.mode, entry.path).encode()
-        tree_entry = mode_path + b'\x00' + entry.sha1
-        tree_entries.append(tree_entry)
-    return hash_object(b''.join(tree_entries), 'tree')
+    i = start
+    while i < end:
+        name = entries.path(i)[len(prefix):]
+        if '/' in name:
+            sub_name = name.split('/', 1)[0]
+            sub_prefix = prefix + sub_name + '/'
+            #'0' sorts right after '/', so everything under sub_prefix ends where sub_name + '0' would go
+            sub_end = entries.bisect_left(prefix + sub_name + '0', i, end)
+            sha1 = build_tree(entries, i, sub_end, sub_prefix, cache_tree, new_cache_tree)
+            tree_entries.append('{:o} {}'.format(0o40000, sub_name).encode() + b'\x00' + sha1)
+            i = sub_end
+        else:
+            mode_path = '{:o} {}'.format(tree_mode(entries.mode(i)), name).encode()
+            tree_entries.append(mode_path + b'\x00' + entries.sha1(i))
+            i += 1
+    sha1 = bytes.fromhex(hash_object(b''.join(tree_entries), 'tree'))
+    new_cache_tree[directory] = (end - start, sha1)
+    return sha1
+
+#Write tree object (and all its subtrees) from current index, return hex sha1 of the root tree
+def write_tree():
+    entries, extensions = read_index_file()
+    cache_tree = parse_cache_tree(extensions.get(b'TREE'))
+    new_cache_tree = {}
+    sha1 = build_tree(entries, 0, len(entries), '', cache_tree, new_cache_tree)
+    if new_cache_tree != cache_tree:
+        extensions[b'TREE'] = serialize_cache_tree(new_cache_tree)
+        write_index(entries, extensions)
+    return sha1.hex()
 
 #while we're here, let's implement read_tree, just the reverse of write_tree
 
-#read tree given SHA1 or data, return list of (mode, path, sha1) tuples
+#Each tree entry is "<octal mode> <path>\x00<20 byte digest>". The path can hold spaces but never a NUL, and the
+#digest can hold anything, so we let the regex engine find every entry in one pass over the buffer
+TREE_ENTRY_RE = re.compile(rb'([0-7]+) ([^\x00]*)\x00(.{20})', re.DOTALL)
+
+#read tree given SHA1 or data bytes, return list of (mode, path, digest) tuples
+#digest is the raw 20 byte SHA-1, call .hex() on the ones you need as strings
 def read_tree(sha1=None, data=None):
     if sha1 is not None:
         obj_type, data = read_object(sha1)
         assert obj_type == 'tree'
     elif data is None:
         raise TypeError('must specify sha1 or data')
-    i = 0
-    entries = []
-    for _ in range(1000):
-        end = data.find(b'\x00', i)
-        if end == -1:
-            break
-        mode_str, path = data[i:end].decode().split()
-        mode = int(mode_str, 8)
-        digest = data[end + 1:end + 21]
-        entries.append((mode, path, digest.hex()))
-        i = end + 1 + 20
-    return entries
+    found = TREE_ENTRY_RE.findall(data)
+    #findall skips anything that isn't an entry, so if the entries don't add up to the whole buffer it's corrupt
+    if sum(len(mode) + len(path) for mode, path, _ in found) + 22 * len(found) != len(data):
+        raise ValueError('corrupt tree object' + (' ' + sha1 if sha1 else ''))
+    #there's only a handful of different modes, so parse each one once
+    modes = {}
+    return [(modes.get(mode) or modes.setdefault(mode, int(mode, 8)), path.decode(), digest)
+            for mode, path, digest in found]
 
 """
 Second is the commit object itself, this records the tree hash, parent commit,
@@ -430,7 +2199,7 @@ author, timestamp, and commit message. Right now we'll only support a single lin
 
 #Gets current commit hash of local master branch.
 def get_local_master_hash():
-    master_path = os.path.join('.git', 'refs', 'heads', 'master')
+    master_path = git_path('refs', 'heads', 'master')
     try:
         return read_file(master_path).decode().strip()
     except FileNotFoundError:
@@ -460,8 +2229,7 @@ def commit(message, author):
     lines.append('')
     data = '\n'.join(lines).encode()
     sha1 = hash_object(data, 'commit')
-    master_path = os.path.join('.git','refs','heads', 'master')
-    write_file(master_path, (sha1 + '\n').encode())
+    write_ref('refs/heads/master', sha1)
     print('committed to master: {:7}'.format(sha1))
     return sha1
 
@@ -529,96 +2297,890 @@ def build_lines_data(lines):
     result.append(b'0000')
     return b''.join(result)
 
-"""Now that we have a way to unpack and also send data to the server
-we need to implement a basic https request function"""
+"""extract_lines needs the whole response in memory first, which is no good for a big push or fetch response
+that we'd like to act on as it arrives. PktLineReader pulls pkt-lines off a stream one at a time instead.
 
-#Make authenticated http request to given url
-def http_request(url, username, password, data=None):
-    pm = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-    pm.add_password(None, url, username, password)
-    auth = urllib.request.HTTPBasicAuthHandler(pm)
-    opener = urllib.request.build_opener(auth)
+Servers that support side-band-64k can also multiplex the response: every pkt-line starts with a channel
+byte, 1 is the actual data (itself pkt-lines, or pack data when fetching), 2 is progress messages meant for
+the user, and 3 is a fatal error message."""
 
-    req = urllib.request.Request(url, data=data)
-    req.add_header('Content-Type', 'application/x-git-receive-pack-request')
-    req.add_header('Accept', 'application/x-git-receive-pack-result')
+#Build a single pkt-line (same format as build_lines_data, but without the flush at the end)
+def pkt_line(line):
+    return '{:04x}'.format(len(line) + 5).encode() + line + b'\n'
 
-    resp = opener.open(req)
-    body = resp.read()
-    return body
+#Reads pkt-lines one at a time from a stream (anything with a read(size) method), without buffering the whole response
+class PktLineReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = bytearray()
 
+    #Return exactly n bytes, or fewer only if the stream ends
+    def read_exact(self, n):
+        while len(self.buf) < n:
+            data = self.stream.read(max(n - len(self.buf), 65536))
+            if not data:
+                break
+            self.buf += data
+        result = bytes(self.buf[:n])
+        del self.buf[:n]
+        return result
 
-#get commit hash of master branch, return SHA-1 hex or None if no remote commits
-def get_remote_master_hash(git_url, username, password):
-    print(git_url)
-    url = git_url + '/info/refs?service=git-receive-pack'
-    response = http_request(url, username, password)
-    print(response)
-    lines = extract_lines(response)
-    #This ensures we're getting what we're requesting from git
-    assert lines[0] == b'# service=git-receive-pack\n'
-    assert lines[1] == b''
-    if lines[2][:40] == b'0' * 40:
-        return None
-    master_sha1, master_ref = lines[2].split(b'\x00')[0].split()
-    assert master_ref == b'refs/heads/master'
-    assert len(master_sha1) == 40
-    return master_sha1.decode()
+    #Return the payload of the next pkt-line, b'' for a flush, or None at the end of the stream
+    def read_line(self):
+        header = self.read_exact(4)
+        if not header:
+            return None
+        if len(header) < 4:
+            raise ValueError('pkt-line truncated: got {!r}'.format(header))
+        n = int(header, 16)
+        if n == 0:
+            return b''
+        if n < 4:
+            raise ValueError('invalid pkt-line size {}'.format(n))
+        payload = self.read_exact(n - 4)
+        if len(payload) < n - 4:
+            raise ValueError('pkt-line truncated: header says {} bytes, but only {} available'.format(
+                n, len(payload) + 4))
+        return payload
 
+    #Yield the pkt-line payloads up to (not including) the next flush or the end of the stream
+    def iter_lines(self):
+        while True:
+            line = self.read_line()
+            if not line:
+                return
+            yield line
 
-"""Ok, we can talk to the server,
-now we need to determine what the server doesn't already have
-So we will recursively find object hashes in a tree and commit
-so we can compare them to the master branch"""
+    #Yield side-band channel 1 data until a flush, sending channel 2 to progress (a function taking bytes)
+    #and raising ValueError for a channel 3 error
+    def iter_side_band(self, progress=None):
+        for line in self.iter_lines():
+            channel, data = line[0], line[1:]
+            if channel == 1:
+                yield data
+            elif channel == 2:
+                if progress is not None:
+                    progress(data)
+            elif channel == 3:
+                raise ValueError('remote error: {}'.format(data.decode(errors='replace').strip()))
+            else:
+                raise ValueError('unexpected side-band channel {}'.format(channel))
 
-#Return set of SHA-1 hashes of all objects, including the hash of the tree itself
-def find_tree_objects(tree_sha1):
-    objects = {tree_sha1}
-    for mode, path, sha1 in read_tree(sha1=tree_sha1):
-        if stat.S_ISDIR(mode):
-            objects.update(find_tree_objects(sha1))
-        else:
-            objects.add(sha1)
-    return objects
+    #Yield whatever is left of the stream as raw bytes
+    def iter_raw(self):
+        if self.buf:
+            yield bytes(self.buf)
+            self.buf.clear()
+        while True:
+            data = self.stream.read(65536)
+            if not data:
+                return
+            yield data
 
-#Return set of SHA-1 hashes of all objects in this commit, including the hash of the commit itself.
-def find_commit_objects(commit_sha1):
-    objects = {commit_sha1}
-    obj_type, commit = read_object(commit_sha1)
-    assert obj_type == 'commit'
-    lines = commit.decode().splitlines()
-    tree = next(l[5:45] for l in lines if l.startswith('tree '))
-    objects.update(find_tree_objects(tree))
-    parents = (l[7:47] for l in lines if l.startswith('parent '))
-    for parent in parents:
-        objects.update(find_commit_objects(parent))
-    return objects
+#Write server progress messages to stderr as they arrive
+def print_progress(data):
+    sys.stderr.write(data.decode(errors='replace'))
+    sys.stderr.flush()
 
-#Finally a function to determine what objects are missing
+#Wraps an iterable of byte chunks so it can be read like a stream (ex: side-band data fed to a PktLineReader)
+class ChunkStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b''
 
-#return set of SHA-1 hashes of objects in local commit that aren't at remote
-def find_missing_objects(local_sha1, remote_sha1):
-    local_objects = find_commit_objects(local_sha1)
-    #remote is empty, so it's everything in our directory
-    if remote_sha1 is None:
-        return local_objects
-    remote_objects = find_commit_objects(remote_sha1)
-    return local_objects - remote_objects
+    def read(self, size=-1):
+        if not self.buf:
+            self.buf = next(self.chunks, b'')
+        if size < 0:
+            data = self.buf + b''.join(self.chunks)
+            self.buf = b''
+            return data
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
 
-"""Now we can handle pushing
-we need to send a pkt-line which says to update the master branch to this commit hash
-then a pack file containing the content of all the missing objects we found with find_missing_objects
+#Parse report-status lines from receive-pack, return (unpack status, dict of ref -> None if ok or the error message)
+def parse_report_status(lines):
+    unpack_status = None
+    results = collections.OrderedDict()
+    for line in lines:
+        line = line.decode().rstrip('\n')
+        if line.startswith('unpack '):
+            unpack_status = line[len('unpack '):]
+        elif line.startswith('ok '):
+            results[line[3:]] = None
+        elif line.startswith('ng '):
+            ref, _, reason = line[3:].partition(' ')
+            results[ref] = reason
+    return unpack_status, results
 
-So what's a pack file?
-it has a 12-byte header starting with PACK then each object is encoded with a variable-length size
-then compressed using zlib, and finally a 20-byte hash of the entire pack file. Note that you can 
-make the pack file size even smaller based on changes between objects, but that's something we may round back to"""
+"""Now that we have a way to unpack and also send data to the server
+we need to implement a basic https request function
 
-#encodes a single object for a pack file and returns the bytes
-def encode_pack_object(obj):
-    obj_type, data = read_object(obj)
-    type_num = ObjectType[obj_type].value
-    size = len(data)
+A push is (at least) two requests to the same server, and building a fresh urllib opener for each one
+means a new connection (and TLS handshake) every time, plus a 401 round trip before the credentials get
+sent. So HttpSession keeps connections open between requests (one pool per host), sends Basic auth with
+the first request, and asks for gzip'd responses."""
+
+#Return (scheme, host, port) of url, with the scheme's default port filled in
+def get_url_origin(url):
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    return scheme, (parts.hostname or '').lower(), parts.port or {'http': 80, 'https': 443}.get(scheme)
+
+#A reusable, thread safe set of keep-alive http(s) connections that authenticate with Basic auth
+class HttpSession:
+    def __init__(self, username=None, password=None, timeout=60):
+        self.headers = {'Accept-Encoding': 'gzip', 'User-Agent': 'gitpy'}
+        if username is not None:
+            credentials = '{}:{}'.format(username, password or '').encode()
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode()
+        self.timeout = timeout
+        #(scheme, host) -> list of idle connections
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #Close every idle connection
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+    #Return (connection, True if it's an idle one from the pool), fresh skips the pool
+    def _connect(self, key, fresh=False):
+        with self.lock:
+            if self.idle[key] and not fresh:
+                return self.idle[key].pop(), True
+        scheme, host = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout,
+                                               context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    #Put a connection whose response has been read to the end back in the pool
+    def release(self, key, connection):
+        with self.lock:
+            self.idle[key].append(connection)
+
+    #Make a request and return an HttpResponse to read the (decompressed) body from.
+    #data can be bytes or an iterable of bytes, which gets sent with chunked transfer encoding as it's produced
+    def open(self, url, data=None, content_type=None, accept=None):
+        origin = get_url_origin(url)
+        for _ in range(5):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            headers = dict(self.headers)
+            #the credentials are for the server we were asked to talk to, not wherever it redirects us
+            if get_url_origin(url) != origin:
+                headers.pop('Authorization', None)
+            if content_type:
+                headers['Content-Type'] = content_type
+            if accept:
+                headers['Accept'] = accept
+            replayable = data is None or isinstance(data, bytes)
+            if not replayable:
+                headers['Transfer-Encoding'] = 'chunked'
+            method = 'GET' if data is None else 'POST'
+            #a streamed body can't be sent again, so don't risk it on an idle connection the server may have
+            #timed out while we were building it
+            connection, reused = self._connect(key, fresh=not replayable)
+            try:
+                connection.request(method, path, body=data, headers=headers,
+                                   encode_chunked=not replayable)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not (reused and replayable):
+                    raise
+                #the server closed an idle connection on us, try once more on a fresh one
+                connection, _ = self._connect(key, fresh=True)
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308) and replayable:
+                response.read()
+                connection.close()
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                body = response.read()
+                connection.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                             io.BytesIO(body))
+            return HttpResponse(self, key, connection, response)
+        raise ValueError('too many redirects for {}'.format(url))
+
+    #Make a request and return the whole (decompressed) response body
+    def request(self, url, data=None, content_type=None, accept=None):
+        with self.open(url, data, content_type, accept) as response:
+            return response.read()
+
+#Response body from an HttpSession, gunzipped if needed. The connection goes back to the pool once it's read
+class HttpResponse:
+    def __init__(self, session, key, connection, response):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.headers = response.headers
+        self.decompressor = None
+        if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.done = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #Read up to size bytes of body (-1 for all of it), returns b'' at the end
+    def read(self, size=-1):
+        if self.done:
+            return b''
+        if self.decompressor is None:
+            data = self.response.read() if size < 0 else self.response.read1(size)
+        else:
+            data = b''
+            #a chunk of compressed input can decompress to nothing, keep going until we have something
+            while not data:
+                raw = self.response.read() if size < 0 else self.response.read1(size)
+                if not raw:
+                    data = self.decompressor.flush()
+                    break
+                data = self.decompressor.decompress(raw)
+        if size < 0 or not data:
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        #read1 can hit the end of a Content-Length body without marking the response closed
+        complete = self.response.isclosed() or self.response.length == 0
+        if complete and not self.response.will_close:
+            self.response.close()
+            self.session.release(self.key, self.connection)
+        else:
+            self.connection.close()
+
+    #Stop reading, if the body wasn't read to the end the connection can't be reused
+    def close(self):
+        self._finish()
+
+#Make authenticated http request to given url
+#data can be bytes or an iterable of bytes, which gets sent with chunked transfer encoding as it's produced
+#pass an HttpSession to reuse its connections, otherwise a one-off session is used
+def http_request(url, username, password, data=None, session=None):
+    content_type = 'application/x-git-receive-pack-request'
+    accept = 'application/x-git-receive-pack-result'
+    if session is not None:
+        return session.request(url, data, content_type, accept)
+    with HttpSession(username, password) as session:
+        return session.request(url, data, content_type, accept)
+
+#Parse a ref advertisement (list of lines from extract_lines), return tuple of (dict of ref name -> sha1, list of capabilities)
+def parse_ref_advertisement(lines):
+    lines = list(lines)
+    #over http the refs come after a "# service=..." line and a flush
+    if lines and lines[0].startswith(b'# service='):
+        assert lines[1] == b'', 'expected flush after service line, got {!r}'.format(lines[1])
+        lines = lines[2:]
+    refs = collections.OrderedDict()
+    capabilities = []
+    for i, line in enumerate(lines):
+        if not line:
+            break
+        if i == 0 and b'\x00' in line:
+            line, caps = line.split(b'\x00', 1)
+            capabilities = caps.decode().split()
+        sha1, name = line.decode().strip().split(' ', 1)
+        #an empty repository advertises its capabilities on a fake ref
+        if name == 'capabilities^{}':
+            continue
+        refs[name] = sha1
+    return refs, capabilities
+
+#Return (dict of ref name -> sha1, list of capabilities) for the given service (git-upload-pack or git-receive-pack)
+def get_remote_refs(git_url, service, session):
+    url = git_url + '/info/refs?service=' + service
+    return parse_info_refs(session.request(url), service)
+
+#Parse the body of an info/refs response for service, return (dict of ref name -> sha1, list of capabilities)
+def parse_info_refs(response, service):
+    lines = extract_lines(response)
+    assert lines[0] == '# service={}\n'.format(service).encode(), \
+        'unexpected service line {!r}'.format(lines[0])
+    return parse_ref_advertisement(lines)
+
+#get commit hash of master branch, return SHA-1 hex or None if no remote commits
+def get_remote_master_hash(git_url, username, password, session=None):
+    if session is None:
+        with HttpSession(username, password) as session:
+            refs, _ = get_remote_refs(git_url, 'git-receive-pack', session)
+    else:
+        refs, _ = get_remote_refs(git_url, 'git-receive-pack', session)
+    return refs.get('refs/heads/master')
+
+
+"""Ok, we can talk to the server,
+now we need to determine what the server doesn't already have
+So we will find object hashes in a tree and commit
+so we can compare them to the master branch
+
+These walk with an explicit stack instead of recursing, a long history would otherwise blow
+python's recursion limit (one stack frame per commit)."""
+
+#Parse commit with given sha1, return tuple of (tree sha1, list of parent sha1s, committer timestamp)
+#(answered from the commit-graph file when the commit is in it, so the commit doesn't need inflating)
+def read_commit(commit_sha1):
+    graph = get_commit_graph()
+    if graph is not None:
+        found = graph.find(commit_sha1)
+        if found is not None:
+            return found[:3]
+    obj_type, commit = read_object(commit_sha1)
+    assert obj_type == 'commit'
+    tree = None
+    parents = []
+    timestamp = 0
+    for line in commit.split(b'\n'):
+        if not line:
+            #a blank line ends the headers, everything after is the message
+            break
+        if line.startswith(b'tree '):
+            tree = line[5:45].decode()
+        elif line.startswith(b'parent '):
+            parents.append(line[7:47].decode())
+        elif line.startswith(b'committer '):
+            timestamp = int(line.rsplit(b' ', 2)[1])
+    return tree, parents, timestamp
+
+#Follow annotated tags from sha1 down to what they point at, return (sha1 of the commit (or other object), list of tag sha1s)
+def peel_tag(sha1):
+    tags = []
+    while True:
+        obj_type, _ = read_object_header(sha1)
+        if obj_type != 'tag':
+            return sha1, tags
+        tags.append(sha1)
+        _, data = read_object(sha1)
+        sha1 = next(l[7:47] for l in data.decode().splitlines() if l.startswith('object '))
+
+#Return the commit sha1 points at (following annotated tags), or None if it's missing or not a commit
+#(ex: a tag of a tree or a blob)
+def peel_to_commit(sha1):
+    try:
+        sha1, _ = peel_tag(sha1)
+        obj_type, _ = read_object_header(sha1)
+    except ValueError:
+        return None
+    return sha1 if obj_type == 'commit' else None
+
+#Return a list of sha1s given a single sha1, None, or an iterable of sha1s
+def as_sha1_list(sha1s):
+    if sha1s is None:
+        return []
+    if isinstance(sha1s, str):
+        return [sha1s]
+    return list(sha1s)
+
+#Return set of SHA-1 hashes of all objects, including the hash of the tree itself
+#if paths is a dict, it's filled with sha1 -> path of each object (used to find good delta bases in create_pack)
+def find_tree_objects(tree_sha1, paths=None, prefix=''):
+    objects = {tree_sha1}
+    walk_tree_objects(tree_sha1, objects, objects, paths, prefix)
+    return objects
+
+#Add every object below tree_sha1 that isn't in have to found, without descending into trees in have or seen.
+#Trees visited get added to seen, so a shared subtree is only ever read once per walk
+def walk_tree_objects(tree_sha1, found, seen, paths=None, prefix='', have=()):
+    stack = [(tree_sha1, prefix)]
+    while stack:
+        sha1, prefix = stack.pop()
+        for mode, path, digest in read_tree(sha1=sha1):
+            entry_sha1 = digest.hex()
+            if entry_sha1 in have:
+                continue
+            if paths is not None:
+                paths.setdefault(entry_sha1, prefix + path)
+            if stat.S_ISDIR(mode):
+                if entry_sha1 not in seen:
+                    seen.add(entry_sha1)
+                    found.add(entry_sha1)
+                    stack.append((entry_sha1, prefix + path + '/'))
+            else:
+                found.add(entry_sha1)
+
+#Return set of SHA-1 hashes of all objects in this commit, including the hash of the commit itself.
+def find_commit_objects(commit_sha1, paths=None):
+    objects = set()
+    seen_trees = set()
+    stack = [commit_sha1]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in objects:
+            continue
+        objects.add(sha1)
+        tree, parents, _ = read_commit(sha1)
+        if tree not in seen_trees:
+            seen_trees.add(tree)
+            objects.add(tree)
+            walk_tree_objects(tree, objects, seen_trees, paths)
+        stack.extend(parents)
+    return objects
+
+"""Walking the whole local and remote history on every push means a push of one commit costs as much as
+pushing the whole repository. Like git, we instead walk commits newest first from both tips at once, marking
+everything reachable from the remote tip as "uninteresting", and stop as soon as only uninteresting commits
+are left to look at. The remote has the trees of the uninteresting commits right next to our new ones (the
+boundary), so those make up the "have" set and we never descend into a subtree that's in it.
+
+On top of that, after a successful push we know the remote has everything in the have set plus everything
+we just sent, so we save that as a sorted list of binary sha1s in .git/reachable-cache along with the tip it
+belongs to. The next push from that tip can then binary search the (mmapped) file instead of walking the
+boundary trees at all."""
+
+#Walk commits newest first from local_sha1, stopping at history reachable from remote_sha1
+#(either can also be a list of sha1s, when pushing several refs at once).
+#Return (list of commits not reachable from remote, set of remote commits bordering them,
+#True if every remote tip is an ancestor of the local ones)
+def walk_new_commits(local_sha1, remote_sha1):
+    local_sha1s = as_sha1_list(local_sha1)
+    remote_sha1s = as_sha1_list(remote_sha1)
+    #sha1 -> (tree, parents, timestamp) for every commit we've read
+    commits = {}
+    uninteresting = set()
+    queued = set()
+    heap = []
+    #how many queued commits are still interesting, once that hits 0 the rest of history is already at the remote
+    interesting_queued = 0
+    graph = get_commit_graph()
+    #Mark sha1 uninteresting, and if it (or anything below it) was already taken as new, its ancestors too
+    def mark_uninteresting(sha1):
+        nonlocal interesting_queued
+        stack = [sha1]
+        while stack:
+            sha1 = stack.pop()
+            if sha1 in uninteresting:
+                continue
+            uninteresting.add(sha1)
+            if sha1 in queued:
+                #still waiting its turn, it'll pass the mark on to its parents when it comes off the heap
+                interesting_queued -= 1
+            elif sha1 in commits:
+                stack.extend(commits[sha1][1])
+    def enqueue(sha1, is_uninteresting):
+        nonlocal interesting_queued
+        if is_uninteresting:
+            mark_uninteresting(sha1)
+        if sha1 in queued or sha1 in commits:
+            return
+        try:
+            commits[sha1] = read_commit(sha1)
+        except ValueError:
+            #the remote has a commit we don't, nothing to exclude along this line
+            return
+        queued.add(sha1)
+        if sha1 not in uninteresting:
+            interesting_queued += 1
+        #order by generation number first when the commit-graph knows it: a commit always has a lower
+        #generation than its children, so unlike timestamps it can't be thrown off by a skewed clock
+        generation = graph.generation(sha1) if graph is not None else None
+        if generation is None:
+            generation = GENERATION_INFINITY
+        heapq.heappush(heap, (-generation, -commits[sha1][2], sha1))
+    for sha1 in local_sha1s:
+        enqueue(sha1, False)
+    for sha1 in remote_sha1s:
+        enqueue(sha1, True)
+    new_commits = []
+    while heap and interesting_queued:
+        sha1 = heapq.heappop(heap)[-1]
+        queued.discard(sha1)
+        is_uninteresting = sha1 in uninteresting
+        if not is_uninteresting:
+            interesting_queued -= 1
+            new_commits.append(sha1)
+        for parent in commits[sha1][1]:
+            enqueue(parent, is_uninteresting)
+    #a commit (and its ancestors) can be marked uninteresting after we already took it as new (clock skew),
+    #so filter again
+    new_commits = [c for c in new_commits if c not in uninteresting]
+    boundary = {p for c in new_commits for p in commits[c][1] if p in uninteresting}
+    boundary.update(sha1 for sha1 in remote_sha1s if sha1 in commits)
+    #if a remote tip is an ancestor of ours, it has to be the parent of one of our new commits
+    #(and with nothing new there's nothing to rewind)
+    new_parents = {p for c in new_commits for p in commits[c][1]}
+    fast_forward = not new_commits or all(sha1 in new_parents for sha1 in remote_sha1s)
+    return new_commits, boundary, fast_forward
+
+#A sorted list of binary sha1s of objects known to be at the remote, mmapped from .git/reachable-cache
+class ReachabilityCache:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, tip, self.count = struct.unpack_from('!4sL20sL', self.map, 0)
+        assert magic == b'RCHB', 'invalid reachability cache signature {}'.format(magic)
+        assert version == 1, 'unknown reachability cache version {}'.format(version)
+        self.tip = tip.hex()
+        self.start = struct.calcsize('!4sL20sL')
+
+    def close(self):
+        self.map.close()
+
+    def __contains__(self, sha1):
+        sha1 = bytes.fromhex(sha1)
+        lo = bisect_sha1(self.map, self.start, 0, self.count, sha1)
+        pos = self.start + lo * 20
+        return lo < self.count and self.map[pos:pos + 20] == sha1
+
+    #Yield every binary sha1 in the cache, in sorted order
+    def __iter__(self):
+        for n in range(self.count):
+            pos = self.start + n * 20
+            yield self.map[pos:pos + 20]
+
+#Return the ReachabilityCache for tip_sha1, or None if the cache doesn't exist or belongs to another tip
+def load_reachability_cache(tip_sha1):
+    try:
+        cache = ReachabilityCache(git_path('reachable-cache'))
+    except (FileNotFoundError, ValueError):
+        return None
+    if cache.tip != tip_sha1:
+        cache.close()
+        return None
+    return cache
+
+#Save have (a set of hex sha1s or a ReachabilityCache) plus objects as everything reachable-at-remote for tip_sha1
+def save_reachability_cache(tip_sha1, have, objects):
+    if isinstance(have, ReachabilityCache):
+        old = iter(have)
+    else:
+        old = (bytes.fromhex(sha1) for sha1 in sorted(have))
+    new = (bytes.fromhex(sha1) for sha1 in sorted(objects))
+    path = git_path('reachable-cache')
+    tmp_path = path + '.tmp' + unique_suffix()
+    count = 0
+    last = None
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('!4sL20sL', b'RCHB', 1, bytes.fromhex(tip_sha1), 0))
+        for sha1 in heapq.merge(old, new):
+            if sha1 != last:
+                f.write(sha1)
+                count += 1
+                last = sha1
+        f.seek(0)
+        f.write(struct.pack('!4sL20sL', b'RCHB', 1, bytes.fromhex(tip_sha1), count))
+    if isinstance(have, ReachabilityCache):
+        have.close()
+    os.replace(tmp_path, path)
+
+#return (set of SHA-1 hashes of objects in local commit that aren't at remote,
+#the set/cache of objects we know the remote has, True if the push is a fast-forward)
+#local_sha1 and remote_sha1 can also be lists, to find what's missing for several refs at once
+def walk_missing_objects(local_sha1, remote_sha1, paths=None):
+    #tags aren't commits, so walk from what they point at (and send the tag objects themselves)
+    local_tips = []
+    tags = set()
+    for sha1 in as_sha1_list(local_sha1):
+        tip, tag_sha1s = peel_tag(sha1)
+        local_tips.append(tip)
+        tags.update(tag_sha1s)
+    #the remote can have tips we've never seen, those we can't walk from (and don't need to)
+    remote_tips = []
+    remote_tags = set()
+    for sha1 in as_sha1_list(remote_sha1):
+        if has_object(sha1):
+            tip, tag_sha1s = peel_tag(sha1)
+            remote_tips.append(tip)
+            remote_tags.update(tag_sha1s)
+    new_commits, boundary, fast_forward = walk_new_commits(local_tips, remote_tips)
+    have = None
+    if isinstance(remote_sha1, str):
+        have = load_reachability_cache(remote_sha1)
+    if have is None:
+        have = set()
+        seen = set()
+        for sha1 in boundary:
+            tree = read_commit(sha1)[0]
+            have.add(sha1)
+            if tree not in have:
+                have.add(tree)
+                walk_tree_objects(tree, have, seen)
+    missing = set(new_commits)
+    seen = set()
+    for sha1 in new_commits:
+        tree = read_commit(sha1)[0]
+        if tree in have or tree in seen:
+            continue
+        seen.add(tree)
+        missing.add(tree)
+        walk_tree_objects(tree, missing, seen, paths, have=have)
+    missing.update(tags - remote_tags)
+    return missing, have, fast_forward
+
+#Finally a function to determine what objects are missing
+
+#return set of SHA-1 hashes of objects in local commit that aren't at remote
+def find_missing_objects(local_sha1, remote_sha1, paths=None):
+    missing, have, _ = walk_missing_objects(local_sha1, remote_sha1, paths)
+    if isinstance(have, ReachabilityCache):
+        have.close()
+    return missing
+
+"""Commit graph
+Even without inflating trees, walking history still means inflating and parsing every commit just to get its
+tree and parents. git's commit-graph file (.git/objects/info/commit-graph) stores exactly that for every commit
+in a compact binary table, so we write the same format:
+    a header: CGPH, version 1, hash version 1 (sha1), number of chunks, number of base graphs (0)
+    a table of contents: a 4 byte id and 8 byte offset for each chunk, then a 0 id with the end offset
+    OIDF: a 256 entry fanout table, just like a pack .idx
+    OIDL: every commit's sha1, sorted
+    CDAT: for each commit, its tree's sha1, the positions of its first two parents (0x70000000 for none,
+          0x80000000 | n pointing into EDGE for more than two), then the generation number (upper 30 bits)
+          and commit time (lower 34 bits) in 8 bytes
+    EDGE: positions of the 2nd onwards parents of octopus merges, the last one flagged with 0x80000000
+    the sha1 of everything before it
+
+The generation number is 1 for a root commit and 1 more than the biggest of its parents otherwise. That means
+a commit can only be an ancestor of commits with bigger generations, which lets is_ancestor stop early."""
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+#generation used for commits that aren't in the commit-graph (they're newer than everything in it)
+GENERATION_INFINITY = 0xFFFFFFFF
+
+#A memory mapped commit-graph file
+class CommitGraph:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, hash_version, num_chunks, _ = struct.unpack_from('!4sBBBB', self.map, 0)
+        assert signature == b'CGPH', 'invalid commit-graph signature {}'.format(signature)
+        assert version == 1, 'unknown commit-graph version {}'.format(version)
+        assert hash_version == 1, 'unknown commit-graph hash version {}'.format(hash_version)
+        self.chunks = {}
+        for n in range(num_chunks):
+            chunk_id, offset = struct.unpack_from('!4sQ', self.map, 8 + n * 12)
+            self.chunks[chunk_id] = offset
+        self.fanout = struct.unpack_from('!256L', self.map, self.chunks[b'OIDF'])
+        self.count = self.fanout[255]
+
+    def close(self):
+        self.map.close()
+
+    #Return binary sha1 of the commit at position n
+    def sha1_at(self, n):
+        start = self.chunks[b'OIDL'] + n * 20
+        return self.map[start:start + 20]
+
+    #Return position of commit with hex sha1 in the graph, or None
+    def position(self, sha1):
+        sha1 = bytes.fromhex(sha1)
+        first = sha1[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        n = bisect_sha1(self.map, self.chunks[b'OIDL'], lo, hi, sha1)
+        if n < hi and self.sha1_at(n) == sha1:
+            return n
+        return None
+
+    #Return (tree sha1, list of parent sha1s, commit time, generation) of commit at position n
+    def commit_at(self, n):
+        tree, parent1, parent2, gen_time, time_low = struct.unpack_from(
+            '!20sLLLL', self.map, self.chunks[b'CDAT'] + n * 36)
+        parents = []
+        if parent1 != GRAPH_PARENT_NONE:
+            parents.append(self.sha1_at(parent1).hex())
+        if parent2 & GRAPH_EXTRA_EDGES:
+            edge = self.chunks[b'EDGE'] + (parent2 & 0x7fffffff) * 4
+            while True:
+                position, = struct.unpack_from('!L', self.map, edge)
+                parents.append(self.sha1_at(position & 0x7fffffff).hex())
+                if position & GRAPH_LAST_EDGE:
+                    break
+                edge += 4
+        elif parent2 != GRAPH_PARENT_NONE:
+            parents.append(self.sha1_at(parent2).hex())
+        timestamp = ((gen_time & 3) << 32) | time_low
+        return tree.hex(), parents, timestamp, gen_time >> 2
+
+    #Return (tree sha1, list of parent sha1s, commit time, generation) of commit with hex sha1, or None
+    def find(self, sha1):
+        n = self.position(sha1)
+        if n is None:
+            return None
+        return self.commit_at(n)
+
+    #Return generation number of commit with hex sha1, or None if it isn't in the graph
+    def generation(self, sha1):
+        n = self.position(sha1)
+        if n is None:
+            return None
+        gen_time, = struct.unpack_from('!L', self.map, self.chunks[b'CDAT'] + n * 36 + 28)
+        return gen_time >> 2
+
+#Return the CommitGraph for this repo (or None if there isn't one), re-opening it only when the file changes
+def get_commit_graph():
+    repository = get_repository()
+    path = git_path('objects', 'info', 'commit-graph')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    with repository.cache_lock:
+        if mtime != repository.commit_graph_mtime or (mtime is not None and repository.commit_graph is None):
+            #another thread could still be reading the old one, so leave closing it to the garbage collector
+            repository.commit_graph = CommitGraph(path) if mtime is not None else None
+            repository.commit_graph_mtime = mtime
+        return repository.commit_graph
+
+#Return dict of ref name -> sha1 for every ref under .git/refs (and in .git/packed-refs, if real git made one)
+def read_local_refs():
+    refs = {}
+    try:
+        for line in read_file(git_path('packed-refs')).decode().splitlines():
+            if line and line[0] not in '#^':
+                sha1, name = line.split(' ', 1)
+                refs[name] = sha1
+    except FileNotFoundError:
+        pass
+    git_dir = get_repository().git_dir
+    for root, dirs, files in os.walk(git_path('refs')):
+        for file in files:
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, git_dir).replace('\\', '/')
+            refs[name] = read_file(path).decode().strip()
+    return refs
+
+#Write .git/objects/info/commit-graph covering every commit reachable from the local refs, return number of commits
+def write_commit_graph():
+    commits = {}
+    #tags can point at tag objects (or trees and blobs), only the commits they lead to belong in the graph
+    stack = [sha1 for sha1 in map(peel_to_commit, set(read_local_refs().values())) if sha1 is not None]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in commits:
+            continue
+        commits[sha1] = read_commit(sha1)
+        stack.extend(commits[sha1][1])
+    order = sorted(commits)
+    positions = {sha1: n for n, sha1 in enumerate(order)}
+    #generation numbers, computed children-last without recursing
+    generations = {}
+    for start in order:
+        stack = [start]
+        while stack:
+            sha1 = stack[-1]
+            if sha1 in generations:
+                stack.pop()
+                continue
+            pending = [p for p in commits[sha1][1] if p not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            generations[sha1] = 1 + max((generations[p] for p in commits[sha1][1]), default=0)
+            stack.pop()
+    fanout = [0] * 256
+    for sha1 in order:
+        fanout[int(sha1[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    cdat = []
+    edges = []
+    for sha1 in order:
+        tree, parents, timestamp = commits[sha1]
+        parent_positions = [positions[p] for p in parents]
+        parent1 = parent_positions[0] if parent_positions else GRAPH_PARENT_NONE
+        if len(parent_positions) > 2:
+            parent2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(parent_positions[1:-1])
+            edges.append(GRAPH_LAST_EDGE | parent_positions[-1])
+        elif len(parent_positions) == 2:
+            parent2 = parent_positions[1]
+        else:
+            parent2 = GRAPH_PARENT_NONE
+        gen_time = (min(generations[sha1], 0x3FFFFFFF) << 2) | ((timestamp >> 32) & 3)
+        cdat.append(struct.pack('!20sLLLL', bytes.fromhex(tree), parent1, parent2,
+                                gen_time, timestamp & 0xFFFFFFFF))
+    chunks = [
+        (b'OIDF', struct.pack('!256L', *fanout)),
+        (b'OIDL', b''.join(bytes.fromhex(sha1) for sha1 in order)),
+        (b'CDAT', b''.join(cdat)),
+    ]
+    if edges:
+        chunks.append((b'EDGE', struct.pack('!{}L'.format(len(edges)), *edges)))
+    parts = [struct.pack('!4sBBBB', b'CGPH', 1, 1, len(chunks), 0)]
+    offset = 8 + (len(chunks) + 1) * 12
+    for chunk_id, chunk in chunks:
+        parts.append(struct.pack('!4sQ', chunk_id, offset))
+        offset += len(chunk)
+    parts.append(struct.pack('!4sQ', b'\x00' * 4, offset))
+    parts.extend(chunk for _, chunk in chunks)
+    data = b''.join(parts)
+    info_dir = git_path('objects', 'info')
+    os.makedirs(info_dir, exist_ok=True)
+    path = os.path.join(info_dir, 'commit-graph')
+    tmp_path = path + '.tmp' + unique_suffix()
+    write_file(tmp_path, data + hashlib.sha1(data).digest())
+    os.replace(tmp_path, path)
+    return len(order)
+
+#Return True if commit ancestor_sha1 is reachable from (or the same as) descendant_sha1
+def is_ancestor(ancestor_sha1, descendant_sha1):
+    graph = get_commit_graph()
+    min_generation = graph.generation(ancestor_sha1) if graph is not None else None
+    seen = set()
+    stack = [descendant_sha1]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 == ancestor_sha1:
+            return True
+        if sha1 in seen:
+            continue
+        seen.add(sha1)
+        if min_generation is not None:
+            generation = graph.generation(sha1)
+            #anything at or below the ancestor's generation (other than the ancestor itself) can't reach it
+            if generation is not None and generation <= min_generation:
+                continue
+        stack.extend(read_commit(sha1)[1])
+    return False
+
+"""Now we can handle pushing
+we need to send a pkt-line which says to update the master branch to this commit hash
+then a pack file containing the content of all the missing objects we found with find_missing_objects
+
+So what's a pack file?
+it has a 12-byte header starting with PACK then each object is encoded with a variable-length size
+then compressed using zlib, and finally a 20-byte hash of the entire pack file.
+
+We can make the pack much smaller based on changes between objects: instead of a whole object we can send a
+delta, instructions for rebuilding it from another object that's earlier in the pack. An OFS_DELTA says how
+many bytes back its base starts (a REF_DELTA names it by sha1 instead, which is what we send to a server that
+doesn't advertise the ofs-delta capability). The delta itself is the base's size and the result's size (same
+varint format as below), then a list of "copy this range of the base" and "insert these literal bytes" instructions.
+
+Finding good bases is the hard part. Like git, we sort objects by type, then a hash of their path that groups
+files with the same name together, then biggest first, and try each object against the last `window` objects
+before it. A delta is only kept if it's a decent bit smaller than the object, and chains of deltas are limited
+to `depth` so reading an object back doesn't mean applying hundreds of deltas."""
+
+DELTA_BLOCK_SIZE = 16
+
+#Encode a pack object header (type and variable length size) and return the bytes
+def encode_pack_object_header(type_num, size):
     byte = (type_num << 4) | (size & 0x0f)
     size >>= 4
     header = []
@@ -627,53 +3189,1738 @@ def encode_pack_object(obj):
         byte = size & 0x7f
         size >>= 7
     header.append(byte)
-    return bytes(header) + zlib.compress(data)
+    return bytes(header)
 
-#Create pack file by encoding all objects an concatinating them, return bytes of the full pack file
-def create_pack(objects):
+#encodes a single object for a pack file and returns the bytes
+def encode_pack_object(obj):
+    obj_type, data = read_object(obj)
+    type_num = ObjectType[obj_type].value
+    return encode_pack_object_header(type_num, len(data)) + zlib.compress(data)
+
+#Encode an OFS_DELTA entry whose base starts distance bytes before it, return the bytes
+def encode_ofs_delta(delta, distance):
+    return (encode_pack_object_header(OFS_DELTA, len(delta)) +
+            encode_ofs_delta_offset(distance) + zlib.compress(delta))
+
+#Encode a REF_DELTA entry against the base with given hex sha1, for servers that don't understand OFS_DELTA
+def encode_ref_delta(delta, base_sha1):
+    return (encode_pack_object_header(REF_DELTA, len(delta)) +
+            bytes.fromhex(base_sha1) + zlib.compress(delta))
+
+#Encode the negative offset of an OFS_DELTA (7 bits per byte, most significant first, each continuation adding one)
+#index version 4 uses the same encoding for its path prefix lengths
+def encode_ofs_delta_offset(distance):
+    offset_bytes = [distance & 0x7f]
+    distance >>= 7
+    while distance:
+        distance -= 1
+        offset_bytes.append(0x80 | (distance & 0x7f))
+        distance >>= 7
+    return bytes(reversed(offset_bytes))
+
+#Encode a size for a delta header (7 bits per byte, least significant first)
+def encode_delta_size(size):
+    result = []
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if size:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+#Index every DELTA_BLOCK_SIZE block of source by its bytes, return dict of block -> offset
+def build_delta_index(source):
+    index = {}
+    for i in range(0, len(source) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        index.setdefault(source[i:i + DELTA_BLOCK_SIZE], i)
+    return index
+
+#Return how many bytes match going forward from a[ai] and b[bi]
+def match_length(a, ai, b, bi):
+    length = 0
+    step = 4096
+    #compare big slices first, then narrow down, so long matches don't cost a python loop per byte
+    while step:
+        while ai + length + step <= len(a) and bi + length + step <= len(b) and \
+                a[ai + length:ai + length + step] == b[bi + length:bi + length + step]:
+            length += step
+        step //= 2
+    return length
+
+#Create a delta that turns source into target, return the delta bytes or None if it would be bigger than max_size
+def create_delta(source, target, source_index=None, max_size=None):
+    if source_index is None:
+        source_index = build_delta_index(source)
+    out = bytearray(encode_delta_size(len(source)) + encode_delta_size(len(target)))
+    if max_size is None:
+        max_size = len(target) * 2 + len(out) + 1
+    literal_start = 0
+    i = 0
+    end = len(target) - DELTA_BLOCK_SIZE
+    find = source_index.get
+    #once the pending literal alone would make the delta too big there's no point looking any further,
+    #which is what stops us crawling through the whole of a target that has nothing in common with source
+    give_up = max_size - len(out)
+    while i <= end:
+        offset = find(target[i:i + DELTA_BLOCK_SIZE])
+        if offset is None:
+            i += 1
+            if i > give_up:
+                return None
+            continue
+        length = match_length(source, offset, target, i)
+        #the match might start earlier than the block we found it by, steal those bytes back from the literal
+        while i > literal_start and offset > 0 and source[offset - 1] == target[i - 1]:
+            i -= 1
+            offset -= 1
+            length += 1
+        append_delta_insert(out, target, literal_start, i)
+        append_delta_copy(out, offset, length)
+        i += length
+        literal_start = i
+        if len(out) > max_size:
+            return None
+        give_up = literal_start + max_size - len(out)
+    append_delta_insert(out, target, literal_start, len(target))
+    if len(out) > max_size:
+        return None
+    return bytes(out)
+
+#Append insert instructions for target[start:end] to out (at most 127 bytes per instruction)
+def append_delta_insert(out, target, start, end):
+    while start < end:
+        n = min(end - start, 0x7f)
+        out.append(n)
+        out += target[start:start + n]
+        start += n
+
+#Append copy instructions for source[offset:offset + length] to out (at most 64KB per instruction)
+def append_delta_copy(out, offset, length):
+    while length:
+        n = min(length, 0x10000)
+        op = 0x80
+        args = bytearray()
+        for shift in range(4):
+            byte = (offset >> (shift * 8)) & 0xff
+            if byte:
+                op |= 1 << shift
+                args.append(byte)
+        #a size of 0x10000 is encoded as no size bytes at all
+        size = n if n != 0x10000 else 0
+        for shift in range(3):
+            byte = (size >> (shift * 8)) & 0xff
+            if byte:
+                op |= 0x10 << shift
+                args.append(byte)
+        out.append(op)
+        out += args
+        offset += n
+        length -= n
+
+#git's path hash, weighted towards the last characters of the path so files with the same name sort together
+def pack_name_hash(path):
+    name_hash = 0
+    for c in path.encode():
+        if c in b' \t\n\r':
+            continue
+        name_hash = (name_hash >> 2) + (c << 24)
+    return name_hash & 0xFFFFFFFF
+
+#One object in the delta search window
+DeltaCandidate = collections.namedtuple('DeltaCandidate', ['sha1', 'obj_type', 'data', 'depth', 'offset'])
+
+#Yield the encoded bytes of each object in pack order, delta compressing against a window of earlier objects.
+#offset is where the first object will land in the pack. paths maps sha1 -> path (used to group similar objects),
+#and if stats is a dict it gets filled with the number of deltas, how many bytes smaller they are than the objects
+#before zlib (raw_bytes_saved) and the total size of the encoded objects (pack_bytes).
+#ofs_delta=False refers to bases by sha1 (REF_DELTA) instead of by offset, for a server that doesn't advertise the
+#ofs-delta capability
+def encode_pack_objects(objects, window=10, depth=50, paths=None, stats=None, offset=12, ofs_delta=True):
+    paths = paths or {}
+    if stats is not None:
+        stats.update(objects=0, deltas=0, raw_bytes_saved=0, pack_bytes=0)
+    order = []
+    for sha1 in objects:
+        obj_type, size = read_object_header(sha1)
+        order.append((ObjectType[obj_type].value, pack_name_hash(paths.get(sha1, '')), -size, sha1))
+    order.sort()
+    candidates = collections.deque(maxlen=window) if window > 0 else None
+    delta_indexes = {}
+    for type_num, _, _, sha1 in order:
+        obj_type, data = read_object(sha1)
+        best = None
+        obj_depth = 0
+        if candidates is not None and len(data) >= 64:
+            max_size = len(data) // 2 - 20
+            for base in candidates:
+                if base.obj_type != obj_type or base.depth >= depth:
+                    continue
+                if abs(len(base.data) - len(data)) >= max_size or len(base.data) < len(data) // 32:
+                    continue
+                if base.sha1 not in delta_indexes:
+                    delta_indexes[base.sha1] = build_delta_index(base.data)
+                delta = create_delta(base.data, data, delta_indexes[base.sha1], max_size)
+                if delta is not None:
+                    best = (delta, base)
+                    max_size = len(delta) - 1
+        if best is not None:
+            delta, base = best
+            if ofs_delta:
+                encoded = encode_ofs_delta(delta, offset - base.offset)
+            else:
+                encoded = encode_ref_delta(delta, base.sha1)
+            obj_depth = base.depth + 1
+            if stats is not None:
+                stats['deltas'] += 1
+                stats['raw_bytes_saved'] += len(data) - len(delta)
+        else:
+            encoded = encode_pack_object_header(type_num, len(data)) + zlib.compress(data)
+        if stats is not None:
+            stats['objects'] += 1
+            stats['pack_bytes'] += len(encoded)
+        if candidates is not None:
+            if len(candidates) == candidates.maxlen:
+                delta_indexes.pop(candidates[0].sha1, None)
+            candidates.append(DeltaCandidate(sha1, obj_type, data, obj_depth, offset))
+        yield sha1, encoded
+        offset += len(encoded)
+
+"""Building the whole pack in memory before sending it means holding every compressed object at once, and
+nothing goes over the wire until the last object is compressed. So instead iter_pack is a generator that
+yields the pack a piece at a time and hashes as it goes, which lets push hand it straight to the http
+request and stream it with chunked transfer encoding."""
+
+#Yield the bytes of a pack file piece by piece, ending with the sha1 trailer (arguments are the same as create_pack)
+def iter_pack(objects, window=10, depth=50, paths=None, stats=None, ofs_delta=True):
+    sha = hashlib.sha1()
     #12 byte header that has PACk in it
     header = struct.pack('!4sLL', b'PACK', 2, len(objects))
-    body = b''.join(encode_pack_object(o) for o in sorted(objects))
-    contents = header + body
-    sha1 = hashlib.sha1(contents).digest()
-    data = contents + sha1
+    sha.update(header)
+    yield header
+    for _, encoded in encode_pack_objects(objects, window, depth, paths, stats, offset=len(header),
+                                                ofs_delta=ofs_delta):
+        sha.update(encoded)
+        yield encoded
+    yield sha.digest()
+
+#Regroup an iterable of byte strings into chunks of at least chunk_size bytes (except the last one)
+def buffer_chunks(pieces, chunk_size=65536):
+    buf = bytearray()
+    for piece in pieces:
+        buf += piece
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
+#Create pack file by encoding all objects an concatinating them, return bytes of the full pack file
+#window and depth control delta compression (window=0 turns it off), see encode_pack_objects for paths and stats
+def create_pack(objects, window=10, depth=50, paths=None, stats=None, ofs_delta=True):
+    return b''.join(iter_pack(objects, window, depth, paths, stats, ofs_delta))
+
+"""Pack files on disk
+The same pack format we send to the server is also how git stores objects locally once there are too many
+loose files (millions of tiny zlib files means millions of inodes). Each .pack file sits next to a .idx file,
+which is what makes lookups fast. A version 2 .idx is laid out like so:
+    4 byte magic (ff 't' 'O' 'c') and a 4 byte version (2)
+    a 256 entry "fanout" table: entry i is the number of objects whose first sha1 byte is <= i
+    every sha1 in the pack, sorted (20 bytes each)
+    a crc32 of each packed object (4 bytes each)
+    the offset of each object in the .pack (4 bytes each, if the high bit is set it's an index into the next table)
+    8 byte offsets for packs bigger than 2GB
+    the sha1 of the .pack, then the sha1 of the .idx itself
+
+So to find an object we use the fanout to narrow down to objects starting with the same byte, then binary
+search just that slice. We mmap both files so the OS only pages in the bits we actually touch.
+
+Packs can also hold deltas: an object stored as instructions for rebuilding it from another (base) object.
+OFS_DELTA finds its base by offset earlier in the same pack, REF_DELTA by sha1."""
+
+OFS_DELTA = 6
+REF_DELTA = 7
+
+#Map of pack type numbers to object type names
+PACK_TYPE_NAMES = {t.value: t.name for t in ObjectType}
+
+#Decode a variable-length size from a delta header, return (size, new offset)
+def decode_delta_size(data, i):
+    size = 0
+    shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, i
+
+#Rebuild an object from the base object's bytes and the delta instructions, return the new bytes
+def apply_delta(base, delta):
+    source_size, i = decode_delta_size(delta, 0)
+    assert source_size == len(base), \
+        'delta expects base of {} bytes, got {}'.format(source_size, len(base))
+    target_size, i = decode_delta_size(delta, i)
+    result = []
+    while i < len(delta):
+        op = delta[i]
+        i += 1
+        if op & 0x80:
+            #copy instruction: the low 4 bits say which offset bytes follow, the next 3 which size bytes
+            offset = 0
+            for shift in range(4):
+                if op & (1 << shift):
+                    offset |= delta[i] << (shift * 8)
+                    i += 1
+            size = 0
+            for shift in range(3):
+                if op & (0x10 << shift):
+                    size |= delta[i] << (shift * 8)
+                    i += 1
+            if size == 0:
+                size = 0x10000
+            result.append(base[offset:offset + size])
+        elif op:
+            #insert instruction: the next op bytes are literal data
+            result.append(delta[i:i + op])
+            i += op
+        else:
+            raise ValueError('invalid delta opcode 0')
+    data = b''.join(result)
+    assert len(data) == target_size, \
+        'delta produced {} bytes, expected {}'.format(len(data), target_size)
     return data
 
-#Push to master branch given git repo url
-def push(git_url, username, password):
+#Decompress one zlib stream starting at offset in buf (without copying the rest of buf),
+#return (data, number of compressed bytes consumed)
+def inflate_at(buf, offset, chunk_size=65536):
+    view = memoryview(buf)
+    d = zlib.decompressobj()
+    parts = []
+    i = offset
+    while not d.eof:
+        chunk = view[i:i + chunk_size]
+        if not chunk:
+            raise ValueError('truncated zlib stream at offset {}'.format(offset))
+        parts.append(d.decompress(chunk))
+        i += len(chunk)
+    return b''.join(parts), i - offset - len(d.unused_data)
+
+#Parse a pack object header at offset, return (type_num, size, offset of the data after the header)
+def decode_pack_object_header(buf, offset):
+    byte = buf[offset]
+    offset += 1
+    type_num = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = buf[offset]
+        offset += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    return type_num, size, offset
+
+#Parse the negative offset that follows an OFS_DELTA header, return (distance back to base, new offset)
+def decode_ofs_delta_offset(buf, offset):
+    byte = buf[offset]
+    offset += 1
+    distance = byte & 0x7f
+    while byte & 0x80:
+        byte = buf[offset]
+        offset += 1
+        distance = ((distance + 1) << 7) | (byte & 0x7f)
+    return distance, offset
+
+#Binary search a table of sorted 20 byte sha1s starting at table_offset in buf, looking only at entries lo to hi,
+#return the index of the first entry >= sha1
+def bisect_sha1(buf, table_offset, lo, hi, sha1):
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = table_offset + mid * 20
+        if buf[pos:pos + 20] < sha1:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+#A memory mapped version 2 .idx file
+class PackIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from('!4sL', self.map, 0)
+        assert magic == b'\xfftOc', 'invalid pack index signature {}'.format(magic)
+        assert version == 2, 'unknown pack index version {}'.format(version)
+        self.fanout = struct.unpack_from('!256L', self.map, 8)
+        self.count = self.fanout[255]
+        self.sha1_offset = 8 + 256 * 4
+        self.crc_offset = self.sha1_offset + self.count * 20
+        self.offset_offset = self.crc_offset + self.count * 4
+        self.large_offset_offset = self.offset_offset + self.count * 4
+
+    def close(self):
+        self.map.close()
+
+    #Return the binary sha1 of the nth object in the index
+    def sha1_at(self, n):
+        start = self.sha1_offset + n * 20
+        return self.map[start:start + 20]
+
+    #Return the pack offset of the nth object in the index
+    def offset_at(self, n):
+        offset, = struct.unpack_from('!L', self.map, self.offset_offset + n * 4)
+        if offset & 0x80000000:
+            large = self.large_offset_offset + (offset & 0x7fffffff) * 8
+            offset, = struct.unpack_from('!Q', self.map, large)
+        return offset
+
+    #Return index of first entry >= binary sha1 among entries sharing its first byte
+    def _bisect(self, sha1):
+        first = sha1[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        return bisect_sha1(self.map, self.sha1_offset, lo, hi, sha1), hi
+
+    #Return pack offset of object with binary sha1, or None if it isn't in this pack
+    def find(self, sha1):
+        n, end = self._bisect(sha1)
+        if n < end and self.sha1_at(n) == sha1:
+            return self.offset_at(n)
+        return None
+
+    #Return list of hex sha1s in this index starting with the given hex prefix
+    def find_prefix(self, sha1_prefix):
+        #pad an odd length prefix out so we get the lowest possible hash to start from
+        low = bytes.fromhex((sha1_prefix + '0' * 40)[:40])
+        n, end = self._bisect(low)
+        matches = []
+        while n < end:
+            sha1 = self.sha1_at(n).hex()
+            if not sha1.startswith(sha1_prefix):
+                break
+            matches.append(sha1)
+            n += 1
+        return matches
+
+    #Yield (binary sha1, offset) for every object in the index
+    def entries(self):
+        for n in range(self.count):
+            yield self.sha1_at(n), self.offset_at(n)
+
+#A memory mapped .pack file and its .idx
+#(index is normally the .idx next to the pack, but index_pack passes its own while it builds one)
+class Pack:
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index or PackIndex(path[:-len('.pack')] + '.idx')
+        #recently rebuilt objects by offset, so walking a long delta chain doesn't redo the whole chain every time
+        self.base_cache = ObjectCache(16 * 1024 * 1024)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, num_objects = struct.unpack_from('!4sLL', self.map, 0)
+        assert signature == b'PACK', 'invalid pack signature {}'.format(signature)
+        assert version == 2, 'unknown pack version {}'.format(version)
+        assert num_objects == self.index.count, \
+            'pack has {} objects but index has {}'.format(num_objects, self.index.count)
+
+    def close(self):
+        self.index.close()
+        self.map.close()
+
+    #Return (type_num, data, base) for the object at offset, without resolving deltas.
+    #base is the base's offset for OFS_DELTA, the base's binary sha1 for REF_DELTA, None otherwise
+    def read_raw(self, offset):
+        type_num, size, data_offset = decode_pack_object_header(self.map, offset)
+        base = None
+        if type_num == OFS_DELTA:
+            distance, data_offset = decode_ofs_delta_offset(self.map, data_offset)
+            base = offset - distance
+        elif type_num == REF_DELTA:
+            base = self.map[data_offset:data_offset + 20]
+            data_offset += 20
+        data, _ = inflate_at(self.map, data_offset)
+        assert len(data) == size, 'expected size {}, got {} bytes'.format(size, len(data))
+        return type_num, data, base
+
+    #Return (object_type, size) of the object at offset without inflating all of it
+    def read_header(self, offset):
+        type_num, size, data_offset = decode_pack_object_header(self.map, offset)
+        if type_num == OFS_DELTA:
+            distance, data_offset = decode_ofs_delta_offset(self.map, data_offset)
+            base_type = self.read_header(offset - distance)[0]
+        elif type_num == REF_DELTA:
+            base = self.map[data_offset:data_offset + 20]
+            data_offset += 20
+            base_offset = self.index.find(base)
+            if base_offset is None:
+                base_type = read_object_header(base.hex())[0]
+            else:
+                base_type = self.read_header(base_offset)[0]
+        else:
+            return PACK_TYPE_NAMES[type_num], size
+        #the object's real size is the second of the two sizes at the start of the delta
+        d = zlib.decompressobj()
+        head = b''
+        view = memoryview(self.map)
+        while len(head) < 20 and not d.eof:
+            head += d.decompress(view[data_offset:data_offset + 64])
+            data_offset += 64
+        _, i = decode_delta_size(head, 0)
+        size, _ = decode_delta_size(head, i)
+        return base_type, size
+
+    #Read the object at offset, resolving any chain of deltas, return (object_type, data_bytes)
+    def read_object(self, offset):
+        #walk down to the base first (iteratively, delta chains can be long) then apply deltas on the way back up
+        #(offset, delta) for each delta on the way down
+        deltas = []
+        while True:
+            cached = self.base_cache.get(offset) if deltas else None
+            if cached is not None:
+                obj_type, data = cached
+                break
+            type_num, data, base = self.read_raw(offset)
+            if type_num == OFS_DELTA:
+                deltas.append((offset, data))
+                offset = base
+            elif type_num == REF_DELTA:
+                deltas.append((offset, data))
+                base_offset = self.index.find(base)
+                if base_offset is None:
+                    #a thin pack's base can live anywhere in the object store
+                    obj_type, data = read_object(base.hex())
+                    break
+                offset = base_offset
+            else:
+                obj_type = PACK_TYPE_NAMES[type_num]
+                if deltas:
+                    self.base_cache.put(offset, (obj_type, data))
+                break
+        for delta_offset, delta in reversed(deltas):
+            data = apply_delta(data, delta)
+            self.base_cache.put(delta_offset, (obj_type, data))
+        return (obj_type, data)
+
+#Return list of Pack objects in .git/objects/pack, re-scanning only when the directory has changed
+def get_packs():
+    repository = get_repository()
+    pack_dir = git_path('objects', 'pack')
+    try:
+        mtime = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    packs = repository.packs
+    if packs is not None and mtime == repository.packs_mtime:
+        return packs
+    with repository.cache_lock:
+        if repository.packs is not None and mtime == repository.packs_mtime:
+            return repository.packs
+        #keep packs that are still there open, other threads could be reading them
+        old_packs = {pack.path: pack for pack in repository.packs or []}
+        packs = []
+        if mtime is not None:
+            for name in sorted(os.listdir(pack_dir)):
+                path = os.path.join(pack_dir, name)
+                if name.endswith('.pack') and os.path.exists(path[:-5] + '.idx'):
+                    packs.append(old_packs.get(path) or Pack(path))
+        repository.packs = packs
+        repository.packs_mtime = mtime
+    return packs
+
+#Close all open pack files (needed before deleting them, at least on windows)
+def close_packs():
+    repository = get_repository()
+    with repository.cache_lock:
+        for pack in repository.packs or []:
+            pack.close()
+        repository.packs = None
+
+#Return (pack, offset) of the object with given hex sha1, or None if no pack has it
+def find_packed_object(sha1):
+    sha1_bin = bytes.fromhex(sha1)
+    for pack in get_packs():
+        offset = pack.index.find(sha1_bin)
+        if offset is not None:
+            return pack, offset
+    return None
+
+#Write the objects (hex sha1s) out to a new .pack and .idx in .git/objects/pack, return the pack's sha1
+def write_pack(objects, window=10, depth=50):
+    pack_dir = git_path('objects', 'pack')
+    os.makedirs(pack_dir, exist_ok=True)
+    tmp_path = os.path.join(pack_dir, 'tmp_pack_{}'.format(unique_suffix()))
+    #(binary sha1, crc32, offset) of each object, for the .idx
+    index_entries = []
+    sha = hashlib.sha1()
+    with open(tmp_path, 'wb') as f:
+        header = struct.pack('!4sLL', b'PACK', 2, len(objects))
+        f.write(header)
+        sha.update(header)
+        offset = len(header)
+        for obj, encoded in encode_pack_objects(objects, window, depth, offset=offset):
+            f.write(encoded)
+            sha.update(encoded)
+            index_entries.append((bytes.fromhex(obj), zlib.crc32(encoded), offset))
+            offset += len(encoded)
+        pack_sha1 = sha.digest()
+        f.write(pack_sha1)
+    name = 'pack-' + pack_sha1.hex()
+    pack_path = os.path.join(pack_dir, name + '.pack')
+    #write the .idx first, a .pack without its .idx is simply ignored by get_packs
+    write_pack_index(os.path.join(pack_dir, name + '.idx'), index_entries, pack_sha1)
+    os.replace(tmp_path, pack_path)
+    return pack_sha1.hex()
+
+#Write a version 2 .idx file given (binary sha1, crc32, offset) entries and the pack's checksum
+def write_pack_index(path, entries, pack_sha1):
+    entries = sorted(entries)
+    fanout = [0] * 256
+    for sha1, _, _ in entries:
+        fanout[sha1[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    offsets = []
+    large_offsets = []
+    for _, _, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+    parts = [
+        struct.pack('!4sL', b'\xfftOc', 2),
+        struct.pack('!256L', *fanout),
+        b''.join(sha1 for sha1, _, _ in entries),
+        struct.pack('!{}L'.format(len(entries)), *(crc for _, crc, _ in entries)),
+        struct.pack('!{}L'.format(len(offsets)), *offsets),
+        struct.pack('!{}Q'.format(len(large_offsets)), *large_offsets),
+        pack_sha1,
+    ]
+    data = b''.join(parts)
+    tmp_path = path + '.tmp' + unique_suffix()
+    write_file(tmp_path, data + hashlib.sha1(data).digest())
+    os.replace(tmp_path, path)
+
+#Yield the hex sha1 of every loose object in .git/objects
+def iter_loose_objects():
+    objects_dir = git_path('objects')
+    for name in os.listdir(objects_dir):
+        if len(name) != 2:
+            continue
+        for rest in os.listdir(os.path.join(objects_dir, name)):
+            if len(rest) == 38:
+                yield name + rest
+
+"""Repacking
+git gc/repack rolls loose objects up into a pack so lookups stop depending on how many files
+are sitting in .git/objects. By default only loose objects are packed, with all_packs the existing
+packs are rolled into the new one too so there is exactly one pack left."""
+
+#Pack loose objects (and optionally every existing pack) into a new pack, then delete what was packed
+def repack(all_packs=False):
+    loose = set(iter_loose_objects())
+    old_packs = list(get_packs()) if all_packs else []
+    objects = set(loose)
+    for pack in old_packs:
+        objects.update(sha1.hex() for sha1, _ in pack.index.entries())
+    if not objects:
+        print('nothing to pack')
+        return None
+    pack_sha1 = write_pack(objects)
+    new_name = 'pack-{}.pack'.format(pack_sha1)
+    old_paths = [p.path for p in old_packs if os.path.basename(p.path) != new_name]
+    close_packs()
+    for path in old_paths:
+        os.remove(path[:-len('.pack')] + '.idx')
+        os.remove(path)
+    for sha1 in loose:
+        os.remove(loose_object_path(sha1))
+    objects_dir = git_path('objects')
+    for name in {sha1[:2] for sha1 in loose}:
+        try:
+            os.rmdir(os.path.join(objects_dir, name))
+        except OSError:
+            pass
+    print('packed {} object{} into {}'.format(len(objects), '' if len(objects) == 1 else 's', new_name))
+    return pack_sha1
+
+"""Pushing more than one ref
+The receive-pack request can hold any number of "<old sha1> <new sha1> <ref>" commands, so pushing a dozen
+branches and tags doesn't need a dozen advertisements, packs and POSTs. We work out what's missing for all of
+the new tips at once (using every ref the remote advertised as a have), so an object shared by several
+branches is only sent once, and with the atomic capability the server updates either every ref or none."""
+
+#Turn refspecs (master, v1.0, refs/heads/x, or src:dst) into a dict of remote ref name -> local sha1
+def resolve_refspecs(refspecs, local_refs):
+    updates = collections.OrderedDict()
+    for spec in refspecs:
+        src, _, dst = spec.partition(':')
+        for name in [src, 'refs/heads/' + src, 'refs/tags/' + src]:
+            if name in local_refs:
+                break
+        else:
+            raise ValueError('src refspec {!r} does not match any ref'.format(src))
+        if not dst:
+            dst = name
+        elif not dst.startswith('refs/'):
+            #push to the same kind of ref as the source (a branch to a branch, a tag to a tag)
+            dst = name.rsplit('/', 1)[0] + '/' + dst if name.startswith('refs/') else 'refs/heads/' + dst
+        updates[dst] = local_refs[name]
+    return updates
+
+#Return the (old sha1 or None, new sha1, ref) commands needed to bring remote_refs up to date with updates
+def get_push_commands(remote_refs, updates):
+    return [(remote_refs.get(ref), sha1, ref) for ref, sha1 in updates.items() if remote_refs.get(ref) != sha1]
+
+#Return tuple of (the remote tips to treat as haves, True if the push is just master) for the given commands
+#(the reachability cache only describes a single line of history, so it's only used for plain master pushes)
+def get_push_remote_tips(remote_refs, commands):
+    if [ref for _, _, ref in commands] == ['refs/heads/master']:
+        return remote_refs.get('refs/heads/master'), True
+    return sorted(set(remote_refs.values())), False
+
+#Return the capabilities to ask for in a push of commands, given the ones the remote advertised
+def get_push_capabilities(capabilities, commands, atomic):
+    if atomic and len(commands) > 1 and 'atomic' not in capabilities:
+        raise ValueError('the remote does not support atomic pushes')
+    caps = ['report-status'] + [c for c in ['side-band-64k', 'ofs-delta'] if c in capabilities]
+    if atomic and len(commands) > 1:
+        caps.append('atomic')
+    return caps
+
+#Build the pkt-lines of ref update commands that start a receive-pack request
+def build_push_commands(commands, caps):
+    lines = ['{} {} {}'.format(old or ('0' * 40), new, ref).encode() for old, new, ref in commands]
+    lines[0] += '\x00 {}'.format(' '.join(caps)).encode()
+    return build_lines_data(lines)
+
+#Read the report-status from a receive-pack response stream, return (unpack status, dict of ref -> error or None)
+def read_push_report(stream, caps):
+    reader = PktLineReader(stream)
+    if 'side-band-64k' in caps:
+        reader = PktLineReader(ChunkStream(reader.iter_side_band(print_progress)))
+    return parse_report_status(reader.iter_lines())
+
+#Raise ValueError if the remote failed to unpack or rejected any of the commands
+def check_push_report(commands, unpack_status, results):
+    errors = []
+    for _, _, ref in commands:
+        if ref not in results:
+            errors.append('{} (no status reported)'.format(ref))
+        elif results[ref] is not None:
+            errors.append('{} ({})'.format(ref, results[ref]))
+    if unpack_status != 'ok':
+        raise ValueError('remote failed to unpack: {}'.format(unpack_status))
+    if errors:
+        raise ValueError('remote rejected {}'.format(', '.join(errors)))
+
+#Update many remote refs in one request given a dict of remote ref name -> local sha1
+#atomic asks the server to apply all of the updates or none of them (when there's more than one)
+#return tuple of (dict of ref -> (old sha1 or None, new sha1) for each ref that changed, set of objects sent)
+def push_refs(git_url, updates, username, password, window=10, depth=50, atomic=True):
         if username is None:
             username = os.environ['GIT_USERNAME']
         if password is None:
             password = os.environ['GIT_PASSWORD']
-        remote_sha1 = get_remote_master_hash(git_url, username, password)
-        local_sha1 = get_local_master_hash()
-        missing = find_missing_objects(local_sha1, remote_sha1)
-        print('updating remote master from {} to {} ({} object{})'.format(
-                remote_sha1 or 'no commits', local_sha1, len(missing),
-                '' if len(missing) == 1 else 's'))
-        lines = ['{} {} refs/heads/master\x00 report-status'.format(
-                remote_sha1 or ('0' * 40), local_sha1).encode()]
-        data = build_lines_data(lines) + create_pack(missing)
-        url = git_url + '/git-receive-pack'
-        response = http_request(url, username, password, data=data)
-        lines = extract_lines(response)
-        assert len(lines) >= 2, \
-            'expected at least 2 lines, got {}'.format(len(lines))
-        assert lines[0] == b'unpack ok\n', \
-            "expected line 1 b'unpack ok', got: {}".format(lines[0])
-        assert lines[1] == b'ok refs/heads/master\n', \
-            "expected line 2 b'ok refs/heads/master\n', got: {}".format(lines[1])
+        with HttpSession(username, password) as session:
+            remote_refs, capabilities = get_remote_refs(git_url, 'git-receive-pack', session)
+            commands = get_push_commands(remote_refs, updates)
+            if not commands:
+                print('everything up to date')
+                return {}, set()
+            caps = get_push_capabilities(capabilities, commands, atomic)
+            remote_tips, single_master = get_push_remote_tips(remote_refs, commands)
+            paths = {}
+            missing, have, fast_forward = walk_missing_objects([new for _, new, _ in commands], remote_tips, paths)
+            try:
+                for old, new, ref in commands:
+                    print('updating remote {} from {} to {}'.format(ref, old or 'no commits', new))
+                print('sending {} object{}'.format(len(missing), '' if len(missing) == 1 else 's'))
+                stats = {}
+                pack = iter_pack(missing, window, depth, paths, stats, 'ofs-delta' in caps)
+                data = buffer_chunks(itertools.chain([build_push_commands(commands, caps)], pack))
+                url = git_url + '/git-receive-pack'
+                #read the response as it streams in, so the server's progress shows up while it's still working
+                with session.open(url, data, 'application/x-git-receive-pack-request',
+                                  'application/x-git-receive-pack-result') as response:
+                    print('delta compressed {} of {} objects ({} bytes smaller before zlib), sent {} bytes'.format(
+                            stats['deltas'], stats['objects'], stats['raw_bytes_saved'], stats['pack_bytes']))
+                    unpack_status, results = read_push_report(response, caps)
+                check_push_report(commands, unpack_status, results)
+            except BaseException:
+                if isinstance(have, ReachabilityCache):
+                    have.close()
+                raise
+        if single_master and fast_forward:
+            save_reachability_cache(commands[0][1], have, missing)
+        elif isinstance(have, ReachabilityCache):
+            have.close()
+        return {ref: (old, new) for old, new, ref in commands}, missing
+
+#Push to master branch given git repo url
+#window and depth control delta compression of the pack (window=0 sends whole objects)
+def push(git_url, username, password, window=10, depth=50):
+        remote_sha1 = None
+        updates = {'refs/heads/master': get_local_master_hash()}
+        updated, missing = push_refs(git_url, updates, username, password, window, depth)
+        if 'refs/heads/master' in updated:
+            remote_sha1 = updated['refs/heads/master'][0]
         return (remote_sha1, missing)
 
+"""Pushing to many remotes at once
+When we mirror the same commits to several servers, pushing to one after another takes as long as all of
+them put together, since each push spends most of its time waiting on the network. push_many talks to every
+server at the same time with asyncio instead, so it takes about as long as the slowest one. AsyncHttpSession
+is a small http/1.1 client on asyncio streams (keep-alive, Basic auth, gzip and chunked responses), it's just
+a host and port away from any server, so a local test server works as well as a real one.
+
+Working out what's missing and building the pack is the expensive part, and mirrors are usually at the same
+commit, so remotes that advertise the same tips share a pack: it's built once in a worker thread (the other
+remotes keep talking meanwhile) and the same bytes go to each of them."""
+
+#A keep-alive http(s) client on asyncio streams that authenticates with Basic auth (the asyncio HttpSession)
+class AsyncHttpSession:
+    def __init__(self, username=None, password=None, timeout=60):
+        self.headers = {'Accept-Encoding': 'gzip', 'User-Agent': 'gitpy'}
+        if username is not None:
+            credentials = '{}:{}'.format(username, password or '').encode()
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode()
+        #seconds to wait for the connection or the next bit of the request or response
+        self.timeout = timeout
+        #(scheme, host) -> list of idle (reader, writer) pairs
+        self.idle = collections.defaultdict(list)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    #Close every idle connection
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+    def _wait(self, awaitable):
+        return asyncio.wait_for(awaitable, self.timeout)
+
+    async def _connect(self, key):
+        if self.idle[key]:
+            return self.idle[key].pop(), True
+        scheme, host = key
+        parts = urllib.parse.urlsplit('//' + host)
+        if scheme == 'https':
+            connection = asyncio.open_connection(parts.hostname, parts.port or 443, ssl=ssl.create_default_context())
+        else:
+            connection = asyncio.open_connection(parts.hostname, parts.port or 80)
+        return await self._wait(connection), False
+
+    #Send a request, data is None, bytes, or a list of bytes to send one after the other
+    async def _send(self, writer, method, path, host, headers, data):
+        head = ['{} {} HTTP/1.1'.format(method, path), 'Host: ' + host]
+        head += ['{}: {}'.format(name, value) for name, value in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        for piece in data or []:
+            view = memoryview(piece)
+            for i in range(0, len(view), 65536):
+                writer.write(view[i:i + 65536])
+                await self._wait(writer.drain())
+        await self._wait(writer.drain())
+
+    #Read a response, return tuple of (status, reason, headers, body, True if the connection can be reused)
+    async def _read_response(self, reader):
+        status_line = await self._wait(reader.readline())
+        if not status_line:
+            raise ConnectionError('connection closed without a response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        lines = []
+        while True:
+            line = await self._wait(reader.readline())
+            lines.append(line)
+            if not line.strip():
+                break
+        headers = http.client.parse_headers(io.BytesIO(b''.join(lines)))
+        reusable = version == 'HTTP/1.1' and (headers.get('Connection') or '').lower() != 'close'
+        if (headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self._wait(reader.readline())).split(b';', 1)[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await self._wait(reader.readexactly(size)))
+                await self._wait(reader.readexactly(2))
+            #skip any trailers, up to the blank line
+            while (await self._wait(reader.readline())).strip():
+                pass
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await self._wait(reader.readexactly(int(headers['Content-Length'])))
+        else:
+            body = await self._wait(reader.read())
+            reusable = False
+        if (headers.get('Content-Encoding') or '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return int(status), reason, headers, body, reusable
+
+    async def _round_trip(self, key, method, path, headers, data):
+        while True:
+            (reader, writer), reused = await self._connect(key)
+            try:
+                await self._send(writer, method, path, key[1], headers, data)
+                status, reason, response_headers, body, reusable = await self._read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                #the server closed an idle connection on us, try again
+                continue
+            except BaseException:
+                writer.close()
+                raise
+            if reusable:
+                self.idle[key].append((reader, writer))
+            else:
+                writer.close()
+            return status, reason, response_headers, body
+
+    #Make a request and return the whole (decompressed) response body.
+    #data is None to GET, or bytes (or a list of bytes, sent one after the other) to POST
+    async def request(self, url, data=None, content_type=None, accept=None):
+        if isinstance(data, bytes):
+            data = [data]
+        origin = get_url_origin(url)
+        for _ in range(5):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            headers = dict(self.headers)
+            #the credentials are for the server we were asked to talk to, not wherever it redirects us
+            if get_url_origin(url) != origin:
+                headers.pop('Authorization', None)
+            if content_type:
+                headers['Content-Type'] = content_type
+            if accept:
+                headers['Accept'] = accept
+            if data is not None:
+                headers['Content-Length'] = str(sum(len(piece) for piece in data))
+            method = 'GET' if data is None else 'POST'
+            status, reason, response_headers, body = await self._round_trip(key, method, path, headers, data)
+            if status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, response_headers.get('Location'))
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, response_headers, io.BytesIO(body))
+            return body
+        raise ValueError('too many redirects for {}'.format(url))
+
+#get_remote_refs for an AsyncHttpSession
+async def get_remote_refs_async(git_url, service, session):
+    url = git_url + '/info/refs?service=' + service
+    return parse_info_refs(await session.request(url), service)
+
+#Find the objects new_sha1s need that remote_tips don't have and pack them (push_many runs this in a worker thread)
+#return tuple of (set of objects, bytes of the pack, delta stats, the objects the remote has, True if fast-forward)
+def build_push_pack(new_sha1s, remote_tips, window=10, depth=50, ofs_delta=True):
+    paths = {}
+    missing, have, fast_forward = walk_missing_objects(new_sha1s, remote_tips, paths)
+    stats = {}
+    pack = create_pack(missing, window, depth, paths, stats, ofs_delta)
+    return missing, pack, stats, have, fast_forward
+
+#Push updates to one of push_many's remotes, sharing packs (dict of key -> future of build_push_pack) with the
+#others. Adds the pack's key to pushed if the remote takes it, return the same as push_refs
+async def push_remote_async(git_url, updates, session, packs, pushed, window, depth, atomic):
+    remote_refs, capabilities = await get_remote_refs_async(git_url, 'git-receive-pack', session)
+    commands = get_push_commands(remote_refs, updates)
+    if not commands:
+        print('{}: everything up to date'.format(git_url))
+        return {}, set()
+    caps = get_push_capabilities(capabilities, commands, atomic)
+    remote_tips, single_master = get_push_remote_tips(remote_refs, commands)
+    new_sha1s = [new for _, new, _ in commands]
+    ofs_delta = 'ofs-delta' in caps
+    #the pack only depends on what we're sending, what the remote already has and how it wants deltas
+    key = (frozenset(new_sha1s), single_master, remote_tips if single_master else tuple(remote_tips), ofs_delta)
+    if key not in packs:
+        packs[key] = asyncio.get_running_loop().run_in_executor(
+            None, get_repository().call, build_push_pack, new_sha1s, remote_tips, window, depth, ofs_delta)
+    missing, pack, stats, _, _ = await packs[key]
+    for old, new, ref in commands:
+        print('{}: updating remote {} from {} to {}'.format(git_url, ref, old or 'no commits', new))
+    print('{}: sending {} object{} ({} bytes), delta compressed {} of them ({} bytes smaller before zlib)'.format(
+            git_url, len(missing), '' if len(missing) == 1 else 's', stats['pack_bytes'], stats['deltas'],
+            stats['raw_bytes_saved']))
+    body = await session.request(git_url + '/git-receive-pack', [build_push_commands(commands, caps), pack],
+                                 'application/x-git-receive-pack-request', 'application/x-git-receive-pack-result')
+    unpack_status, results = read_push_report(io.BytesIO(body), caps)
+    check_push_report(commands, unpack_status, results)
+    pushed.add(key)
+    return {ref: (old, new) for old, new, ref in commands}, missing
+
+#Push a dict of remote ref name -> local sha1 to every url in git_urls at the same time. Pass an AsyncHttpSession
+#(or anything with the same request method) as session to use it instead of one made from username and password.
+#return dict of url -> what push_refs returns for it. If any remote fails the others are still pushed to,
+#then ValueError says which ones failed and why
+async def push_many_async(git_urls, updates, username=None, password=None, window=10, depth=50, atomic=True,
+                          session=None):
+    own_session = session is None
+    if own_session:
+        if username is None:
+            username = os.environ['GIT_USERNAME']
+        if password is None:
+            password = os.environ['GIT_PASSWORD']
+        session = AsyncHttpSession(username, password)
+    packs = {}
+    pushed = set()
+    try:
+        outcomes = await asyncio.gather(*[push_remote_async(url, updates, session, packs, pushed, window, depth, atomic)
+                                          for url in git_urls], return_exceptions=True)
+    finally:
+        if own_session:
+            session.close()
+        for key, future in packs.items():
+            if not future.done() or future.cancelled() or future.exception() is not None:
+                continue
+            missing, _, _, have, fast_forward = future.result()
+            #same as push_refs, remember what the remote has for the next push of master
+            if key in pushed and key[1] and fast_forward:
+                save_reachability_cache(next(iter(key[0])), have, missing)
+            elif isinstance(have, ReachabilityCache):
+                have.close()
+    results = collections.OrderedDict()
+    errors = []
+    for url, outcome in zip(git_urls, outcomes):
+        if isinstance(outcome, BaseException):
+            errors.append('{} ({})'.format(url, outcome))
+        else:
+            results[url] = outcome
+    if errors:
+        raise ValueError('push failed for {}'.format(', '.join(errors)))
+    return results
+
+#Push updates to every url in git_urls at the same time, see push_many_async
+def push_many(git_urls, updates, username=None, password=None, window=10, depth=50, atomic=True):
+    return asyncio.run(push_many_async(git_urls, updates, username, password, window, depth, atomic))
+
+"""Fetching
+Fetching is pushing in reverse, we talk to git-upload-pack instead of git-receive-pack:
+    1. GET info/refs?service=git-upload-pack gets us the server's refs (same format as for push)
+    2. we POST "want <sha1>" for every ref tip we don't have, then "have <sha1>" for commits we do have.
+       The server ACKs the haves it also has, which tells it what it can leave out of the pack.
+       Over http every request stands on its own, so each round repeats the wants and the haves that were
+       ACKed, and we stop once the server says it's ready (or we run out of haves) and send "done".
+    3. the server answers with the pack, split into side-band packets: channel 1 is pack data,
+       channel 2 is progress messages for the user and channel 3 is a fatal error
+
+The pack could be gigabytes, so we never hold it in memory. index_pack reads it as a stream, writing it to
+disk and hashing each object as it's inflated. Deltas can't be hashed until their base is rebuilt, so they
+get resolved afterwards by reading them back out of the (mmapped) pack we just wrote. Then we write the .idx
+and move both into .git/objects/pack, just like a pack made by repack."""
+
+#Return True if the object store has an object with this hex sha1
+def has_object(sha1):
+    return os.path.exists(loose_object_path(sha1)) or find_packed_object(sha1) is not None
+
+#Write sha1 to the ref with given name (ex: refs/heads/master), creating directories as needed
+def write_ref(name, sha1):
+    path = git_path(*name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    #write a temp file and rename it into place, so nobody sees an empty ref
+    tmp_path = path + '.tmp' + unique_suffix()
+    write_file(tmp_path, (sha1 + '\n').encode())
+    os.replace(tmp_path, path)
+
+#Reads a pack from an iterable of byte chunks, writing each byte to out as it's consumed and hashing it
+class PackStreamReader:
+    def __init__(self, chunks, out):
+        self.chunks = iter(chunks)
+        self.out = out
+        self.buf = bytearray()
+        self.pos = 0
+        #offset in the pack of self.buf[self.pos]
+        self.offset = 0
+        self.sha = hashlib.sha1()
+        #crc32 of the bytes consumed since the last reset, for the .idx
+        self.crc = 0
+
+    #Make sure at least n unconsumed bytes are buffered (fewer only if the stream ends)
+    def fill(self, n):
+        if self.pos and self.pos >= len(self.buf) // 2:
+            del self.buf[:self.pos]
+            self.pos = 0
+        while len(self.buf) - self.pos < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+        return len(self.buf) - self.pos
+
+    #Mark the next n buffered bytes as consumed (written to out, hashed and crc'd), return them
+    def consume(self, n):
+        data = bytes(self.buf[self.pos:self.pos + n])
+        self.pos += n
+        self.offset += n
+        self.out.write(data)
+        self.sha.update(data)
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+    #Read and consume exactly n bytes
+    def read(self, n):
+        if self.fill(n) < n:
+            raise ValueError('pack truncated at offset {}'.format(self.offset))
+        return self.consume(n)
+
+    #Inflate one zlib stream, passing each piece of output to callback, return total inflated size
+    def inflate(self, callback):
+        d = zlib.decompressobj()
+        size = 0
+        while not d.eof:
+            if not self.fill(1):
+                raise ValueError('pack truncated at offset {}'.format(self.offset))
+            #feed it a bounded slice: whatever's left over gets copied into unused_data, and with lots of small
+            #objects copying the whole buffer for each one adds up
+            n = min(len(self.buf) - self.pos, 65536)
+            with memoryview(self.buf) as view, view[self.pos:self.pos + n] as available:
+                output = d.decompress(available)
+            self.consume(n - len(d.unused_data))
+            size += len(output)
+            callback(output)
+        return size
+
+    #Read the 20 byte trailer (not hashed or written to out here), return it
+    def read_trailer(self):
+        if self.fill(20) < 20:
+            raise ValueError('pack truncated at offset {}'.format(self.offset))
+        trailer = bytes(self.buf[self.pos:self.pos + 20])
+        self.pos += 20
+        return trailer
+
+#Stand-in for a PackIndex while index_pack is still working out the sha1s (a dict of binary sha1 -> offset)
+class MemoryPackIndex:
+    def __init__(self, offsets, count):
+        self.offsets = offsets
+        self.count = count
+
+    def find(self, sha1):
+        return self.offsets.get(sha1)
+
+    def close(self):
+        pass
+
+#Read a pack from an iterable of byte chunks into .git/objects/pack (with a new .idx), return the pack's sha1 (hex)
+def index_pack(chunks):
+    pack_dir = git_path('objects', 'pack')
+    os.makedirs(pack_dir, exist_ok=True)
+    tmp_path = os.path.join(pack_dir, 'tmp_index_pack_{}'.format(unique_suffix()))
+    #offset -> crc32, for every object
+    crcs = {}
+    #binary sha1 -> offset, for every object whose sha1 we know so far
+    offsets = {}
+    #(offset, base) for each delta, base is the OFS_DELTA base's offset or the REF_DELTA base's binary sha1
+    deltas = []
+    with open(tmp_path, 'wb') as f:
+        reader = PackStreamReader(chunks, f)
+        signature, version, num_objects = struct.unpack('!4sLL', reader.read(12))
+        assert signature == b'PACK', 'invalid pack signature {}'.format(signature)
+        assert version == 2, 'unknown pack version {}'.format(version)
+        for _ in range(num_objects):
+            offset = reader.offset
+            reader.crc = 0
+            byte = reader.read(1)[0]
+            type_num = (byte >> 4) & 7
+            size = byte & 0x0f
+            shift = 4
+            while byte & 0x80:
+                byte = reader.read(1)[0]
+                size |= (byte & 0x7f) << shift
+                shift += 7
+            if type_num == OFS_DELTA:
+                byte = reader.read(1)[0]
+                distance = byte & 0x7f
+                while byte & 0x80:
+                    byte = reader.read(1)[0]
+                    distance = ((distance + 1) << 7) | (byte & 0x7f)
+                deltas.append((offset, offset - distance))
+                inflated = reader.inflate(lambda data: None)
+            elif type_num == REF_DELTA:
+                deltas.append((offset, reader.read(20)))
+                inflated = reader.inflate(lambda data: None)
+            else:
+                sha = hashlib.sha1('{} {}'.format(PACK_TYPE_NAMES[type_num], size).encode() + b'\x00')
+                inflated = reader.inflate(sha.update)
+                offsets[sha.digest()] = offset
+            assert inflated == size, 'expected size {}, got {} bytes'.format(size, inflated)
+            crcs[offset] = reader.crc
+        pack_sha1 = reader.sha.digest()
+        trailer = reader.read_trailer()
+        assert trailer == pack_sha1, 'invalid pack checksum'
+        f.write(trailer)
+    pack = Pack(tmp_path, MemoryPackIndex(offsets, num_objects))
+    try:
+        #a delta's base might itself be a delta we haven't hashed yet (or be one further down a chain that ends at
+        #a REF_DELTA whose base comes later in the pack), so keep going round until we're stuck
+        resolved = set(offsets.values())
+        while deltas:
+            unresolved = []
+            for offset, base in deltas:
+                if isinstance(base, int):
+                    ready = base in resolved
+                else:
+                    ready = base in offsets or has_object(base.hex())
+                if not ready:
+                    unresolved.append((offset, base))
+                    continue
+                obj_type, data = pack.read_object(offset)
+                header = '{} {}'.format(obj_type, len(data)).encode()
+                offsets[hashlib.sha1(header + b'\x00' + data).digest()] = offset
+                resolved.add(offset)
+            if len(unresolved) == len(deltas):
+                raise ValueError('pack has {} deltas with missing bases'.format(len(unresolved)))
+            deltas = unresolved
+    finally:
+        pack.close()
+    name = 'pack-' + pack_sha1.hex()
+    write_pack_index(os.path.join(pack_dir, name + '.idx'),
+                     [(sha1, crcs[offset], offset) for sha1, offset in offsets.items()], pack_sha1)
+    os.replace(tmp_path, os.path.join(pack_dir, name + '.pack'))
+    return pack_sha1.hex()
+
+#Yield hex sha1s of local commits, newest first, to offer the server as haves (skipping ancestors of common ones)
+def iter_haves(common):
+    heap = []
+    seen = set()
+    for ref_sha1 in set(read_local_refs().values()):
+        #tags point at tag objects, and read_commit only understands commits
+        sha1 = peel_to_commit(ref_sha1)
+        if sha1 is not None and sha1 not in seen:
+            seen.add(sha1)
+            heapq.heappush(heap, (-read_commit(sha1)[2], sha1))
+    while heap:
+        _, sha1 = heapq.heappop(heap)
+        _, parents, _ = read_commit(sha1)
+        if sha1 in common:
+            #everything below a commit the server has, it has too
+            common.update(parents)
+            continue
+        yield sha1
+        for parent in parents:
+            if parent not in seen and has_object(parent):
+                seen.add(parent)
+                heapq.heappush(heap, (-read_commit(parent)[2], parent))
+
+#Negotiate with upload-pack and download a pack containing wants, return the new pack's sha1 (or None if no pack)
+def fetch_pack(git_url, wants, capabilities, session):
+    url = git_url + '/git-upload-pack'
+    content_type = 'application/x-git-upload-pack-request'
+    accept = 'application/x-git-upload-pack-result'
+    caps = [c for c in ['multi_ack_detailed', 'side-band-64k', 'ofs-delta'] if c in capabilities]
+    caps.append('agent=gitpy')
+    want_lines = [pkt_line('want {} {}'.format(wants[0], ' '.join(caps)).encode())]
+    want_lines.extend(pkt_line('want {}'.format(w).encode()) for w in wants[1:])
+    want_data = b''.join(want_lines) + b'0000'
+    common = set()
+    acked = []
+    haves = iter_haves(common)
+    #send haves in growing batches, like git, and give up after 256 haves in a row that the server doesn't have
+    batch = 16
+    in_vain = 0
+    ready = False
+    while not ready and in_vain < 256:
+        round_haves = list(itertools.islice(haves, batch))
+        if not round_haves:
+            break
+        data = want_data + b''.join(pkt_line('have {}'.format(h).encode()) for h in acked + round_haves) + b'0000'
+        found = False
+        for line in extract_lines(session.request(url, data, content_type, accept)):
+            parts = line.decode().split()
+            if len(parts) >= 2 and parts[0] == 'ACK':
+                if parts[1] not in acked:
+                    acked.append(parts[1])
+                    common.add(parts[1])
+                    found = True
+                if parts[-1] == 'ready':
+                    ready = True
+        in_vain = 0 if found else in_vain + len(round_haves)
+        batch = min(batch * 2, 1024)
+    data = want_data + b''.join(pkt_line('have {}'.format(h).encode()) for h in acked) + pkt_line(b'done')
+    with session.open(url, data, content_type, accept) as response:
+        reader = PktLineReader(response)
+        #the ACK/NAK lines end with a NAK or a plain "ACK <sha1>", then the pack starts
+        while True:
+            line = reader.read_line()
+            if line is None:
+                return None
+            words = line.split()
+            if words == [b'NAK'] or (len(words) == 2 and words[0] == b'ACK'):
+                break
+        if 'side-band-64k' in caps:
+            chunks = reader.iter_side_band(print_progress)
+        else:
+            chunks = reader.iter_raw()
+        return index_pack(chunks)
+
+#Fetch every branch and tag from the server at git_url, return (dict of remote ref name -> sha1, server capabilities)
+#branches are stored as refs/remotes/origin/<branch>, tags as refs/tags/<tag>
+def fetch(git_url, username=None, password=None, session=None):
+    if username is None:
+        username = os.environ.get('GIT_USERNAME')
+    if password is None:
+        password = os.environ.get('GIT_PASSWORD')
+    own_session = session is None
+    if own_session:
+        session = HttpSession(username, password)
+    try:
+        refs, capabilities = get_remote_refs(git_url, 'git-upload-pack', session)
+        refs = collections.OrderedDict((name, sha1) for name, sha1 in refs.items()
+                                       if not name.endswith('^{}'))
+        wants = sorted({sha1 for sha1 in refs.values() if not has_object(sha1)})
+        #the server can also turn out to have nothing to send, then there's no pack
+        pack_sha1 = fetch_pack(git_url, wants, capabilities, session) if wants else None
+        if pack_sha1 is not None:
+            print('fetched {} ref{} into pack-{}'.format(len(wants), '' if len(wants) == 1 else 's', pack_sha1))
+        else:
+            print('already up to date')
+    finally:
+        if own_session:
+            session.close()
+    for name, sha1 in refs.items():
+        if name.startswith('refs/heads/'):
+            write_ref('refs/remotes/origin/' + name[len('refs/heads/'):], sha1)
+        elif name.startswith('refs/tags/'):
+            write_ref(name, sha1)
+    return refs, capabilities
+
+#Write the files of tree_sha1 into the working copy (under prefix), return list of IndexEntry objects for them
+def checkout_tree(tree_sha1, prefix=''):
+    entries = []
+    stack = [(tree_sha1, prefix)]
+    while stack:
+        sha1, prefix = stack.pop()
+        for mode, path, digest in read_tree(sha1=sha1):
+            full_path = prefix + path
+            if stat.S_ISDIR(mode):
+                os.makedirs(work_path(full_path), exist_ok=True)
+                stack.append((digest.hex(), full_path + '/'))
+                continue
+            if mode == 0o160000:
+                #a submodule, there's nothing of ours to write
+                continue
+            obj_type, data = read_object(digest.hex())
+            assert obj_type == 'blob'
+            if stat.S_ISLNK(mode):
+                os.symlink(data.decode(), work_path(full_path))
+                st = os.lstat(work_path(full_path))
+            else:
+                write_file(work_path(full_path), data)
+                if mode & 0o111:
+                    os.chmod(work_path(full_path), 0o755)
+                st = os.stat(work_path(full_path))
+            entries.append(index_entry_from_stat(full_path, digest, st))
+    return entries
+
+#Clone the repository at git_url into a new directory repo, checking out the server's default branch as master
+def clone(git_url, repo, username=None, password=None):
+    init(repo)
+    with Repository(repo).activate():
+        refs, capabilities = fetch(git_url, username, password)
+        head = 'refs/heads/master'
+        for capability in capabilities:
+            if capability.startswith('symref=HEAD:'):
+                head = capability[len('symref=HEAD:'):]
+        sha1 = refs.get(head) or refs.get('HEAD')
+        if sha1 is None:
+            print('warning: you appear to have cloned an empty repository')
+            return None
+        write_ref('refs/heads/master', sha1)
+        entries = checkout_tree(read_commit(sha1)[0])
+        entries.sort(key=operator.attrgetter('path'))
+        write_index(entries)
+        return sha1
+
+"""Using gitpy as a library
+Repository(path) is the way in for a program that works on lots of repositories, or on one from lots of
+threads. It owns the repository's caches (the open pack files and their delta base caches, the commit-graph,
+the shared index and the optional object cache), so keeping one around for a busy repository saves opening
+and reading all of those again for every operation. Its methods make it the current repository for the
+calling thread and call the functions above, which is all the command line does too.
+
+Reading objects, trees, commits and refs is safe from any number of threads at once. Anything that writes the
+index, refs or packs holds the repository's lock, so two threads can't interleave their read-modify-writes on
+the same repository (and different repositories never wait on each other)."""
+
+class Repository:
+    def __init__(self, path='.', object_cache_bytes=None):
+        self.path = path
+        self.git_dir = os.path.join(path, '.git')
+        if not os.path.isdir(self.git_dir):
+            raise ValueError('{!r} is not a repository (it has no .git directory)'.format(path or '.'))
+        #held while writing the index, refs or packs
+        self.lock = threading.RLock()
+        #held while (re)loading the caches below
+        self.cache_lock = threading.RLock()
+        self.packs = None
+        self.packs_mtime = None
+        self.commit_graph = None
+        self.commit_graph_mtime = None
+        #the last shared index we read, as (path, IndexEntries), so add and status don't parse it twice
+        self.shared_index_cache = None
+        self.object_cache = ObjectCache(object_cache_bytes) if object_cache_bytes else None
+
+    def __repr__(self):
+        return 'Repository({!r})'.format(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #Close the open pack files and commit-graph (they're opened again if the repository is used after this)
+    def close(self):
+        with self.cache_lock:
+            for pack in self.packs or []:
+                pack.close()
+            if self.commit_graph is not None:
+                self.commit_graph.close()
+            self.packs = self.packs_mtime = None
+            self.commit_graph = self.commit_graph_mtime = None
+
+    #Make this the calling thread's current repository for the length of a with block
+    @contextlib.contextmanager
+    def activate(self):
+        previous = getattr(_thread_state, 'repository', None)
+        _thread_state.repository = self
+        try:
+            yield self
+        finally:
+            _thread_state.repository = previous
+
+    #Return function(*args, **kwargs), called with this as the current repository
+    def call(self, function, *args, **kwargs):
+        with self.activate():
+            return function(*args, **kwargs)
+
+    #Same as call, but holding the lock (for anything that writes the index, refs or packs)
+    def call_locked(self, function, *args, **kwargs):
+        with self.lock, self.activate():
+            return function(*args, **kwargs)
+
+    #Create a new repository in directory path, return its Repository
+    @classmethod
+    def init(cls, path, **kwargs):
+        init(path)
+        return cls(path, **kwargs)
+
+    #Clone the repository at git_url into a new directory path, return its Repository
+    @classmethod
+    def clone(cls, git_url, path, username=None, password=None, **kwargs):
+        clone(git_url, path, username, password)
+        return cls(path, **kwargs)
+
+    #Objects
+
+    def read_object(self, sha1_prefix):
+        return self.call(read_object, sha1_prefix)
+
+    def hash_object(self, data, object_type='blob', write=True):
+        return self.call(hash_object, data, object_type, write)
+
+    #Hash the file at path (relative to the working copy) as an object, return its sha1
+    def hash_file(self, path, object_type='blob', write=True):
+        return self.call(lambda: hash_file(work_path(path), object_type, write))
+
+    def read_tree(self, sha1):
+        return self.call(read_tree, sha1=sha1)
+
+    def read_commit(self, sha1):
+        return self.call(read_commit, sha1)
+
+    def resolve_tree(self, name):
+        return self.call(resolve_tree, name)
+
+    #Refs
+
+    #Return dict of ref name -> sha1 for every local ref
+    def refs(self):
+        return self.call(read_local_refs)
+
+    #Return the sha1 master is at (None for a new repository)
+    def head(self):
+        return self.call(get_local_master_hash)
+
+    def write_ref(self, name, sha1):
+        return self.call_locked(write_ref, name, sha1)
+
+    #Index and working copy
+
+    def read_index(self):
+        return self.call(read_index)
+
+    #Return tuple of (changed paths, new paths, deleted paths)
+    def status(self):
+        #status refreshes stat data in the index, so it counts as a write
+        return self.call_locked(get_status)
+
+    def add(self, paths, jobs=None):
+        return self.call_locked(add, paths, jobs)
+
+    #Commit the index to master, return the new commit's sha1
+    def commit(self, message, author=None):
+        return self.call_locked(commit, message, author)
+
+    #Return list of the lines of a diff of the working copy against the index
+    def diff(self):
+        return self.call_locked(lambda: list(iter_diff()))
+
+    #Return list of the lines of a diff between two commits
+    def diff_commits(self, a_name, b_name):
+        return self.call(lambda: list(iter_commit_diff(a_name, b_name)))
+
+    def update_index(self, version=None, split=None):
+        return self.call_locked(update_index, version, split)
+
+    #Packs and history
+
+    def repack(self, all_packs=False):
+        return self.call_locked(repack, all_packs)
+
+    def write_commit_graph(self):
+        return self.call_locked(write_commit_graph)
+
+    def gc(self):
+        with self.lock, self.activate():
+            repack(all_packs=True)
+            return write_commit_graph()
+
+    #Remotes
+
+    #Fetch every branch and tag from git_url, return (dict of remote ref name -> sha1, server capabilities)
+    def fetch(self, git_url, username=None, password=None):
+        return self.call_locked(fetch, git_url, username, password)
+
+    #Push refspecs (default: master) to git_url, return tuple of (dict of ref -> (old sha1, new sha1) for each
+    #ref that changed, set of objects sent)
+    def push(self, git_url, refspecs=None, username=None, password=None, window=10, depth=50, atomic=True):
+        with self.lock, self.activate():
+            updates = resolve_refspecs(refspecs or ['master'], read_local_refs())
+            return push_refs(git_url, updates, username, password, window, depth, atomic)
+
+    #Push refspecs (default: master) to every url in git_urls at the same time, return dict of url -> what push
+    #returns for it (see push_many_async)
+    def push_many(self, git_urls, refspecs=None, username=None, password=None, window=10, depth=50, atomic=True):
+        with self.lock, self.activate():
+            updates = resolve_refspecs(refspecs or ['master'], read_local_refs())
+            return push_many(git_urls, updates, username, password, window, depth, atomic)
+
+"""Tracing
+When something is slow we want to know where the time goes without reaching for a profiler. Setting
+GITPY_TRACE (or passing --trace) swaps the functions below for wrappers that count calls, bytes and wall time,
+and swaps the zlib module for one that does the same for every (de)compression. At exit we print a summary
+table to stderr, or with GITPY_TRACE=trace.json (--trace-file trace.json) write a Chrome trace, which can be opened
+in chrome://tracing or ui.perfetto.dev to see every call on a timeline, per thread.
+
+Nothing is wrapped unless tracing is turned on, so it costs nothing when it's off. Times are inclusive (a
+write_index includes its zlib and hash work), and work done in add's worker processes isn't counted."""
+
+TRACE_MAX_EVENTS = 1000000
+
+#Functions to trace, and how to get the number of bytes they handled from (args, result), or None
+TRACED_FUNCTIONS = [
+    ('read_object', lambda args, result: len(result[1])),
+    ('read_object_header', None),
+    ('find_object', None),
+    ('Pack.read_object', lambda args, result: len(result[1])),
+    ('hash_object', lambda args, result: len(args[0])),
+    ('hash_file', lambda args, result: os.path.getsize(args[0])),
+    ('read_tree', None),
+    ('read_commit', None),
+    ('read_index', None),
+    ('read_index_file', None),
+    ('parse_index', lambda args, result: len(args[0])),
+    ('write_index', None),
+    ('get_status', None),
+    ('scan_working_copy', None),
+    ('scan_directory', None),
+    ('read_local_refs', None),
+    ('walk_missing_objects', None),
+    ('create_delta', lambda args, result: len(args[1])),
+    ('write_pack', None),
+    ('index_pack', None),
+    ('get_remote_refs', None),
+    ('fetch_pack', None),
+    ('push_refs', None),
+    ('build_push_pack', lambda args, result: len(result[1])),
+    ('HttpSession.open', lambda args, result: len(args[2]) if len(args) > 2 and isinstance(args[2], bytes) else None),
+    ('HttpResponse.read', lambda args, result: len(result)),
+]
+
+#Collects calls, bytes and time for each traced name (and a timeline of calls for a Chrome trace)
+class Tracer:
+    def __init__(self, output):
+        self.output = output
+        self.keep_events = output.endswith('.json')
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        #name -> [calls, bytes, seconds]
+        self.totals = collections.defaultdict(lambda: [0, 0, 0.0])
+        self.events = []
+        self.dropped_events = 0
+        self.pid = os.getpid()
+
+    def record(self, name, start, end, size):
+        with self.lock:
+            totals = self.totals[name]
+            totals[0] += 1
+            totals[1] += size or 0
+            totals[2] += end - start
+            if not self.keep_events:
+                return
+            if len(self.events) >= TRACE_MAX_EVENTS:
+                self.dropped_events += 1
+                return
+            event = {'name': name, 'ph': 'X', 'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6,
+                     'pid': os.getpid(), 'tid': threading.get_ident()}
+            if size is not None:
+                event['args'] = {'bytes': size}
+            self.events.append(event)
+
+    #Return a wrapper for function that records each call under name
+    def wrap(self, name, function, size=None):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.record(name, start, time.perf_counter(), size(args, result) if size else None)
+            return result
+        return traced
+
+    #Print a table of the totals for each name (slowest first) to file
+    def print_summary(self, file):
+        total = time.perf_counter() - self.start
+        print('gitpy trace: {:.3f}s total'.format(total), file=file)
+        print('{:<24} {:>10} {:>14} {:>10} {:>7}'.format('name', 'calls', 'bytes', 'seconds', '%'), file=file)
+        for name, (calls, size, seconds) in sorted(self.totals.items(), key=lambda item: -item[1][2]):
+            print('{:<24} {:>10} {:>14} {:>10.4f} {:>6.1f}%'.format(
+                    name, calls, size or '', seconds, 100 * seconds / total if total else 0), file=file)
+
+    #Write everything recorded as a Chrome trace (the JSON object format) to path
+    def write_chrome_trace(self, path):
+        with self.lock:
+            trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                     'otherData': {'dropped_events': self.dropped_events,
+                                   'totals': {name: {'calls': calls, 'bytes': size, 'seconds': seconds}
+                                              for name, (calls, size, seconds) in self.totals.items()}}}
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        print('wrote trace of {} calls to {}'.format(len(self.events), path), file=sys.stderr)
+
+    def dump(self):
+        #a forked child (like one of add's worker processes) has its own copy of the tracer, only we report
+        if os.getpid() != self.pid:
+            return
+        if self.keep_events:
+            self.write_chrome_trace(self.output)
+        else:
+            self.print_summary(sys.stderr)
+
+#Stands in for a zlib compressobj or decompressobj, recording each call (bytes are what went in to compress,
+#and what came out of decompress)
+class TracedZlibStream:
+    def __init__(self, tracer, name, stream, count_output):
+        self.tracer = tracer
+        self.name = name
+        self.stream = stream
+        self.count_output = count_output
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def _call(self, method, data, *args):
+        start = time.perf_counter()
+        result = method(data, *args)
+        self.tracer.record(self.name, start, time.perf_counter(), len(result) if self.count_output else len(data))
+        return result
+
+    def compress(self, data):
+        return self._call(self.stream.compress, data)
+
+    def decompress(self, data, *args):
+        return self._call(self.stream.decompress, data, *args)
+
+    def flush(self, *args):
+        start = time.perf_counter()
+        result = self.stream.flush(*args)
+        self.tracer.record(self.name, start, time.perf_counter(), len(result) if self.count_output else 0)
+        return result
+
+#Stands in for the zlib module while tracing
+class TracedZlib:
+    def __init__(self, tracer, module):
+        self.tracer = tracer
+        self.module = module
+        self.compress = tracer.wrap('zlib.compress', module.compress, lambda args, result: len(args[0]))
+        self.decompress = tracer.wrap('zlib.decompress', module.decompress, lambda args, result: len(result))
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def compressobj(self, *args, **kwargs):
+        return TracedZlibStream(self.tracer, 'zlib.compressobj', self.module.compressobj(*args, **kwargs), False)
+
+    def decompressobj(self, *args, **kwargs):
+        return TracedZlibStream(self.tracer, 'zlib.decompressobj', self.module.decompressobj(*args, **kwargs), True)
+
+tracer = None
+
+#Return what GITPY_TRACE asks enable_tracing for, or None if it's unset or off ('', 0 or false)
+def get_trace_setting():
+    value = os.environ.get('GITPY_TRACE', '').strip()
+    if value.lower() in ('', '0', 'false'):
+        return None
+    return value
+
+#Start tracing, output is "summary" (or anything not ending in .json) for a table on stderr at exit,
+#or the path of a Chrome trace to write at exit. Returns the Tracer
+def enable_tracing(output='summary'):
+    global tracer, zlib
+    if tracer is not None:
+        return tracer
+    tracer = Tracer(output)
+    module_globals = globals()
+    for name, size in TRACED_FUNCTIONS:
+        if '.' in name:
+            class_name, method_name = name.split('.')
+            cls = module_globals[class_name]
+            setattr(cls, method_name, tracer.wrap(name, getattr(cls, method_name), size))
+        else:
+            module_globals[name] = tracer.wrap(name, module_globals[name], size)
+    zlib = TracedZlib(tracer, zlib)
+    atexit.register(tracer.dump)
+    return tracer
+
 if __name__ == '__main__':
     #okay we're expecting something like 'py gitpy.py command'
     parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', action='store_const', const='summary', default=get_trace_setting(),
+                        help='print where the time went at exit (GITPY_TRACE is the default environment variable,'
+                             ' set it to a .json file name to write a Chrome trace instead)')
+    parser.add_argument('--trace-file', dest='trace', metavar='file.json',
+                        help='write a Chrome trace of where the time went to file.json at exit')
     sub_parsers = parser.add_subparsers(dest='command', metavar='command')
     sub_parsers.required = True
 
     #add commands and description of what they do
     sub_parser = sub_parsers.add_parser('add', help='add file(s) to index')
-    sub_parser.add_argument('paths', nargs='+', metavar='path', help='path(s) of files to add')
+    sub_parser.add_argument('paths', nargs='+', metavar='path',
+                            help='path(s) of files, directories or glob patterns to add')
+    sub_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of processes to hash files with (defaults to the number of cpus)')
 
     sub_parser = sub_parsers.add_parser('cat-file', help='display contents of object')
     #Defines the type of modes this command/arg can have
@@ -682,6 +4929,12 @@ if __name__ == '__main__':
                             help='object type (commit, tree, blob) or display mode (size, type, pretty)')
     sub_parser.add_argument('hash_prefix', help='SHA-1 hash (or sha-1 prefix) of object to display')
 
+    sub_parser = sub_parsers.add_parser('clone', help='clone a repository from a git server into a new directory')
+    sub_parser.add_argument('git_url', help='url of git repo, ex: https://github.com/yourprofile/yourrepo.git')
+    sub_parser.add_argument('repo', help='directory name for new repo')
+    sub_parser.add_argument('-p', '--password', help='password to use for authentication (GIT_PASSWORD is the default environment parameter)')
+    sub_parser.add_argument('-u', '--username', help='username for authentication (GIT_USERNAME is the environement default variable)')
+
     sub_parser = sub_parsers.add_parser('commit', help='commit current state of index to master branch')
     sub_parser.add_argument('-a', '--author',
                             help='commit author in format "A U Jake <author@email.com>"'
@@ -689,8 +4942,24 @@ if __name__ == '__main__':
                             'variables by default)')
     sub_parser.add_argument('-m', '--message', required=True, help='text of commit message')
 
-    sub_parser = sub_parsers.add_parser('diff', help='shows difference of files changed between index and current copy')
+    sub_parser = sub_parsers.add_parser('commit-graph',
+        help='write a commit-graph file so history can be walked without reading commit objects')
+
+    sub_parser = sub_parsers.add_parser('diff', help='shows difference of files changed between index and current copy'
+                                        ' (or between two commits)')
+    sub_parser.add_argument('commits', nargs='*', metavar='commit',
+                            help='two commits to compare (a sha1 or prefix, HEAD, a branch or tag, optionally with ~n or ^)')
     
+    sub_parser = sub_parsers.add_parser('fetch', help='fetch branches and tags from a git server')
+    sub_parser.add_argument('git_url', help='url of git repo, ex: https://github.com/yourprofile/yourrepo.git')
+    sub_parser.add_argument('-p', '--password', help='password to use for authentication (GIT_PASSWORD is the default environment parameter)')
+    sub_parser.add_argument('-u', '--username', help='username for authentication (GIT_USERNAME is the environement default variable)')
+
+    sub_parser = sub_parsers.add_parser('fsmonitor-daemon',
+        help='watch the working copy with inotify so status only looks at what changed (runs until interrupted)')
+
+    sub_parser = sub_parsers.add_parser('gc', help='pack all objects into a single pack file')
+
     sub_parser = sub_parsers.add_parser('hash-object', help='hash content of given path (and optionally write to store)')
     sub_parser.add_argument('path', help='path of object to hash')
     sub_parser.add_argument('-t', choices=['commit', 'tree', 'blob'], 
@@ -701,40 +4970,111 @@ if __name__ == '__main__':
     sub_parser.add_argument('repo', help='directory name for new repo')
 
     sub_parser = sub_parsers.add_parser('ls-files', help='list files in index')
-    sub_parser.add_argument('-s' '--stage', action='store_true', help='show object details (mode, has, stage number) as well as the path')
+    sub_parser.add_argument('-s', '--stage', action='store_true', help='show object details (mode, has, stage number) as well as the path')
 
-    sub_parser = sub_parsers.add_parser('push', help='push master branch to given git server url')
+    sub_parser = sub_parsers.add_parser('push', help='push master branch (or other branches and tags) to given git server url')
     sub_parser.add_argument('git_url', help='url of git repo, ex: https://github.com/yourprofile/yourrepo.git')
+    sub_parser.add_argument('refspecs', nargs='*', metavar='refspec',
+                            help='branches or tags to push, as name or src:dst (master by default)')
+    sub_parser.add_argument('--all', action='store_true', help='push every local branch')
+    sub_parser.add_argument('--tags', action='store_true', help='push every local tag')
+    sub_parser.add_argument('--to', action='append', default=[], metavar='git_url', dest='more_urls',
+                            help='also push to this url (can be given more than once), every remote is pushed to at the same time')
+    sub_parser.add_argument('--no-atomic', action='store_false', dest='atomic',
+                            help="don't ask the server to update all refs or none of them")
     sub_parser.add_argument('-p', '--password', help = 'password to use for authentication (GIT_PASSWORD is the default environment parameter)')
     sub_parser.add_argument('-u', '--username', help='username for authentication (GIT_USERNAME is the environement default variable)')
+    sub_parser.add_argument('--window', type=int, default=10,
+                            help='number of objects to try as delta bases for each object (0 disables deltas, default 10)')
+    sub_parser.add_argument('--depth', type=int, default=50, help='maximum length of a delta chain (default 50)')
+
+    sub_parser = sub_parsers.add_parser('repack', help='pack loose objects into a pack file')
+    sub_parser.add_argument('-a', action='store_true', dest='all_packs',
+                            help='also pack objects from existing packs, leaving a single pack')
 
     sub_parser = sub_parsers.add_parser('status',
         help='show status of working copy')
 
+    sub_parser = sub_parsers.add_parser('update-index', help='change how the index is stored')
+    sub_parser.add_argument('--index-version', type=int, choices=[2, 4],
+                            help='index format version (4 compresses paths)')
+    sub_parser.add_argument('--split-index', action='store_true', default=None, dest='split',
+                            help='keep most entries in a shared index so writes only contain changes')
+    sub_parser.add_argument('--no-split-index', action='store_false', dest='split',
+                            help='write the whole index to .git/index again')
+
     args = parser.parse_args()
 
+    if args.trace:
+        enable_tracing(args.trace)
+
+    #init and clone make a repository, everything else works on the one in the current directory
+    if args.command == 'init':
+        Repository.init(args.repo)
+        sys.exit(0)
+    if args.command == 'clone':
+        Repository.clone(args.git_url, args.repo, username=args.username, password=args.password)
+        sys.exit(0)
+    try:
+        repo = Repository('.', object_cache_bytes=int(os.environ.get('GITPY_OBJECT_CACHE') or 0))
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+
     if args.command == 'add':
-        add(args.paths)
+        repo.add(args.paths, jobs=args.jobs)
     elif args.command == 'cat-file':
         try:
-            cat_file(args.mode, args.hash_prefix)
+            repo.call(cat_file, args.mode, args.hash_prefix)
         except ValueError as error:
             print(error, file=sys.stderr)
             sys.exit(1)
     elif args.command == 'commit':
-        commit(args.message, author=args.author)
+        repo.commit(args.message, author=args.author)
+    elif args.command == 'commit-graph':
+        print('wrote commit-graph with {} commits'.format(repo.write_commit_graph()))
     elif args.command == 'diff':
-        diff()
+        if not args.commits:
+            lines = repo.diff()
+        elif len(args.commits) == 2:
+            try:
+                lines = repo.diff_commits(*args.commits)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
+        else:
+            parser.error('diff takes no commits or two of them')
+        for line in lines:
+            print(line)
+    elif args.command == 'fetch':
+        repo.fetch(args.git_url, username=args.username, password=args.password)
+    elif args.command == 'fsmonitor-daemon':
+        repo.call(fsmonitor_daemon)
+    elif args.command == 'gc':
+        repo.gc()
     elif args.command == 'hash-object':
-        sha1 = hash_object(read_file(args.path), args.type, write=args.write)
-        print(sha1)
-    elif args.command == 'init':
-        init(args.repo)
+        print(repo.hash_file(args.path, args.type, write=args.write))
     elif args.command == 'ls-files':
-        ls_files(details=args.stage)
+        repo.call(ls_files, details=args.stage)
     elif args.command == 'push':
-        push(args.git_url, username=args.username, password=args.password)
+        refspecs = list(args.refspecs)
+        if args.all or args.tags:
+            local_refs = repo.refs()
+            if args.all:
+                refspecs.extend(name for name in local_refs if name.startswith('refs/heads/'))
+            if args.tags:
+                refspecs.extend(name for name in local_refs if name.startswith('refs/tags/'))
+        if args.more_urls:
+            repo.push_many([args.git_url] + args.more_urls, refspecs, username=args.username,
+                           password=args.password, window=args.window, depth=args.depth, atomic=args.atomic)
+        else:
+            repo.push(args.git_url, refspecs, username=args.username, password=args.password,
+                      window=args.window, depth=args.depth, atomic=args.atomic)
+    elif args.command == 'repack':
+        repo.repack(all_packs=args.all_packs)
     elif args.command == 'status':
-        status()
+        repo.call_locked(status)
+    elif args.command == 'update-index':
+        repo.update_index(version=args.index_version, split=args.split)
     else:
-        assert False, 'unexpected command {!r}'.format(args.command)
\ No newline at end of file
+        assert False, 'unexpected command {!r}'.format(args.command)
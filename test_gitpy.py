@@ -0,0 +1,270 @@
+"""Tests for gitpy, run with: python -m unittest test_gitpy
+
+These need the real git command line: it builds the remote repositories we talk to (and checks what we write),
+and its http-backend serves them to gitpy over http on localhost."""
+
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+import contextlib
+import io
+import asyncio
+import unittest
+import unittest.mock
+import http.server
+
+import gitpy
+
+#Run git with args in directory cwd, return its output
+def run_git(cwd, *args, env=None):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          env=dict(os.environ, **(env or {}))).stdout.decode()
+
+#Commit a file with the given contents in the (non bare) git repository at path, return the commit's sha1
+def git_commit(path, name, contents, message):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(contents)
+    run_git(path, 'add', name)
+    env = {'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+           'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com'}
+    run_git(path, 'commit', '-q', '-m', message, env=env)
+    return run_git(path, 'rev-parse', 'HEAD').strip()
+
+#Make an annotated tag called name of target in the git repository at path
+def git_tag(path, name, target='HEAD'):
+    env = {'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com'}
+    run_git(path, 'tag', '-a', '-m', 'tag ' + name, name, target, env=env)
+
+#Serves every repository under root with git http-backend (pushes included)
+class GitHttpBackendHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    root = None
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        if (self.headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def run_backend(self):
+        path, _, query = self.path.partition('?')
+        body = self.read_body() if self.command == 'POST' else b''
+        env = dict(os.environ, GIT_PROJECT_ROOT=self.root, GIT_HTTP_EXPORT_ALL='1', REMOTE_USER='test',
+                   REQUEST_METHOD=self.command, PATH_INFO=path, QUERY_STRING=query,
+                   CONTENT_TYPE=self.headers.get('Content-Type') or '', CONTENT_LENGTH=str(len(body)))
+        output = subprocess.run(['git', 'http-backend'], input=body, stdout=subprocess.PIPE, env=env).stdout
+        head, _, response = output.partition(b'\r\n\r\n')
+        status = 200
+        headers = []
+        for line in head.decode().split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.lower() == 'status':
+                status = int(value.split()[0])
+            else:
+                headers.append((name, value.strip()))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = run_backend
+    do_POST = run_backend
+
+#Start a threaded http server with handler on a free port, return the server (shut it down when done)
+def start_server(handler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@unittest.skipIf(shutil.which('git') is None, 'needs the git command line')
+class GitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    #Create a bare remote called name.git that the http server can serve, return its path
+    def make_remote(self, name):
+        path = os.path.join(self.tmp, 'remotes', name + '.git')
+        run_git(self.tmp, 'init', '-q', '--bare', path)
+        run_git(path, 'config', 'http.receivepack', 'true')
+        return path
+
+    #Serve everything made by make_remote, return the base url
+    def serve_remotes(self):
+        handler = type('Handler', (GitHttpBackendHandler,), {'root': os.path.join(self.tmp, 'remotes')})
+        server = start_server(handler)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    #Create a gitpy repository called name, return its Repository
+    def make_repository(self, name):
+        with contextlib.redirect_stdout(io.StringIO()):
+            repo = gitpy.Repository.init(os.path.join(self.tmp, name))
+        self.addCleanup(repo.close)
+        return repo
+
+    #Call method (quietly), return what it returns
+    def quietly(self, method, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return method(*args, **kwargs)
+
+class FetchTest(GitTestCase):
+    def test_fetch_twice_with_annotated_tag(self):
+        remote = self.make_remote('tagged')
+        work = os.path.join(self.tmp, 'work')
+        run_git(self.tmp, 'clone', '-q', remote, work)
+        first = git_commit(work, 'a.txt', 'one\n', 'first')
+        git_tag(work, 'v1')
+        run_git(work, 'push', '-q', 'origin', 'HEAD:refs/heads/master', '--tags')
+        url = self.serve_remotes() + 'tagged.git'
+        repo = self.make_repository('local')
+        refs, _ = self.quietly(repo.fetch, url)
+        self.assertEqual(refs['refs/heads/master'], first)
+        #the tag written by the first fetch is a have for the second
+        self.assertEqual(repo.call(gitpy.peel_tag, repo.refs()['refs/tags/v1'])[0], first)
+        refs, _ = self.quietly(repo.fetch, url)
+        self.assertEqual(refs['refs/heads/master'], first)
+        second = git_commit(work, 'a.txt', 'two\n', 'second')
+        git_tag(work, 'v2')
+        run_git(work, 'push', '-q', 'origin', 'HEAD:refs/heads/master', '--tags')
+        refs, _ = self.quietly(repo.fetch, url)
+        self.assertEqual(refs['refs/heads/master'], second)
+        self.assertEqual(repo.read_object(second)[0], 'commit')
+        run_git(repo.path, 'fsck', '--strict')
+
+class CommitGraphTest(GitTestCase):
+    def test_gc_with_annotated_tags(self):
+        path = os.path.join(self.tmp, 'repo')
+        run_git(self.tmp, 'init', '-q', path)
+        git_commit(path, 'a.txt', 'one\n', 'first')
+        git_tag(path, 'v1')
+        git_commit(path, 'a.txt', 'two\n', 'second')
+        #a tag of a tag, and tags of things that aren't commits
+        git_tag(path, 'v2')
+        git_tag(path, 'v2-again', 'v2')
+        git_tag(path, 'tree', 'HEAD^{tree}')
+        git_tag(path, 'blob', 'HEAD:a.txt')
+        repo = gitpy.Repository(path)
+        self.addCleanup(repo.close)
+        self.quietly(repo.gc)
+        run_git(path, 'commit-graph', 'verify')
+        graph = repo.call(gitpy.get_commit_graph)
+        self.assertEqual(graph.count, 2)
+
+class PushTest(GitTestCase):
+    #Make a gitpy repository with one commit, return its Repository
+    def make_committed_repository(self):
+        repo = self.make_repository('local')
+        with open(os.path.join(repo.path, 'a.txt'), 'w') as f:
+            f.write('one\n')
+        self.quietly(repo.add, ['a.txt'])
+        self.quietly(repo.commit, 'first', 'Test <test@example.com>')
+        return repo
+
+    def test_push(self):
+        remote = self.make_remote('pushed')
+        url = self.serve_remotes() + 'pushed.git'
+        repo = self.make_committed_repository()
+        updated, missing = self.quietly(repo.push, url, username='user', password='secret')
+        self.assertEqual(updated['refs/heads/master'], (None, repo.head()))
+        self.assertEqual(len(missing), 3)
+        self.assertEqual(run_git(remote, 'rev-parse', 'master').strip(), repo.head())
+        run_git(remote, 'fsck', '--strict')
+
+    def test_failed_push_closes_session(self):
+        self.make_remote('pushed')
+        url = self.serve_remotes() + 'pushed.git'
+        repo = self.make_committed_repository()
+        closed = []
+        def fail(*args, **kwargs):
+            raise ValueError('walk failed')
+        def close(session):
+            closed.append(session)
+            original_close(session)
+        original_close = gitpy.HttpSession.close
+        with unittest.mock.patch.object(gitpy, 'walk_missing_objects', fail), \
+                unittest.mock.patch.object(gitpy.HttpSession, 'close', close):
+            with self.assertRaisesRegex(ValueError, 'walk failed'):
+                self.quietly(repo.push, url, username='user', password='secret')
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(dict(closed[0].idle), {})
+
+#Redirects every request to target + /done (unless target is None or it's already /done, then answers ok),
+#and remembers the Authorization header of each request it gets
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    target = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.authorizations.append(self.headers.get('Authorization'))
+        if self.target is None or self.path == '/done':
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        else:
+            self.send_response(302)
+            self.send_header('Location', self.target + '/done')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+class RedirectTest(unittest.TestCase):
+    #Start a server that redirects to target (or answers itself if it's None), return it
+    def start(self, target=None):
+        server = start_server(type('Handler', (RedirectHandler,), {'target': target}))
+        server.authorizations = []
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    #Check request(url) sends credentials to the server in the url, but not to one it gets redirected to
+    def check_redirect(self, request):
+        other_host = self.start()
+        #localhost and 127.0.0.1 are the same machine, but not the same host as far as the url goes
+        elsewhere = self.start('http://localhost:{}'.format(other_host.server_port))
+        self.assertEqual(request('http://127.0.0.1:{}/x'.format(elsewhere.server_port)), b'ok')
+        self.assertIsNotNone(elsewhere.authorizations[0])
+        self.assertEqual(other_host.authorizations, [None])
+        #a different port is a different server too
+        other_port = self.start()
+        elsewhere = self.start('http://127.0.0.1:{}'.format(other_port.server_port))
+        self.assertEqual(request('http://127.0.0.1:{}/x'.format(elsewhere.server_port)), b'ok')
+        self.assertEqual(other_port.authorizations, [None])
+        #but a redirect that stays on the same server keeps them
+        same = self.start()
+        same.RequestHandlerClass.target = 'http://127.0.0.1:{}'.format(same.server_port)
+        self.assertEqual(request('http://127.0.0.1:{}/x'.format(same.server_port)), b'ok')
+        self.assertEqual(len(same.authorizations), 2)
+        self.assertIsNotNone(same.authorizations[1])
+
+    def test_cross_host_redirect_drops_credentials(self):
+        with gitpy.HttpSession('user', 'secret') as session:
+            self.check_redirect(session.request)
+
+    def test_async_cross_host_redirect_drops_credentials(self):
+        def request(url):
+            async def run():
+                async with gitpy.AsyncHttpSession('user', 'secret') as session:
+                    return await session.request(url)
+            return asyncio.run(run())
+        self.check_redirect(request)
+
+if __name__ == '__main__':
+    unittest.main()